@@ -0,0 +1,123 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import batched
+from typing import NamedTuple
+
+from indico_payment_icbc.util import RsaUtil, get_aes_codec, get_icbc_verifier
+
+#: number of payloads a worker process verifies at once
+AUDIT_CHUNK_SIZE = 500
+#: the path the notifications of ICBC are signed with
+NOTIFY_SIGN_PATH = "/notifyUrlServlet"
+
+_worker_public_key = None
+
+
+class AuditResult(NamedTuple):
+    transaction_id: int
+    #: ``valid``, ``invalid`` (the signature does not match the data, or the
+    #: stored decrypted data does not match the signed one),
+    #: ``amount_mismatch`` (the signed amount differs from the one of the
+    #: transaction), ``malformed`` or ``unsigned`` (e.g. the placeholder
+    #: of an order, which has nothing to verify)
+    outcome: str
+    detail: str = ""
+
+
+def check_payload(transaction_id, amount, data, encrypt_key=None, public_key=None):
+    """Check the ICBC signature of the data stored in a transaction.
+
+    Notifications are verified like the notify handler does it.  For order
+    query responses stored by the success handler only the encrypted
+    ``response_biz_content`` is signed, so it is decrypted with the
+    ``encrypt_key`` of the event and compared with the decrypted copy
+    stored next to it.
+
+    :param amount: the amount of the transaction
+    :param data: the ``data`` of the transaction
+    :param encrypt_key: the ``encrypt_key`` setting of the event, which is
+                        needed to check order query responses
+    :param public_key: the ``gateway_public_key`` setting
+    :return: an :class:`AuditResult`
+    """
+    if not data or "sign" not in data:
+        return AuditResult(transaction_id, "unsigned")
+    try:
+        if "response_biz_content" in data:
+            if not encrypt_key:
+                raise ValueError("no encrypt_key to decrypt the response")
+            content = f'"{data["response_biz_content"]}"'
+            signed_biz_content = get_aes_codec(encrypt_key).decrypt(
+                data["response_biz_content"]
+            )
+        else:
+            params = {key: value for key, value in data.items() if key != "sign"}
+            content = RsaUtil.encrypt_str(NOTIFY_SIGN_PATH, params)
+            signed_biz_content = data["biz_content"]
+        if not get_icbc_verifier(public_key).verify_sign(content, data["sign"]):
+            return AuditResult(transaction_id, "invalid", "signature does not match")
+        signed_amount = int(json.loads(signed_biz_content)["total_amt"])
+    except (KeyError, TypeError, ValueError) as exc:
+        return AuditResult(transaction_id, "malformed", f"{type(exc).__name__}: {exc}")
+    if data.get("biz_content") != signed_biz_content:
+        return AuditResult(
+            transaction_id, "invalid", "biz_content does not match the signed one"
+        )
+    if signed_amount != round(amount * 100):
+        return AuditResult(
+            transaction_id,
+            "amount_mismatch",
+            f"signed {signed_amount} != stored {round(amount * 100)}",
+        )
+    return AuditResult(transaction_id, "valid")
+
+
+def _init_worker(public_key):
+    global _worker_public_key
+    _worker_public_key = public_key
+
+
+def _check_chunk(rows):
+    return [check_payload(*row, public_key=_worker_public_key) for row in rows]
+
+
+def audit_payloads(rows, *, public_key=None, workers=None, chunk_size=AUDIT_CHUNK_SIZE):
+    """Check the signatures of stored payloads on all CPU cores.
+
+    The rows are consumed lazily and only a couple of chunks per worker are
+    in flight, so they can be streamed from the database.  The workers are
+    spawned instead of forked so they never share the database connection
+    of the caller.
+
+    :param rows: an iterable of ``(transaction_id, amount, data,
+                 encrypt_key)`` tuples, with the ``encrypt_key`` setting of
+                 the event of each transaction
+    :param public_key: the ``gateway_public_key`` setting
+    :param workers: the number of worker processes, defaults to the number
+                    of CPUs; with ``1`` everything runs in this process
+    :return: an iterator of :class:`AuditResult`, not necessarily in the
+             order of the rows
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for row in rows:
+            yield check_payload(*row, public_key=public_key)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(public_key,),
+    ) as executor:
+        pending = set()
+        for chunk in batched(rows, chunk_size):
+            pending.add(executor.submit(_check_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in pending:
+            yield from future.result()
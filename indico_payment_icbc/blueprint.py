@@ -1,15 +1,45 @@
 from indico.core.plugins import IndicoPluginBlueprint
 
-from indico_payment_icbc.controllers import RHICBCpayNotify, RHICBCpaySuccess
+from indico_payment_icbc.controllers import (
+    RHICBCExportTransactions,
+    RHICBCMetrics,
+    RHICBCpayNotify,
+    RHICBCpaySign,
+    RHICBCpaySuccess,
+)
+
+blueprint = IndicoPluginBlueprint("payment_icbc", __name__)
 
-blueprint = IndicoPluginBlueprint(
-    "payment_icbc",
-    __name__,
-    url_prefix="/event/<int:event_id>/registrations/<int:reg_form_id>/icbc",
+# build and sign the request once the payer picked a channel
+blueprint.add_url_rule(
+    "/event/<int:event_id>/registrations/<int:reg_form_id>/icbc/sign",
+    "sign",
+    RHICBCpaySign,
+    methods=("POST",),
 )
 
 # sync return
-blueprint.add_url_rule("/success", "success", RHICBCpaySuccess, methods=("GET", "POST"))
+blueprint.add_url_rule(
+    "/event/<int:event_id>/registrations/<int:reg_form_id>/icbc/success",
+    "success",
+    RHICBCpaySuccess,
+    methods=("GET", "POST"),
+)
 
 # async return
-blueprint.add_url_rule("/notify", "notify", RHICBCpayNotify, methods=("POST",))
+blueprint.add_url_rule(
+    "/event/<int:event_id>/registrations/<int:reg_form_id>/icbc/notify",
+    "notify",
+    RHICBCpayNotify,
+    methods=("POST",),
+)
+
+# transaction export for the organizers
+blueprint.add_url_rule(
+    "/event/<int:event_id>/manage/payments/icbc/transactions.<any(csv,jsonl):format>",
+    "export_transactions",
+    RHICBCExportTransactions,
+)
+
+# prometheus scrape endpoint
+blueprint.add_url_rule("/icbc/metrics", "metrics", RHICBCMetrics)
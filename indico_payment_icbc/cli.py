@@ -0,0 +1,421 @@
+import csv
+import json
+from collections import Counter
+from datetime import timedelta
+from itertools import batched
+
+import click
+from flask_pluginengine import current_plugin
+from indico.cli.core import cli_group
+from indico.core.db import db
+from indico.modules.events.models.events import Event
+from indico.modules.events.payment.models.transactions import (
+    PaymentTransaction,
+    TransactionStatus,
+)
+from indico.modules.events.registration.models.registrations import Registration
+from indico.util.console import cformat
+from indico.util.date_time import as_utc
+
+from indico_payment_icbc.audit import AUDIT_CHUNK_SIZE, audit_payloads
+from indico_payment_icbc.export import (
+    EXPORT_BATCH_SIZE,
+    EXPORT_FORMATS,
+    iter_export_rows,
+    query_transactions,
+)
+from indico_payment_icbc.models.notifications import (
+    ICBCNotification,
+    ICBCNotificationState,
+)
+from indico_payment_icbc.models.orders import ICBCOrder
+from indico_payment_icbc.operations import process_notification
+from indico_payment_icbc.plugin import ORDER_LIFETIME
+from indico_payment_icbc.reconciliation import (
+    RECONCILE_BATCH_SIZE,
+    RECONCILE_CONCURRENCY,
+    RECONCILE_GRACE_PERIOD,
+    RECONCILE_MIN_AGE,
+    find_unreconciled_orders,
+    reconcile_orders,
+)
+from indico_payment_icbc.settlement import (
+    DEFAULT_COLUMNS,
+    SETTLEMENT_BATCH_SIZE,
+    StatementFormatError,
+    read_statement,
+    reconcile_statement,
+)
+
+
+@cli_group(name="icbc")
+def cli():
+    """Manage the ICBC payment plugin."""
+
+
+@cli.command()
+@click.option(
+    "--hours",
+    type=int,
+    default=48,
+    show_default=True,
+    help="How many hours back to look for unreconciled orders",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=RECONCILE_BATCH_SIZE,
+    show_default=True,
+    help="Number of orders committed at once",
+)
+@click.option(
+    "--concurrency",
+    type=int,
+    default=RECONCILE_CONCURRENCY,
+    show_default=True,
+    help="Maximum number of concurrent requests to ICBC",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Only report paid orders without registering them"
+)
+@click.option(
+    "--include-expired",
+    is_flag=True,
+    help="Also query orders which expired before the grace period",
+)
+def reconcile(hours, batch_size, concurrency, dry_run, include_expired):
+    """Query ICBC for unpaid orders and register the paid ones."""
+    orders = find_unreconciled_orders(
+        window=timedelta(hours=hours),
+        min_age=RECONCILE_MIN_AGE,
+        grace_period=None if include_expired else RECONCILE_GRACE_PERIOD,
+        batch_size=batch_size,
+    )
+    stats = reconcile_orders(
+        orders, batch_size=batch_size, concurrency=concurrency, dry_run=dry_run
+    )
+    click.echo(f"Checked {sum(stats.values())} unreconciled orders")
+    for outcome, count in sorted(stats.items()):
+        click.echo(cformat("%{green!}{}%{reset}: {}").format(outcome, count))
+
+
+@cli.command("replay-notifications")
+@click.option(
+    "--id",
+    "notification_ids",
+    type=int,
+    multiple=True,
+    help="Only replay the notifications with these IDs (can be used multiple times)",
+)
+@click.option(
+    "--pending", is_flag=True, help="Also replay notifications never processed"
+)
+def replay_notifications(notification_ids, pending):
+    """Process stored ICBC notifications which failed processing.
+
+    Notifications which have been processed successfully are never
+    registered twice, even when their ID is given explicitly.
+    """
+    query = ICBCNotification.query.order_by(ICBCNotification.id)
+    if notification_ids:
+        query = query.filter(ICBCNotification.id.in_(notification_ids))
+    else:
+        states = {ICBCNotificationState.failed}
+        if pending:
+            states.add(ICBCNotificationState.pending)
+        query = query.filter(ICBCNotification.state.in_(states))
+    ids = [id_ for id_, in query.with_entities(ICBCNotification.id)]
+    click.echo(f"Replaying {len(ids)} notifications")
+    stats = Counter()
+    for id_ in ids:
+        state = process_notification(ICBCNotification.query.get(id_))
+        db.session.commit()
+        stats[state.name] += 1
+    for outcome, count in sorted(stats.items()):
+        click.echo(cformat("%{green!}{}%{reset}: {}").format(outcome, count))
+
+
+@cli.command()
+@click.option("--event", "event_id", type=int, help="Only export this event")
+@click.option(
+    "--since", type=click.DateTime(), help="Only export transactions since (UTC)"
+)
+@click.option(
+    "--until", type=click.DateTime(), help="Only export transactions before (UTC)"
+)
+@click.option(
+    "--status",
+    "statuses",
+    type=click.Choice([status.name for status in TransactionStatus]),
+    multiple=True,
+    help="Only export transactions with this status (can be used multiple times)",
+)
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(sorted(EXPORT_FORMATS)),
+    default="csv",
+    show_default=True,
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=EXPORT_BATCH_SIZE,
+    show_default=True,
+    help="Number of rows fetched from the database at once",
+)
+@click.argument("output", type=click.File("w", encoding="utf-8"), default="-")
+def export(event_id, since, until, statuses, format_, batch_size, output):
+    """Export ICBC transactions with their order details."""
+    query = query_transactions(
+        event_id=event_id,
+        start_dt=as_utc(since) if since else None,
+        end_dt=as_utc(until) if until else None,
+        statuses=[TransactionStatus[status] for status in statuses],
+    )
+    writer = EXPORT_FORMATS[format_][0]
+    output.writelines(writer(iter_export_rows(query, batch_size=batch_size)))
+
+
+@cli.command()
+@click.argument("statement", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--encoding",
+    default="utf-8-sig",
+    show_default=True,
+    help="Encoding of the statement file (e.g. gbk)",
+)
+@click.option("--delimiter", default="|", show_default=True)
+@click.option(
+    "--column",
+    "columns",
+    type=(click.Choice(sorted(DEFAULT_COLUMNS)), str),
+    multiple=True,
+    help="Use a different statement column, e.g. '--column amount 交易金额'",
+)
+@click.option("--yuan", is_flag=True, help="The amounts are in yuan instead of fen")
+@click.option(
+    "--since",
+    type=click.DateTime(),
+    help="Start of the statement period (UTC), to find orders missing from it",
+)
+@click.option(
+    "--until", type=click.DateTime(), help="End of the statement period (UTC)"
+)
+@click.option(
+    "--register",
+    is_flag=True,
+    help="Register the payments which are in the statement but not in Indico",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=SETTLEMENT_BATCH_SIZE,
+    show_default=True,
+    help="Number of records matched at once",
+)
+@click.option(
+    "--report",
+    type=click.File("w", encoding="utf-8"),
+    help="Write every record which did not match to this CSV file",
+)
+def settle(
+    statement,
+    encoding,
+    delimiter,
+    columns,
+    yuan,
+    since,
+    until,
+    register,
+    batch_size,
+    report,
+):
+    """Reconcile a settlement statement of ICBC with the orders in Indico."""
+    if (since is None) != (until is None):
+        raise click.UsageError("--since and --until must be used together")
+    with open(statement, encoding=encoding, newline="") as fileobj:
+        records = read_statement(
+            fileobj, delimiter=delimiter, columns=dict(columns), amount_in_yuan=yuan
+        )
+        results = reconcile_statement(
+            records,
+            start_dt=as_utc(since) if since else None,
+            end_dt=as_utc(until) if until else None,
+            register=register,
+            batch_size=batch_size,
+        )
+        writer = None
+        if report:
+            writer = csv.writer(report)
+            writer.writerow(("outcome", "line", "mer_id", "out_trade_no", "detail"))
+        stats = Counter()
+        try:
+            for result in results:
+                stats[result.outcome] += 1
+                if writer and result.outcome not in ("matched", "registered"):
+                    source = result.record or result.order
+                    writer.writerow(
+                        (
+                            result.outcome,
+                            result.record.line if result.record else "",
+                            source.mer_id,
+                            source.out_trade_no,
+                            result.detail,
+                        )
+                    )
+        except StatementFormatError as exc:
+            raise click.ClickException(str(exc))
+    for outcome, count in sorted(stats.items()):
+        click.echo(cformat("%{green!}{}%{reset}: {}").format(outcome, count))
+
+
+@cli.command("verify-signatures")
+@click.option("--event", "event_id", type=int, help="Only verify this event")
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of worker processes  [default: number of CPUs]",
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=AUDIT_CHUNK_SIZE,
+    show_default=True,
+    help="Number of payloads a worker verifies at once",
+)
+@click.option(
+    "--report",
+    type=click.File("w", encoding="utf-8"),
+    help="Write every transaction which did not verify to this CSV file",
+)
+def verify_signatures(event_id, workers, chunk_size, report):
+    """Verify the ICBC signatures of the stored transaction data.
+
+    Exits with status 1 if any transaction data is not signed correctly.
+    """
+    query = (
+        PaymentTransaction.query.join(
+            Registration, PaymentTransaction.registration_id == Registration.id
+        )
+        .filter(PaymentTransaction.provider == "icbc")
+        .order_by(PaymentTransaction.id)
+        .with_entities(
+            PaymentTransaction.id,
+            PaymentTransaction.amount,
+            PaymentTransaction.data,
+            Registration.event_id,
+        )
+    )
+    if event_id is not None:
+        query = query.filter(Registration.event_id == event_id)
+    encrypt_keys = {}
+
+    def _get_encrypt_key(id_):
+        # the order query responses are encrypted with the key of the event
+        if id_ not in encrypt_keys:
+            encrypt_keys[id_] = current_plugin.event_settings.get(
+                Event.get(id_), "encrypt_key"
+            )
+        return encrypt_keys[id_]
+
+    rows = (
+        (transaction_id, amount, data, _get_encrypt_key(id_))
+        for transaction_id, amount, data, id_ in query.yield_per(EXPORT_BATCH_SIZE)
+    )
+    results = audit_payloads(
+        rows,
+        public_key=current_plugin.settings.get("gateway_public_key"),
+        workers=workers,
+        chunk_size=chunk_size,
+    )
+    writer = None
+    if report:
+        writer = csv.writer(report)
+        writer.writerow(("transaction_id", "outcome", "detail"))
+    stats = Counter()
+    for result in results:
+        stats[result.outcome] += 1
+        if result.outcome in ("valid", "unsigned"):
+            continue
+        click.echo(
+            cformat("%{red!}{}%{reset}: transaction {} ({})").format(
+                result.outcome, result.transaction_id, result.detail
+            )
+        )
+        if writer:
+            writer.writerow(result)
+    for outcome, count in sorted(stats.items()):
+        click.echo(cformat("%{green!}{}%{reset}: {}").format(outcome, count))
+    if set(stats) - {"valid", "unsigned"}:
+        raise click.exceptions.Exit(1)
+
+
+@cli.command("backfill-orders")
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1000,
+    show_default=True,
+    help="Number of transactions committed at once",
+)
+def backfill_orders(batch_size):
+    """Create the order table entries for orders made before it existed."""
+    transaction_ids = [
+        id_
+        for id_, in PaymentTransaction.query.filter(
+            PaymentTransaction.provider == "icbc",
+            PaymentTransaction.status.in_(
+                [TransactionStatus.rejected, TransactionStatus.successful]
+            ),
+        )
+        .order_by(PaymentTransaction.id)
+        .with_entities(PaymentTransaction.id)
+    ]
+    stats = Counter()
+    for ids in batched(transaction_ids, batch_size):
+        transactions = (
+            PaymentTransaction.query.filter(PaymentTransaction.id.in_(ids))
+            .order_by(PaymentTransaction.id)
+            .all()
+        )
+        for transaction in transactions:
+            if transaction.data and "biz_content" in transaction.data:
+                stats[_backfill_order(transaction)] += 1
+        db.session.commit()
+    for outcome, count in sorted(stats.items()):
+        click.echo(cformat("%{green!}{}%{reset}: {}").format(outcome, count))
+
+
+def _backfill_order(transaction):
+    biz_content = json.loads(transaction.data["biz_content"])
+    order = ICBCOrder.find_order(
+        biz_content.get("mer_id"), biz_content.get("out_trade_no")
+    )
+    if transaction.status == TransactionStatus.successful:
+        # a payment reported by ICBC, which always comes after its order
+        if order is None or order.is_paid:
+            return "skipped"
+        order.update_status("0", paid_transaction=transaction)
+        return "linked"
+    if order is not None:
+        return "skipped"
+    # the placeholder recorded when the payment request was built
+    channel = transaction.data.get("channel") or (
+        "domestic" if "icbc_flag" in biz_content else "foreign"
+    )
+    db.session.add(
+        ICBCOrder(
+            registration_id=transaction.registration_id,
+            transaction=transaction,
+            mer_id=biz_content["mer_id"],
+            out_trade_no=biz_content["out_trade_no"],
+            channel=channel,
+            amount=transaction.amount,
+            currency=transaction.currency,
+            created_dt=transaction.timestamp,
+            expires_dt=transaction.timestamp + timedelta(seconds=ORDER_LIFETIME),
+        )
+    )
+    db.session.flush()
+    return "created"
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from indico_payment_icbc import metrics, tracing
+from indico_payment_icbc.ids import generate_id
+from indico_payment_icbc.log import log_event
+from indico_payment_icbc.util import RsaUtil, get_aes_codec, get_signer
+
+if TYPE_CHECKING:
+    import requests
+
+#: default base URL of the ICBC open API gateway
+DEFAULT_GATEWAY_URL = "https://gw.open.icbc.com.cn"
+#: (connect, read) timeouts in seconds for requests to the gateway
+DEFAULT_TIMEOUT = (3.05, 15)
+#: number of retries after a failed request to the gateway
+DEFAULT_RETRIES = 2
+#: base delay in seconds between retries, doubled on each attempt
+DEFAULT_BACKOFF = 0.3
+#: number of pooled keep-alive connections to the gateway per process
+POOL_SIZE = 10
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class ICBCGatewayError(Exception):
+    """A request to the ICBC gateway failed."""
+
+
+def get_session() -> "requests.Session":
+    """Get the HTTP session shared by all gateway clients of this process.
+
+    The session keeps a pool of keep-alive connections.  A new one is created
+    after a fork so worker processes never share sockets.  `requests` is only
+    imported here, so processes which never call the gateway do not load it.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session, _session_pid = session, pid
+    return _session
+
+
+class ICBCGatewayClient:
+    """Client for the ICBC open API gateway of a merchant.
+
+    It takes care of building, encrypting and signing the requests and of
+    decrypting the responses.  Failed requests are retried with jittered
+    exponential backoff.
+    """
+
+    ORDER_QUERY_PATH = "/api/cardbusiness/aggregatepay/b2c/online/orderqry/V1"
+
+    def __init__(
+        self,
+        *,
+        app_id,
+        mer_id,
+        mer_prtcl_no,
+        sign_key,
+        encrypt_key,
+        base_url=DEFAULT_GATEWAY_URL,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        logger=None,
+    ):
+        self.app_id = app_id
+        self.mer_id = mer_id
+        self.mer_prtcl_no = mer_prtcl_no
+        self.signer = get_signer(sign_key)
+        self.aes_codec = get_aes_codec(encrypt_key)
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.logger = logger
+
+    @classmethod
+    def from_settings(cls, settings, event_settings, **kwargs):
+        """Create a client from the plugin and event settings."""
+        return cls(
+            app_id=event_settings["app_id"],
+            mer_id=event_settings["mer_id"],
+            mer_prtcl_no=event_settings["mer_prtcl_no"],
+            sign_key=event_settings["sign_key"],
+            encrypt_key=event_settings["encrypt_key"],
+            base_url=settings.get("gateway_url") or DEFAULT_GATEWAY_URL,
+            **kwargs,
+        )
+
+    def query_order(self, out_trade_no):
+        """Query the status of an order.
+
+        :return: the JSON response of the gateway, with the decrypted
+                 ``response_biz_content`` added as ``biz_content``.
+        """
+        biz_content = {}
+        biz_content["mer_id"] = self.mer_id
+        biz_content["out_trade_no"] = out_trade_no
+        biz_content["deal_flag"] = "0"
+        biz_content["icbc_app_id"] = self.app_id
+        biz_content["mer_prtcl_no"] = self.mer_prtcl_no
+        return self.call(self.ORDER_QUERY_PATH, biz_content)
+
+    def call(self, path, biz_content):
+        """Send an encrypted and signed request to an API of the gateway."""
+        with tracing.span("icbc.gateway_call", api=path):
+            with tracing.span("icbc.build_request"):
+                data = self._build_request(path, biz_content)
+            response_json = self._post(path, data)
+
+            try:
+                response_biz_content = response_json["response_biz_content"]
+            except KeyError:
+                raise ICBCGatewayError(
+                    f"Unexpected response from ICBC: {response_json}"
+                )
+            with tracing.span("icbc.decrypt_response"):
+                response_json["biz_content"] = self.aes_codec.decrypt(
+                    response_biz_content
+                )
+
+        if self.logger is not None:
+            log_event(
+                self.logger,
+                logging.DEBUG,
+                "icbc_gateway_response",
+                api=path,
+                request=data,
+                biz_content=biz_content,
+                response=response_json,
+            )
+        return response_json
+
+    def _build_request(self, path, biz_content):
+        # -------- get current time --------
+        current_time = time.time()
+
+        # -------- common fields --------
+        data = {}
+        data["app_id"] = self.app_id
+        data["msg_id"] = generate_id()
+        data["charset"] = "UTF-8"
+        data["encrypt_type"] = "AES"
+        data["sign_type"] = "RSA2"
+        data["timestamp"] = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(current_time)
+        )
+        data["biz_content"] = self.aes_codec.encrypt(
+            json.dumps(biz_content, separators=(",", ":"))
+        )
+
+        # -------- signing --------
+        encrypt_str = RsaUtil.encrypt_str(path, data)
+        data["sign"] = self.signer.create_sign(encrypt_str)
+        return data
+
+    def _post(self, path, data):
+        import requests
+
+        url = self.base_url + path
+        session = get_session()
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                with tracing.span("icbc.gateway_request", attempt=attempt):
+                    response = session.post(url, data=data, timeout=self.timeout)
+                outcome = str(response.status_code)
+                if response.status_code < 500 and response.status_code != 429:
+                    response.raise_for_status()
+                    response.encoding = "utf-8"
+                    return response.json()
+                error = ICBCGatewayError(
+                    f"ICBC gateway returned HTTP {response.status_code}"
+                )
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                outcome = type(exc).__name__
+                error = ICBCGatewayError(f"Could not reach the ICBC gateway: {exc}")
+            except (requests.RequestException, ValueError) as exc:
+                raise ICBCGatewayError(f"Invalid response from ICBC: {exc}") from exc
+            finally:
+                metrics.observe(
+                    "icbc_gateway_request_seconds",
+                    time.perf_counter() - start,
+                    api=path,
+                    outcome=outcome,
+                )
+
+            if attempt >= self.retries:
+                raise error
+            delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+            if self.logger is not None:
+                self.logger.warning(
+                    "%s, retrying in %.2fs (attempt %d/%d)",
+                    error,
+                    delay,
+                    attempt + 1,
+                    self.retries,
+                )
+            time.sleep(delay)
+            attempt += 1
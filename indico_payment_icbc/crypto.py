@@ -0,0 +1,260 @@
+import os
+from abc import ABC, abstractmethod
+
+#: environment variable selecting the library doing the RSA and AES operations
+CRYPTO_BACKEND_ENV_VAR = "INDICO_ICBC_CRYPTO_BACKEND"
+#: the backend used unless another one is configured
+DEFAULT_CRYPTO_BACKEND = "pycryptodome"
+
+_backend = None
+_logger = None
+
+
+class CryptoBackend(ABC):
+    """Base class of the libraries doing the RSA and AES operations.
+
+    Keys and ciphers are opaque objects of the library; they are created once
+    by :class:`~indico_payment_icbc.util.RsaUtil` and
+    :class:`~indico_payment_icbc.util.AesCodec` and can be shared between
+    threads.  All backends must produce the same signatures and ciphertexts,
+    which PKCS#1 v1.5 and CBC with a fixed IV make deterministic.
+    """
+
+    #: the name the backend is selected by in ``INDICO_ICBC_CRYPTO_BACKEND``
+    name = None
+
+    @abstractmethod
+    def load_key(self, pem, passphrase=None):
+        """Load a PEM private or public RSA key.
+
+        :raise ValueError: if the key cannot be parsed
+        """
+
+    @abstractmethod
+    def public_key(self, private_key):
+        """Get the public part of a key loaded by :meth:`load_key`."""
+
+    @abstractmethod
+    def sign_sha256(self, private_key, data):
+        """Sign bytes with PKCS#1 v1.5 and SHA256 (``RSA2``)."""
+
+    @abstractmethod
+    def verify_sha1(self, public_key, data, signature):
+        """Check a PKCS#1 v1.5 signature made with SHA1 (``RSA``).
+
+        :return: whether the signature is valid
+        """
+
+    @abstractmethod
+    def aes_cbc(self, key, iv):
+        """Create an AES-CBC cipher with PKCS7 padding.
+
+        The returned object has ``encrypt(data)`` and ``decrypt(data)``
+        methods taking and returning bytes; ``decrypt`` raises
+        :exc:`ValueError` if the data or its padding is invalid.
+        """
+
+
+class PyCryptodomeBackend(CryptoBackend):
+    """Sign and encrypt with `PyCryptodome`."""
+
+    name = "pycryptodome"
+
+    def __init__(self):
+        from Crypto.Cipher import AES
+        from Crypto.Hash import SHA1, SHA256
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import pkcs1_15
+
+        self._aes = AES
+        self._sha1 = SHA1
+        self._sha256 = SHA256
+        self._rsa = RSA
+        self._pkcs1_15 = pkcs1_15
+
+    def load_key(self, pem, passphrase=None):
+        return self._rsa.import_key(pem, passphrase=passphrase)
+
+    def public_key(self, private_key):
+        return private_key.publickey()
+
+    def sign_sha256(self, private_key, data):
+        return self._pkcs1_15.new(private_key).sign(self._sha256.new(data))
+
+    def verify_sha1(self, public_key, data, signature):
+        try:
+            self._pkcs1_15.new(public_key).verify(self._sha1.new(data), signature)
+        except (ValueError, TypeError):
+            return False
+        return True
+
+    def aes_cbc(self, key, iv):
+        return _PyCryptodomeAesCbc(self._aes, key, iv)
+
+
+class _PyCryptodomeAesCbc:
+    __slots__ = ("_aes", "_key", "_iv", "_pad", "_unpad")
+
+    def __init__(self, aes, key, iv):
+        from Crypto.Util.Padding import pad, unpad
+
+        # fail early on invalid keys, like the OpenSSL backend does
+        aes.new(key, aes.MODE_CBC, iv=iv)
+        self._aes = aes
+        self._key = key
+        self._iv = iv
+        self._pad = pad
+        self._unpad = unpad
+
+    def _new_cipher(self):
+        # CBC ciphers are stateful, so each payload needs a fresh one
+        return self._aes.new(self._key, self._aes.MODE_CBC, iv=self._iv)
+
+    def encrypt(self, data):
+        return self._new_cipher().encrypt(self._pad(data, self._aes.block_size))
+
+    def decrypt(self, data):
+        return self._unpad(self._new_cipher().decrypt(data), self._aes.block_size)
+
+
+class CryptographyBackend(CryptoBackend):
+    """Sign and encrypt with `cryptography`, i.e. with OpenSSL.
+
+    Signing with the merchant key is several times faster than with
+    PyCryptodome, which matters since every payment form is signed.
+    """
+
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+
+        self._invalid_signature = InvalidSignature
+        self._serialization = serialization
+        self._padding = PKCS1v15()
+        self._sha1 = hashes.SHA1()
+        self._sha256 = hashes.SHA256()
+
+    def load_key(self, pem, passphrase=None):
+        if isinstance(pem, str):
+            pem = pem.encode("ascii")
+        if isinstance(passphrase, str):
+            passphrase = passphrase.encode("utf-8")
+        if b"PUBLIC KEY-----" in pem:
+            return self._serialization.load_pem_public_key(pem)
+        try:
+            return self._serialization.load_pem_private_key(pem, passphrase)
+        except TypeError as exc:
+            # missing or unexpected passphrase, which PyCryptodome reports as
+            # an invalid key
+            raise ValueError(str(exc)) from exc
+
+    def public_key(self, private_key):
+        return private_key.public_key()
+
+    def sign_sha256(self, private_key, data):
+        return private_key.sign(data, self._padding, self._sha256)
+
+    def verify_sha1(self, public_key, data, signature):
+        try:
+            public_key.verify(signature, data, self._padding, self._sha1)
+        except self._invalid_signature:
+            return False
+        return True
+
+    def aes_cbc(self, key, iv):
+        return _CryptographyAesCbc(key, iv)
+
+
+class _CryptographyAesCbc:
+    __slots__ = ("_cipher", "_padding")
+
+    def __init__(self, key, iv):
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        # the cipher only holds the key; every payload gets its own context
+        self._cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
+        self._padding = padding.PKCS7(algorithms.AES.block_size)
+
+    def encrypt(self, data):
+        padder = self._padding.padder()
+        encryptor = self._cipher.encryptor()
+        return (
+            encryptor.update(padder.update(data) + padder.finalize())
+            + encryptor.finalize()
+        )
+
+    def decrypt(self, data):
+        decryptor = self._cipher.decryptor()
+        unpadder = self._padding.unpadder()
+        padded = decryptor.update(data) + decryptor.finalize()
+        return unpadder.update(padded) + unpadder.finalize()
+
+
+#: the available backends by name
+BACKENDS = {
+    PyCryptodomeBackend.name: PyCryptodomeBackend,
+    CryptographyBackend.name: CryptographyBackend,
+}
+
+
+def get_backend():
+    """Get the crypto backend of this process.
+
+    It is loaded from the environment the first time it is needed, so its
+    library is only imported by processes which sign or encrypt something,
+    and processes which never loaded the plugin (e.g. the workers of an
+    audit) use the same backend as the ones which did.
+    """
+    if _backend is None:
+        _load_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """Set the crypto backend by name or as a :class:`CryptoBackend`.
+
+    With ``None`` it is loaded from the environment again when it is needed
+    next.
+
+    Keys and ciphers which were already loaded keep using their backend, so
+    this should be done before the plugin handles any payment.
+    """
+    global _backend
+    if isinstance(backend, str):
+        try:
+            backend = BACKENDS[backend]()
+        except KeyError:
+            raise ValueError(f"Unknown crypto backend: {backend}") from None
+    _backend = backend
+
+
+def configure_crypto_backend(logger=None):
+    """Set the logger warning about an unusable crypto backend.
+
+    This does not load the backend: :func:`get_backend` loads the one named
+    in ``INDICO_ICBC_CRYPTO_BACKEND`` when it is first used, and falls back
+    to PyCryptodome if that name is unknown or its library is not
+    installed, which is then logged to ``logger``.  A backend set with
+    :func:`set_backend` is used as it is.
+    """
+    global _logger
+    _logger = logger
+
+
+def _load_backend():
+    name = os.environ.get(CRYPTO_BACKEND_ENV_VAR) or DEFAULT_CRYPTO_BACKEND
+    try:
+        set_backend(name)
+    except (ImportError, ValueError) as exc:
+        if _logger is not None:
+            _logger.warning(
+                "Cannot use the %s crypto backend (%s), using %s",
+                name,
+                exc,
+                DEFAULT_CRYPTO_BACKEND,
+            )
+        set_backend(DEFAULT_CRYPTO_BACKEND)
@@ -0,0 +1,223 @@
+import csv
+import io
+import json
+from itertools import batched
+
+from flask_pluginengine import current_plugin
+from indico.modules.events.models.events import Event
+from indico.modules.events.payment.models.transactions import PaymentTransaction
+from indico.modules.events.registration.models.registrations import Registration
+
+from indico_payment_icbc.util import get_aes_codec
+
+#: number of rows fetched from the database cursor at once
+EXPORT_BATCH_SIZE = 1000
+
+#: the columns of an export, in order
+EXPORT_COLUMNS = (
+    "transaction_id",
+    "timestamp",
+    "status",
+    "amount",
+    "currency",
+    "event_id",
+    "registration_id",
+    "registration_friendly_id",
+    "email",
+    "first_name",
+    "last_name",
+    "channel",
+    "mer_id",
+    "out_trade_no",
+    "order_id",
+    "total_amt",
+    "pay_status",
+    "pay_time",
+)
+
+#: the columns taken from the (decrypted) biz_content of a transaction
+ORDER_COLUMNS = ("mer_id", "out_trade_no", "order_id", "total_amt", "pay_time")
+
+#: the free-text columns, which are escaped in CSV exports
+TEXT_COLUMNS = frozenset(("email", "first_name", "last_name", *ORDER_COLUMNS))
+#: the characters which make spreadsheet applications run a cell as a formula
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def query_transactions(event_id=None, start_dt=None, end_dt=None, statuses=None):
+    """Query the ICBC transactions to export.
+
+    Only the columns needed for the export are loaded, so no ORM objects
+    are built for the rows.
+    """
+    query = (
+        PaymentTransaction.query.join(
+            Registration, PaymentTransaction.registration_id == Registration.id
+        )
+        .filter(PaymentTransaction.provider == "icbc")
+        .order_by(PaymentTransaction.id)
+        .with_entities(
+            PaymentTransaction.id,
+            PaymentTransaction.timestamp,
+            PaymentTransaction.status,
+            PaymentTransaction.amount,
+            PaymentTransaction.currency,
+            PaymentTransaction.data,
+            Registration.event_id,
+            Registration.id,
+            Registration.friendly_id,
+            Registration.email,
+            Registration.first_name,
+            Registration.last_name,
+        )
+    )
+    if event_id is not None:
+        query = query.filter(Registration.event_id == event_id)
+    if start_dt is not None:
+        query = query.filter(PaymentTransaction.timestamp >= start_dt)
+    if end_dt is not None:
+        query = query.filter(PaymentTransaction.timestamp < end_dt)
+    if statuses:
+        query = query.filter(PaymentTransaction.status.in_(statuses))
+    return query
+
+
+def iter_export_rows(query, batch_size=EXPORT_BATCH_SIZE):
+    """Stream the rows of an export.
+
+    The rows are fetched using a server-side cursor, and the responses
+    which only contain the encrypted biz_content of an order are decrypted
+    batch by batch, so the memory used does not depend on the number of
+    transactions.  The order columns of a row are left empty if its
+    biz_content cannot be decrypted or parsed.
+
+    :return: an iterator of dicts with the :data:`EXPORT_COLUMNS`
+    """
+    codecs = {}
+    for batch in batched(query.yield_per(batch_size), batch_size):
+        rows = [_make_row(record) for record in batch]
+        encrypted = {}
+        for row, record in zip(rows, batch):
+            data = record.data or {}
+            if "biz_content" not in data and data.get("response_biz_content"):
+                encrypted.setdefault(row["event_id"], []).append(
+                    (row, data["response_biz_content"])
+                )
+        for event_id, items in encrypted.items():
+            if event_id not in codecs:
+                codecs[event_id] = _get_event_codec(event_id)
+            codec = codecs[event_id]
+            if codec is None:
+                continue
+            for row, payload in items:
+                try:
+                    biz_content = json.loads(codec.decrypt(payload))
+                except ValueError as exc:
+                    # one bad payload must not cut the download short
+                    current_plugin.logger.warning(
+                        "Cannot decrypt the biz_content of ICBC transaction %s: %s",
+                        row["transaction_id"],
+                        exc,
+                    )
+                    continue
+                _add_order_details(row, biz_content)
+        yield from rows
+
+
+def _make_row(record):
+    (
+        transaction_id,
+        timestamp,
+        status,
+        amount,
+        currency,
+        data,
+        event_id,
+        registration_id,
+        friendly_id,
+        email,
+        first_name,
+        last_name,
+    ) = record
+    row = dict.fromkeys(EXPORT_COLUMNS)
+    row.update(
+        transaction_id=transaction_id,
+        timestamp=timestamp.isoformat(),
+        status=status.name,
+        amount=str(amount),
+        currency=currency,
+        event_id=event_id,
+        registration_id=registration_id,
+        registration_friendly_id=friendly_id,
+        email=email,
+        first_name=first_name,
+        last_name=last_name,
+    )
+    data = data or {}
+    row["channel"] = data.get("channel")
+    if "biz_content" in data:
+        try:
+            biz_content = json.loads(data["biz_content"])
+        except ValueError:
+            pass
+        else:
+            _add_order_details(row, biz_content)
+    return row
+
+
+def _add_order_details(row, biz_content):
+    for column in ORDER_COLUMNS:
+        if column in biz_content:
+            row[column] = biz_content[column]
+    if "pay_status" in biz_content or "return_code" in biz_content:
+        row["pay_status"] = biz_content.get("pay_status") or biz_content["return_code"]
+    if row["channel"] is None and "icbc_flag" in biz_content:
+        row["channel"] = "domestic"
+
+
+def _get_event_codec(event_id):
+    event = Event.get(event_id)
+    encrypt_key = current_plugin.event_settings.get(event, "encrypt_key")
+    return get_aes_codec(encrypt_key) if encrypt_key else None
+
+
+def iter_csv(rows):
+    """Stream export rows as CSV, one chunk per row."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(
+            {
+                key: _escape_csv_cell(value) if key in TEXT_COLUMNS else value
+                for key, value in row.items()
+            }
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _escape_csv_cell(value):
+    # names and emails are entered by the registrants, so they must not be
+    # able to inject formulas (https://owasp.org/www-community/attacks/CSV_Injection);
+    # quoting the cell does not prevent that, but a leading quote does; it is
+    # only added to the TEXT_COLUMNS, so e.g. negative amounts stay numbers
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return f"'{value}"
+    return value
+
+
+def iter_jsonl(rows):
+    """Stream export rows as JSON Lines."""
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+#: the supported export formats, mapping to the writer and the MIME type
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv"),
+    "jsonl": (iter_jsonl, "application/x-ndjson"),
+}
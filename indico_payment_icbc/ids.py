@@ -0,0 +1,105 @@
+import os
+import socket
+import threading
+import time
+import zlib
+
+#: 2024-01-01 00:00:00 UTC in milliseconds, the start of the ID timestamps
+EPOCH_MS = 1704067200000
+#: environment variable overriding the node ID derived from the host name
+NODE_ID_ENV_VAR = "INDICO_ICBC_NODE_ID"
+
+TIMESTAMP_BITS = 42  # ~139 years
+NODE_BITS = 16
+PROCESS_BITS = 22  # covers the largest possible Linux pid_max
+SEQUENCE_BITS = 12
+
+#: length of the decimal IDs (28), short enough for ICBC's ``msg_id`` and
+#: ``out_trade_no`` fields
+ID_LENGTH = len(str(1 << (TIMESTAMP_BITS + NODE_BITS + PROCESS_BITS + SEQUENCE_BITS)))
+
+_MAX_NODE = (1 << NODE_BITS) - 1
+_MAX_PROCESS = (1 << PROCESS_BITS) - 1
+_MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def get_node_id():
+    """Get the ID of this machine.
+
+    It is taken from the ``INDICO_ICBC_NODE_ID`` environment variable, so
+    it can be made unique explicitly, or derived from the host name.
+    """
+    value = os.environ.get(NODE_ID_ENV_VAR)
+    if value:
+        node_id = int(value)
+        if not 0 <= node_id <= _MAX_NODE:
+            raise ValueError(f"{NODE_ID_ENV_VAR} must be between 0 and {_MAX_NODE}")
+        return node_id
+    return zlib.crc32(socket.gethostname().encode()) & _MAX_NODE
+
+
+class IDGenerator:
+    """Snowflake-style generator of unique numeric IDs.
+
+    An ID is made of a millisecond timestamp, the node ID, the process ID
+    and a per-millisecond sequence number, so IDs generated by different
+    processes and machines never collide without any coordination, and the
+    ones of a single process are strictly increasing.  When the sequence of
+    a millisecond is exhausted or the clock goes backwards the timestamp is
+    advanced logically instead of waiting for the clock.
+    """
+
+    def __init__(self, node_id=None, clock=time.time):
+        self.node_id = get_node_id() if node_id is None else node_id
+        if not 0 <= self.node_id <= _MAX_NODE:
+            raise ValueError(f"Node ID must be between 0 and {_MAX_NODE}")
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_timestamp = -1
+        self._sequence = 0
+
+    def _now(self):
+        return int(self._clock() * 1000) - EPOCH_MS
+
+    def next_int(self):
+        with self._lock:
+            pid = os.getpid()
+            if pid != self._pid:
+                # a forked child inherits the state but has its own pid
+                self._pid = pid
+                self._last_timestamp = -1
+            timestamp = self._now()
+            if timestamp > self._last_timestamp:
+                self._sequence = 0
+            else:
+                timestamp = self._last_timestamp
+                self._sequence = (self._sequence + 1) & _MAX_SEQUENCE
+                if self._sequence == 0:
+                    timestamp += 1
+            self._last_timestamp = timestamp
+            return (
+                (
+                    (timestamp << NODE_BITS | self.node_id) << PROCESS_BITS
+                    | pid & _MAX_PROCESS
+                )
+                << SEQUENCE_BITS
+            ) | self._sequence
+
+    def next_id(self):
+        """Get a new ID as a fixed-length string of digits."""
+        return str(self.next_int()).zfill(ID_LENGTH)
+
+
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def generate_id():
+    """Generate a unique ID for an ICBC order or message."""
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = IDGenerator()
+    return _generator.next_id()
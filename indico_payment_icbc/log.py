@@ -0,0 +1,88 @@
+import json
+import random
+from collections.abc import Mapping
+
+#: fields whose values are never written to the logs
+REDACTED_FIELDS = frozenset(
+    {"sign", "sign_key", "encrypt_key", "private_key", "password", "token"}
+)
+#: longer values, e.g. encrypted payloads, are truncated
+MAX_VALUE_LENGTH = 256
+REDACTED = "[redacted]"
+
+
+def redact(value):
+    """Get a copy of some data which is safe to log.
+
+    Signatures and keys are replaced in nested mappings and sequences and
+    overly long strings are truncated.
+    """
+    if isinstance(value, Mapping):
+        return {
+            key: REDACTED if key in REDACTED_FIELDS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str) and len(value) > MAX_VALUE_LENGTH:
+        return f"{value[:MAX_VALUE_LENGTH]}...[{len(value)} chars]"
+    return value
+
+
+class LogFields:
+    """The fields of a structured log record.
+
+    Redacting and serializing them only happens once a handler actually
+    formats the record.  Handlers producing structured output can use the
+    ``icbc_fields`` attribute of the record and call :meth:`as_dict`.
+    """
+
+    __slots__ = ("event", "fields")
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def as_dict(self):
+        return {"event": self.event, **redact(self.fields)}
+
+    def __str__(self):
+        return json.dumps(redact(self.fields), default=str, ensure_ascii=False)
+
+
+def log_event(logger, level, event, *, sample=1, **fields):
+    """Write a structured log record for an event.
+
+    Nothing is built unless the logger is enabled for ``level``, and
+    frequent events can be sampled.
+
+    :param logger: the logger to write to
+    :param level: the log level, e.g. ``logging.DEBUG``
+    :param event: a short name of the event, used as the message
+    :param sample: the share of the events which are logged
+    :param fields: the data of the event, redacted before writing it
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample < 1 and random.random() >= sample:
+        return
+    record_fields = LogFields(event, fields)
+    logger.log(
+        level,
+        "%s %s",
+        event,
+        record_fields,
+        extra={"icbc_event": event, "icbc_fields": record_fields},
+    )
+
+
+class Redacted:
+    """Log argument redacting some data only when it is formatted."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(redact(self.value))
@@ -0,0 +1,211 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from functools import wraps
+
+#: environment variable enabling the collection of metrics in a process
+METRICS_ENV_VAR = "INDICO_ICBC_METRICS"
+
+#: buckets in seconds for the signing and encryption operations
+CRYPTO_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+#: buckets in seconds for gateway requests and full handlers
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+#: the histograms, as ``name: (documentation, label names, buckets)``
+HISTOGRAMS = {
+    "icbc_crypto_seconds": (
+        "Time spent signing, verifying, encrypting and decrypting ICBC messages",
+        ("operation",),
+        CRYPTO_BUCKETS,
+    ),
+    "icbc_gateway_request_seconds": (
+        "Time spent in HTTP requests to the ICBC gateway, including failed attempts",
+        ("api", "outcome"),
+        REQUEST_BUCKETS,
+    ),
+    "icbc_handler_seconds": (
+        "Time spent in the ICBC sign, notify and success handlers",
+        ("handler",),
+        REQUEST_BUCKETS,
+    ),
+}
+#: the counters, as ``name: (documentation, label names)``
+COUNTERS = {
+    "icbc_signature_failures_total": (
+        "ICBC messages rejected because of an invalid signature",
+        ("handler",),
+    ),
+    "icbc_duplicate_payments_total": (
+        "ICBC payment results which had been registered already",
+        (),
+    ),
+    "icbc_amount_mismatches_total": (
+        "ICBC payments whose amount did not match the registration fee",
+        (),
+    ),
+    "icbc_payment_status_total": (
+        "ICBC payment results by payment status code",
+        ("status",),
+    ),
+}
+
+_exporter = None
+_null_timer = nullcontext()
+
+
+class MetricsExporter(ABC):
+    """Base class of the backends the metrics are reported to.
+
+    Subclasses can send them to any monitoring system; only
+    :meth:`observe` and :meth:`inc` are required.
+    """
+
+    @abstractmethod
+    def observe(self, name, value, labels):
+        """Record a value, usually a duration in seconds, of a histogram."""
+
+    @abstractmethod
+    def inc(self, name, labels, amount=1):
+        """Increment a counter."""
+
+    def render(self):
+        """Render the metrics for a scrape.
+
+        :return: a ``(body, content_type)`` tuple or ``None`` if the
+                 exporter cannot be scraped.
+        """
+        return None
+
+
+class PrometheusExporter(MetricsExporter):
+    """Export the metrics with `prometheus_client`.
+
+    When ``PROMETHEUS_MULTIPROC_DIR`` is set the metrics of all worker
+    processes are collected from there for a scrape, otherwise only the ones
+    of the process handling the scrape are rendered.
+    """
+
+    def __init__(self, registry=None):
+        import prometheus_client
+
+        self._prometheus = prometheus_client
+        self.registry = registry or prometheus_client.REGISTRY
+        self._histograms = {
+            name: prometheus_client.Histogram(
+                name, doc, labels, buckets=buckets, registry=self.registry
+            )
+            for name, (doc, labels, buckets) in HISTOGRAMS.items()
+        }
+        self._counters = {
+            name: prometheus_client.Counter(name, doc, labels, registry=self.registry)
+            for name, (doc, labels) in COUNTERS.items()
+        }
+
+    def observe(self, name, value, labels):
+        metric = self._histograms[name]
+        (metric.labels(**labels) if labels else metric).observe(value)
+
+    def inc(self, name, labels, amount=1):
+        metric = self._counters[name]
+        (metric.labels(**labels) if labels else metric).inc(amount)
+
+    def render(self):
+        prometheus_client = self._prometheus
+        registry = self.registry
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            from prometheus_client import multiprocess
+
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return (
+            prometheus_client.generate_latest(registry),
+            prometheus_client.CONTENT_TYPE_LATEST,
+        )
+
+
+def get_exporter():
+    """Get the exporter of this process, ``None`` if metrics are off."""
+    return _exporter
+
+
+def set_exporter(exporter):
+    """Set the exporter metrics are reported to, or ``None`` to disable them."""
+    global _exporter
+    _exporter = exporter
+
+
+def configure_metrics(logger=None):
+    """Enable the Prometheus exporter if ``INDICO_ICBC_METRICS`` is set.
+
+    Nothing is collected otherwise, and an exporter set explicitly with
+    :func:`set_exporter` is kept.
+    """
+    if _exporter is not None or os.environ.get(METRICS_ENV_VAR, "") in ("", "0"):
+        return
+    try:
+        set_exporter(PrometheusExporter())
+    except ImportError:
+        if logger is not None:
+            logger.warning(
+                "%s is set but prometheus_client is not installed", METRICS_ENV_VAR
+            )
+
+
+def observe(name, value, **labels):
+    exporter = _exporter
+    if exporter is not None:
+        exporter.observe(name, value, labels)
+
+
+def inc(name, amount=1, **labels):
+    exporter = _exporter
+    if exporter is not None:
+        exporter.inc(name, labels, amount)
+
+
+class _Timer:
+    __slots__ = ("exporter", "name", "labels", "start")
+
+    def __init__(self, exporter, name, labels):
+        self.exporter = exporter
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.exporter.observe(self.name, time.perf_counter() - self.start, self.labels)
+
+
+def timer(name, **labels):
+    """Time a block of code into a histogram.
+
+    When metrics are off a shared no-op context manager is returned.
+    """
+    exporter = _exporter
+    if exporter is None:
+        return _null_timer
+    return _Timer(exporter, name, labels)
+
+
+def timed(name, **labels):
+    """Decorator timing every call of a function into a histogram."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            exporter = _exporter
+            if exporter is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                exporter.observe(name, time.perf_counter() - start, labels)
+
+        return wrapper
+
+    return decorator
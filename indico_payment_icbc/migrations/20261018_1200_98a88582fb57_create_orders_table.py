@@ -0,0 +1,50 @@
+"""Create orders table
+
+Revision ID: 98a88582fb57
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.sql.ddl import CreateSchema, DropSchema
+
+from indico.core.db.sqlalchemy import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '98a88582fb57'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateSchema('plugin_payment_icbc'))
+    op.create_table(
+        'orders',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('registration_id', sa.Integer(), nullable=False, index=True),
+        sa.Column('transaction_id', sa.Integer(), nullable=True, index=True),
+        sa.Column('paid_transaction_id', sa.Integer(), nullable=True, index=True),
+        sa.Column('mer_id', sa.String(), nullable=False),
+        sa.Column('out_trade_no', sa.String(), nullable=False),
+        sa.Column('channel', sa.String(), nullable=False),
+        sa.Column('amount', sa.Numeric(11, 2), nullable=False),
+        sa.Column('currency', sa.String(), nullable=False),
+        sa.Column('created_dt', UTCDateTime(), nullable=False),
+        sa.Column('expires_dt', UTCDateTime(), nullable=False),
+        sa.Column('status', sa.String(), nullable=True),
+        sa.Column('status_dt', UTCDateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['registration_id'], ['event_registration.registrations.id']),
+        sa.ForeignKeyConstraint(['transaction_id'], ['events.payment_transactions.id']),
+        sa.ForeignKeyConstraint(['paid_transaction_id'], ['events.payment_transactions.id']),
+        sa.PrimaryKeyConstraint('id'),
+        schema='plugin_payment_icbc'
+    )
+    op.create_index(None, 'orders', ['mer_id', 'out_trade_no'], unique=True, schema='plugin_payment_icbc')
+
+
+def downgrade():
+    op.drop_table('orders', schema='plugin_payment_icbc')
+    op.execute(DropSchema('plugin_payment_icbc'))
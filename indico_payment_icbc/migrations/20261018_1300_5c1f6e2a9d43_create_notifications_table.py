@@ -0,0 +1,44 @@
+"""Create notifications table
+
+Revision ID: 5c1f6e2a9d43
+Revises: 98a88582fb57
+Create Date: 2026-10-18 13:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+from indico.core.db.sqlalchemy import PyIntEnum, UTCDateTime
+
+from indico_payment_icbc.models.notifications import ICBCNotificationState
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f6e2a9d43'
+down_revision = '98a88582fb57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'notifications',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('registration_id', sa.Integer(), nullable=False, index=True),
+        sa.Column('received_dt', UTCDateTime(), nullable=False),
+        sa.Column('data', postgresql.JSONB(), nullable=False),
+        sa.Column('state', PyIntEnum(ICBCNotificationState), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('processed_dt', UTCDateTime(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['registration_id'], ['event_registration.registrations.id']),
+        sa.PrimaryKeyConstraint('id'),
+        schema='plugin_payment_icbc'
+    )
+    op.create_index(None, 'notifications', ['state'], schema='plugin_payment_icbc',
+                    postgresql_where=sa.text('state != 2'))
+
+
+def downgrade():
+    op.drop_table('notifications', schema='plugin_payment_icbc')
@@ -0,0 +1,72 @@
+from indico.core.db import db
+from indico.core.db.sqlalchemy import PyIntEnum
+from indico.core.db.sqlalchemy.custom.utcdatetime import UTCDateTime
+from indico.util.date_time import now_utc
+from indico.util.enum import IndicoEnum
+from indico.util.string import format_repr
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+class ICBCNotificationState(int, IndicoEnum):
+    pending = 1
+    processed = 2
+    failed = 3
+
+
+class ICBCNotification(db.Model):
+    """A notify callback received from ICBC.
+
+    The payload is stored as soon as its signature has been verified, so it
+    can be processed after the gateway got its response and processed again
+    if that failed.
+    """
+
+    __tablename__ = "notifications"
+    __table_args__ = (
+        db.Index(
+            None,
+            "state",
+            postgresql_where=db.text(
+                f"state != {ICBCNotificationState.processed.value}"
+            ),
+        ),
+        {"schema": "plugin_payment_icbc"},
+    )
+
+    #: The ID of the notification
+    id = db.Column(db.Integer, primary_key=True)
+    #: The ID of the registration the notification is for
+    registration_id = db.Column(
+        db.Integer,
+        db.ForeignKey("event_registration.registrations.id"),
+        index=True,
+        nullable=False,
+    )
+    #: The date/time the notification was received
+    received_dt = db.Column(UTCDateTime, nullable=False, default=now_utc)
+    #: The form data posted by ICBC
+    data = db.Column(JSONB, nullable=False)
+    #: The processing state of the notification
+    state = db.Column(
+        PyIntEnum(ICBCNotificationState),
+        nullable=False,
+        default=ICBCNotificationState.pending,
+    )
+    #: The number of times processing the notification was attempted
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    #: The date/time the notification was last processed
+    processed_dt = db.Column(UTCDateTime, nullable=True)
+    #: The error of the last failed processing attempt
+    error = db.Column(db.Text, nullable=True)
+
+    #: The registration the notification is for
+    registration = db.relationship(
+        "Registration",
+        lazy=True,
+        backref=db.backref(
+            "icbc_notifications", cascade="all, delete-orphan", lazy="dynamic"
+        ),
+    )
+
+    def __repr__(self):
+        return format_repr(self, "id", "registration_id", "state")
@@ -0,0 +1,108 @@
+import json
+
+from indico.core.db import db
+from indico.core.db.sqlalchemy.custom.utcdatetime import UTCDateTime
+from indico.util.date_time import now_utc
+from indico.util.string import format_repr
+
+
+class ICBCOrder(db.Model):
+    """An order sent to ICBC to pay for a registration."""
+
+    __tablename__ = "orders"
+    __table_args__ = (
+        db.Index(None, "mer_id", "out_trade_no", unique=True),
+        {"schema": "plugin_payment_icbc"},
+    )
+
+    #: The ID of the order
+    id = db.Column(db.Integer, primary_key=True)
+    #: The ID of the registration the order is for
+    registration_id = db.Column(
+        db.Integer,
+        db.ForeignKey("event_registration.registrations.id"),
+        index=True,
+        nullable=False,
+    )
+    #: The ID of the transaction which recorded the order
+    transaction_id = db.Column(
+        db.Integer,
+        db.ForeignKey("events.payment_transactions.id"),
+        index=True,
+        nullable=True,
+    )
+    #: The ID of the transaction which registered the payment of the order
+    paid_transaction_id = db.Column(
+        db.Integer,
+        db.ForeignKey("events.payment_transactions.id"),
+        index=True,
+        nullable=True,
+    )
+    #: The merchant ID the order was made for
+    mer_id = db.Column(db.String, nullable=False)
+    #: The order number sent to ICBC
+    out_trade_no = db.Column(db.String, nullable=False)
+    #: The payment channel (``domestic`` or ``foreign``)
+    channel = db.Column(db.String, nullable=False)
+    #: The amount to pay
+    amount = db.Column(db.Numeric(11, 2), nullable=False)  # max. 999999999.99
+    #: The currency of the amount
+    currency = db.Column(db.String, nullable=False)
+    #: The date/time the order was created
+    created_dt = db.Column(UTCDateTime, nullable=False, default=now_utc)
+    #: The date/time after which the order cannot be paid anymore
+    expires_dt = db.Column(UTCDateTime, nullable=False)
+    #: The last payment status (``pay_status``) reported by ICBC
+    status = db.Column(db.String, nullable=True)
+    #: The date/time the status was last updated
+    status_dt = db.Column(UTCDateTime, nullable=True)
+
+    #: The registration the order is for
+    registration = db.relationship(
+        "Registration",
+        lazy=True,
+        backref=db.backref(
+            "icbc_orders", cascade="all, delete-orphan", lazy="dynamic"
+        ),
+    )
+    #: The transaction which recorded the order
+    transaction = db.relationship(
+        "PaymentTransaction", lazy=True, foreign_keys=[transaction_id]
+    )
+    #: The transaction which registered the payment of the order
+    paid_transaction = db.relationship(
+        "PaymentTransaction", lazy=True, foreign_keys=[paid_transaction_id]
+    )
+
+    @property
+    def is_paid(self):
+        return self.paid_transaction_id is not None
+
+    @property
+    def biz_content(self):
+        """The biz_content that was sent to ICBC."""
+        return json.loads(self.transaction.data["biz_content"])
+
+    @classmethod
+    def find_order(cls, mer_id, out_trade_no, lock=False):
+        """Find an order by its merchant and order number.
+
+        With ``lock`` the order row is locked until the end of the
+        transaction and the order is reloaded from the database.
+        """
+        query = cls.query.filter_by(mer_id=mer_id, out_trade_no=out_trade_no)
+        if lock:
+            query = query.with_for_update().populate_existing()
+        return query.first()
+
+    def update_status(self, status, paid_transaction=None):
+        """Record a payment status reported by ICBC."""
+        self.status = status
+        self.status_dt = now_utc()
+        if paid_transaction is not None:
+            self.paid_transaction = paid_transaction
+
+    def __repr__(self):
+        return format_repr(
+            self, "id", "registration_id", "mer_id", "out_trade_no", status=None
+        )
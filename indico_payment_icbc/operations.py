@@ -0,0 +1,167 @@
+import json
+
+from flask_pluginengine import current_plugin
+from indico.core.db import db
+from indico.modules.events.payment.models.transactions import (
+    TransactionAction,
+    TransactionStatus,
+)
+from indico.modules.events.payment.notifications import notify_amount_inconsistency
+from indico.modules.events.payment.util import register_transaction
+from indico.util.date_time import now_utc
+
+from indico_payment_icbc import metrics
+from indico_payment_icbc.log import Redacted
+from indico_payment_icbc.models.notifications import ICBCNotificationState
+from indico_payment_icbc.models.orders import ICBCOrder
+
+transaction_action_mapping = {
+    "0": TransactionAction.complete,
+    # "TRADE_FAIL": TransactionAction.reject,
+    # "Pending": TransactionAction.pending,
+}
+
+
+def get_payment_status(biz_content):
+    """Get the payment status from a (decrypted) ICBC biz_content."""
+    return biz_content.get("pay_status", biz_content["return_code"])
+
+
+def is_transaction_duplicated(registration, biz_content, order=None):
+    """Check whether the payment has already been registered.
+
+    :param registration: the :class:`Registration` that was paid
+    :param biz_content: the biz_content received from ICBC
+    :param order: the :class:`ICBCOrder` of the payment, if it has been
+                  loaded already
+    """
+    if order is None:
+        order = ICBCOrder.find_order(biz_content["mer_id"], biz_content["out_trade_no"])
+    if order is not None:
+        return order.is_paid
+
+    # orders made before the order table existed are only in the transaction data
+    transaction = registration.transaction
+    if (
+        not transaction
+        or transaction.provider != "icbc"
+        or transaction.status != TransactionStatus.successful
+    ):
+        return False
+
+    # biz_content is from database. The other one is from ICBC. We compare them
+    stored_biz_content = json.loads(transaction.data["biz_content"])
+    return (
+        stored_biz_content["mer_id"] == biz_content["mer_id"]
+        and stored_biz_content["out_trade_no"] == biz_content["out_trade_no"]
+    )
+
+
+def verify_amount(registration, biz_content):
+    """Check whether the paid amount matches the registration fee."""
+    expected_amount = round(registration.price * 100)
+    expected_currency = registration.currency
+    amount = int(biz_content["total_amt"])
+
+    if expected_amount == amount:
+        return True
+    metrics.inc("icbc_amount_mismatches_total")
+    current_plugin.logger.warning(
+        "Payment doesn't match event's fee: %s %s != %s %s",
+        amount,
+        "CNY",
+        expected_amount,
+        expected_currency,
+    )
+    notify_amount_inconsistency(registration, amount, "CNY")
+    return False
+
+
+def register_payment(registration, biz_content, data):
+    """Register a payment result reported by ICBC.
+
+    The signature of the data must have been verified already.  The order
+    is locked until the end of the transaction, so a payment reported at
+    the same time by the notify callback, the payer's browser,
+    reconciliation or a settlement statement is only registered once.
+
+    :param registration: the :class:`Registration` that was paid
+    :param biz_content: the decrypted biz_content of the ICBC message
+    :param data: the full ICBC message stored in the transaction
+    :return: the new :class:`PaymentTransaction` or ``None`` if nothing
+             was registered.
+    """
+    order = ICBCOrder.find_order(
+        biz_content["mer_id"], biz_content["out_trade_no"], lock=True
+    )
+
+    # -------- verify duplicated transaction --------
+    if is_transaction_duplicated(registration, biz_content, order):
+        metrics.inc("icbc_duplicate_payments_total")
+        current_plugin.logger.info(
+            "Payment not recorded because transaction was duplicated\nData received: %s",
+            Redacted(data),
+        )
+        return None
+
+    # -------- verify payment status --------
+    payment_status = get_payment_status(biz_content)
+    metrics.inc("icbc_payment_status_total", status=payment_status)
+    if payment_status != "0":
+        if order is not None:
+            order.update_status(payment_status)
+        current_plugin.logger.info(
+            "Payment failed (status: %s)\nData received: %s",
+            payment_status,
+            Redacted(data),
+        )
+        return None
+
+    # -------- verify amount --------
+    verify_amount(registration, biz_content)
+
+    # -------- register transaction --------
+    transaction = register_transaction(
+        registration=registration,
+        amount=float(biz_content["total_amt"]) / 100,
+        currency=registration.currency,
+        action=transaction_action_mapping[payment_status],
+        provider="icbc",
+        data=data,
+    )
+    if order is not None:
+        order.update_status(payment_status, paid_transaction=transaction)
+    return transaction
+
+
+def process_notification(notification):
+    """Register the payment reported by a stored notify callback.
+
+    The notification is locked while processing, and its order by
+    :func:`register_payment`, so it is safe to process the same
+    notification (or several notifications for the same order) more than
+    once and concurrently.  The caller needs to
+    commit the session.
+
+    :param notification: an :class:`ICBCNotification`
+    :return: the new state of the notification
+    """
+    db.session.refresh(notification, with_for_update=True)
+    if notification.state == ICBCNotificationState.processed:
+        return notification.state
+
+    data = notification.data
+    notification.attempts += 1
+    notification.processed_dt = now_utc()
+    try:
+        with db.session.begin_nested():
+            biz_content = json.loads(data["biz_content"])
+            register_payment(notification.registration, biz_content, data)
+    except Exception as exc:
+        current_plugin.logger.exception("Could not process %r", notification)
+        notification.state = ICBCNotificationState.failed
+        notification.error = str(exc)
+    else:
+        notification.state = ICBCNotificationState.processed
+        notification.error = None
+    return notification.state
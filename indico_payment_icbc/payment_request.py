@@ -0,0 +1,107 @@
+import time
+from urllib.parse import urlparse
+
+from indico.core.config import config
+from indico.core.plugins import url_for_plugin
+
+from indico_payment_icbc.ids import generate_id
+from indico_payment_icbc.util import LRUCache
+
+#: the fields of a payment request which are the same for all requests
+COMMON_FIELDS = {
+    "format": "json",
+    "charset": "UTF-8",
+    "encrypt_type": "AES",
+    "sign_type": "RSA2",
+}
+#: the signed fields of a payment request, in the order they are signed in
+SIGNED_FIELDS = tuple(
+    sorted(("app_id", "msg_id", "timestamp", "biz_content", *COMMON_FIELDS))
+)
+
+
+class PaymentRequestTemplate:
+    """The parts of the payment requests of an event not depending on the payer.
+
+    Templates are immutable and built once per event and settings; use
+    :func:`get_request_template` to get the one for the current settings.
+    Only the per-registration and per-order fields are filled in for each
+    request.
+    """
+
+    __slots__ = (
+        "actions",
+        "sign_prefixes",
+        "common_fields",
+        "mer_reference",
+        "logo_url",
+    )
+
+    def __init__(self, *, url, url_foreign, app_id, mer_reference, logo_url):
+        set_ = super().__setattr__
+        set_("actions", {"domestic": url, "foreign": url_foreign})
+        # what the gateway signs is the path of the API followed by the fields
+        set_(
+            "sign_prefixes",
+            {
+                channel: f"{urlparse(action).path}?"
+                for channel, action in self.actions.items()
+            },
+        )
+        set_("common_fields", {"app_id": app_id, **COMMON_FIELDS})
+        set_("mer_reference", mer_reference)
+        set_("logo_url", logo_url)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def build_fields(self, encrypted_biz_content, current_time):
+        """Build the fields of a request, without its signature."""
+        fields = dict(self.common_fields)
+        fields["msg_id"] = generate_id()
+        fields["timestamp"] = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(current_time)
+        )
+        fields["biz_content"] = encrypted_biz_content
+        return fields
+
+    def get_sign_content(self, channel, fields):
+        """Get the string to sign for the fields of a request.
+
+        This is the same as :meth:`RsaUtil.encrypt_str` for the API path of
+        the channel, without sorting the fields again for every request.
+        """
+        return self.sign_prefixes[channel] + "&".join(
+            [f"{name}={fields[name]}" for name in SIGNED_FIELDS]
+        )
+
+
+_template_cache = LRUCache(256)
+
+
+def get_request_template(event, *, url, url_foreign, app_id):
+    """Get the :class:`PaymentRequestTemplate` of an event.
+
+    The templates are cached by the event and the values of the settings
+    they are built from, so saving different plugin or event settings builds
+    a new template and stale ones are evicted.
+
+    :param url: the ``url`` plugin setting
+    :param url_foreign: the ``url_foreign`` plugin setting
+    :param app_id: the ``app_id`` event setting
+    """
+    return _template_cache.get_or_create(
+        (event.id, url, url_foreign, app_id),
+        lambda: PaymentRequestTemplate(
+            url=url,
+            url_foreign=url_foreign,
+            app_id=app_id,
+            # all the callback URLs are on the host Indico runs on
+            mer_reference=urlparse(config.BASE_URL).hostname,
+            logo_url=url_for_plugin("payment_icbc.static", filename="images/logo.png"),
+        ),
+    )
+
+
+def clear_request_template_cache():
+    _template_cache.clear()
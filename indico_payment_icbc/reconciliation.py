@@ -0,0 +1,185 @@
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import batched
+
+from flask_pluginengine import current_plugin
+from indico.core.db import db
+from indico.modules.events.payment.models.transactions import (
+    PaymentTransaction,
+    TransactionStatus,
+)
+from indico.modules.events.registration.models.registrations import Registration
+from indico.util.date_time import now_utc
+from sqlalchemy.orm import contains_eager
+
+from indico_payment_icbc.client import ICBCGatewayClient
+from indico_payment_icbc.models.orders import ICBCOrder
+from indico_payment_icbc.operations import get_payment_status, register_payment
+from indico_payment_icbc.util import verify_response_signature
+
+#: how far back to look for orders which have not been reconciled
+RECONCILE_WINDOW = timedelta(days=2)
+#: orders younger than this are left to the payer's browser and the notify callback
+RECONCILE_MIN_AGE = timedelta(minutes=15)
+#: how long after expiring an order is still queried, since a payment started
+#: just before the order expired may be confirmed later
+RECONCILE_GRACE_PERIOD = timedelta(hours=1)
+#: number of orders queried before the results are committed
+RECONCILE_BATCH_SIZE = 50
+#: maximum number of concurrent order queries
+RECONCILE_CONCURRENCY = 8
+
+
+def find_unreconciled_orders(
+    window=RECONCILE_WINDOW,
+    min_age=RECONCILE_MIN_AGE,
+    grace_period=RECONCILE_GRACE_PERIOD,
+    *,
+    batch_size=RECONCILE_BATCH_SIZE,
+):
+    """Find recent ICBC orders of registrations which are still unpaid.
+
+    Orders whose unpaid status was reported after they expired cannot be
+    paid anymore and are skipped, and so are all orders once their grace
+    period after expiring has passed.  With ``grace_period=None`` they are
+    queried until they leave the window.
+
+    The orders are loaded in batches of ``batch_size`` as they are
+    consumed, so the session can be committed between two batches.
+    """
+    now = now_utc()
+    query = (
+        ICBCOrder.query.join(ICBCOrder.registration)
+        .outerjoin(Registration.transaction)
+        .filter(
+            ICBCOrder.paid_transaction_id.is_(None),
+            ICBCOrder.created_dt >= now - window,
+            ICBCOrder.created_dt <= now - min_age,
+            db.or_(
+                ICBCOrder.status_dt.is_(None),
+                ICBCOrder.status_dt < ICBCOrder.expires_dt,
+            ),
+            Registration.is_active,
+            db.or_(
+                PaymentTransaction.id.is_(None),
+                ~PaymentTransaction.status.in_(
+                    [TransactionStatus.successful, TransactionStatus.pending]
+                ),
+            ),
+        )
+        .options(
+            contains_eager(ICBCOrder.registration).contains_eager(
+                Registration.transaction
+            )
+        )
+        .order_by(ICBCOrder.id)
+    )
+    if grace_period is not None:
+        query = query.filter(ICBCOrder.expires_dt >= now - grace_period)
+    # a server-side cursor (``yield_per``) would not survive the commits
+    # between two batches, so the orders are paged by their ID instead
+    last_id = 0
+    while True:
+        orders = query.filter(ICBCOrder.id > last_id).limit(batch_size).all()
+        if not orders:
+            return
+        # read before the orders are expired by a commit of the caller
+        last_id = orders[-1].id
+        yield from orders
+        if len(orders) < batch_size:
+            return
+
+
+def reconcile_orders(
+    orders,
+    *,
+    batch_size=RECONCILE_BATCH_SIZE,
+    concurrency=RECONCILE_CONCURRENCY,
+    dry_run=False,
+):
+    """Query ICBC for the status of orders and register the paid ones.
+
+    The gateway is queried concurrently, but all database work happens in
+    the calling thread.  The payments are registered the same way as the
+    ones reported by the notify callback.
+
+    :return: a :class:`~collections.Counter` with the outcome of the orders
+    """
+    settings = current_plugin.settings.get_all()
+    logger = current_plugin.logger
+    clients = {}
+    stats = Counter()
+
+    def _get_client(event):
+        if event.id not in clients:
+            event_settings = current_plugin.event_settings.get_all(event)
+            clients[event.id] = (
+                ICBCGatewayClient.from_settings(settings, event_settings)
+                if event_settings["sign_key"] and event_settings["encrypt_key"]
+                else None
+            )
+        return clients[event.id]
+
+    def _query(job):
+        __, client, out_trade_no = job
+        try:
+            return client.query_order(out_trade_no)
+        except Exception as exc:
+            return exc
+
+    with ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix="icbc-reconcile"
+    ) as executor:
+        for batch in batched(orders, batch_size):
+            jobs = []
+            for order in batch:
+                client = _get_client(order.registration.event)
+                if client is None:
+                    stats["skipped"] += 1
+                    continue
+                jobs.append((order, client, order.out_trade_no))
+
+            for (order, __, out_trade_no), response_json in zip(
+                jobs, executor.map(_query, jobs)
+            ):
+                registration = order.registration
+                if isinstance(response_json, Exception):
+                    logger.warning(
+                        "Could not query ICBC order %s: %s", out_trade_no, response_json
+                    )
+                    stats["failed"] += 1
+                    continue
+                if not verify_response_signature(
+                    response_json, settings["gateway_public_key"]
+                ):
+                    logger.warning(
+                        "Invalid signature on ICBC order query result for %s",
+                        out_trade_no,
+                    )
+                    stats["invalid"] += 1
+                    continue
+                biz_content = json.loads(response_json["biz_content"])
+                payment_status = get_payment_status(biz_content)
+                if payment_status != "0":
+                    stats["unpaid"] += 1
+                    if not dry_run:
+                        order.update_status(payment_status)
+                    continue
+                # another order of the same registration may have been paid already
+                if registration.is_paid:
+                    stats["duplicate"] += 1
+                    continue
+                stats["paid"] += 1
+                if dry_run:
+                    continue
+                logger.info(
+                    "Reconciled paid ICBC order %s of %s", out_trade_no, registration
+                )
+                register_payment(registration, biz_content, response_json)
+
+            if not dry_run:
+                db.session.commit()
+
+    return stats
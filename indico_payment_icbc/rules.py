@@ -0,0 +1,164 @@
+import json
+
+from indico.modules.events.registration.models.registrations import (
+    Registration,
+    RegistrationState,
+)
+from indico.util.caching import memoize_request
+
+from indico_payment_icbc.util import LRUCache
+
+MESSAGE_FORM_NOT_ALLOWED = "Payment method not allowed in this registration form! Please use appropriate methods. "
+MESSAGE_NO_RELATED = "No related registration found! Please refer to the notices and complete the related registration first. "
+MESSAGE_MULTIPLE_RELATED = "Multiple registrations with the same email in the related registration found! Please contact the organizers to resolve the conflict. "
+MESSAGE_RELATED_NOT_COMPLETED = "Related registration has not been completed. Please refer to the notices and complete the related registration first."
+MESSAGE_RELATED_COMPLETED = "Related registration has been completed. This payment is not allowed. Please refer to the notices."
+
+#: event settings the payment rules are compiled from
+RULE_SETTINGS = (
+    "allowed_registration_form_ids",
+    "disallowed_registration_form_ids",
+    "completed_registration_form_id",
+    "uncompleted_registration_form_id",
+)
+
+
+class PaymentRules:
+    """The rules deciding which registrations may be paid using ICBC.
+
+    Instances are immutable and compiled from the event settings once; use
+    :func:`get_payment_rules` to get the one for the current settings.
+    """
+
+    __slots__ = (
+        "allowed_form_ids",
+        "disallowed_form_ids",
+        "completed_form_id",
+        "uncompleted_form_id",
+    )
+
+    def __init__(
+        self,
+        allowed_form_ids=None,
+        disallowed_form_ids=frozenset(),
+        completed_form_id=None,
+        uncompleted_form_id=None,
+    ):
+        set_ = super().__setattr__
+        set_(
+            "allowed_form_ids",
+            frozenset(allowed_form_ids) if allowed_form_ids is not None else None,
+        )
+        set_("disallowed_form_ids", frozenset(disallowed_form_ids))
+        set_("completed_form_id", completed_form_id)
+        set_("uncompleted_form_id", uncompleted_form_id)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    @classmethod
+    def from_settings(cls, event_settings):
+        allowed = event_settings["allowed_registration_form_ids"]
+        disallowed = event_settings["disallowed_registration_form_ids"]
+        return cls(
+            allowed_form_ids=json.loads(allowed) if allowed != "" else None,
+            disallowed_form_ids=json.loads(disallowed) if disallowed != "" else (),
+            completed_form_id=event_settings["completed_registration_form_id"],
+            uncompleted_form_id=event_settings["uncompleted_registration_form_id"],
+        )
+
+    def check_form(self, registration_form_id):
+        """Check whether the registration form may use this payment method.
+
+        :return: ``None`` if it is allowed, otherwise the message to show
+        """
+        if (
+            self.allowed_form_ids is not None
+            and registration_form_id not in self.allowed_form_ids
+        ) or registration_form_id in self.disallowed_form_ids:
+            return MESSAGE_FORM_NOT_ALLOWED
+        return None
+
+    def get_related_form_ids(self, registration_form_id):
+        """Get the IDs of the forms whose registrations need to be checked."""
+        return tuple(
+            form_id
+            for form_id in (self.completed_form_id, self.uncompleted_form_id)
+            if form_id is not None and form_id != registration_form_id
+        )
+
+    def check_related(self, registration_form_id, related_states):
+        """Check the completed/uncompleted registration form requirements.
+
+        :param related_states: a mapping from the IDs returned by
+                               :meth:`get_related_form_ids` to the states of
+                               the active registrations with the same email
+                               in that form
+        :return: ``None`` if it is allowed, otherwise the message to show
+        """
+        completed_form_id = self.completed_form_id
+        if completed_form_id is not None and completed_form_id != registration_form_id:
+            states = related_states.get(completed_form_id, ())
+            if not states:
+                return MESSAGE_NO_RELATED
+            elif len(states) > 1:
+                return MESSAGE_MULTIPLE_RELATED
+            elif states[0] != RegistrationState.complete:
+                return MESSAGE_RELATED_NOT_COMPLETED
+
+        uncompleted_form_id = self.uncompleted_form_id
+        if (
+            uncompleted_form_id is not None
+            and uncompleted_form_id != registration_form_id
+        ):
+            states = related_states.get(uncompleted_form_id, ())
+            if len(states) > 1:
+                return MESSAGE_MULTIPLE_RELATED
+            elif states and states[0] == RegistrationState.complete:
+                return MESSAGE_RELATED_COMPLETED
+
+        return None
+
+
+_rules_cache = LRUCache(256)
+
+
+def get_payment_rules(event_settings):
+    """Get the compiled :class:`PaymentRules` for the event settings.
+
+    The rules are cached by the values of the relevant settings, so saving
+    different settings compiles new rules and stale ones are evicted.
+    """
+    key = tuple(event_settings[name] for name in RULE_SETTINGS)
+    return _rules_cache.get_or_create(
+        key, lambda: PaymentRules.from_settings(event_settings)
+    )
+
+
+def clear_payment_rules_cache():
+    _rules_cache.clear()
+
+
+@memoize_request
+def get_related_registration_states(email, form_ids):
+    """Get the states of the active registrations of a person in some forms.
+
+    All forms are looked up in a single query, which is covered by Indico's
+    partial unique index on ``(registration_form_id, email)`` of active
+    registrations.
+
+    :param email: the email address of the registrant
+    :param form_ids: a tuple of registration form IDs
+    :return: a dict mapping each form ID to a list of registration states
+    """
+    related_states = {form_id: [] for form_id in form_ids}
+    if not form_ids:
+        return related_states
+    query = Registration.query.filter(
+        Registration.is_active,
+        Registration.email == email,
+        Registration.registration_form_id.in_(form_ids),
+    ).with_entities(Registration.registration_form_id, Registration.state)
+    for form_id, state in query:
+        related_states[form_id].append(state)
+    return related_states
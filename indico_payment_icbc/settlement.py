@@ -0,0 +1,225 @@
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import batched
+from typing import NamedTuple
+
+import sqlalchemy as sa
+from flask_pluginengine import current_plugin
+from indico.core.db import db
+from indico.modules.events.payment.models.transactions import PaymentTransaction
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
+
+from indico_payment_icbc.models.orders import ICBCOrder
+from indico_payment_icbc.operations import register_payment
+
+#: number of statement records matched against the database at once
+SETTLEMENT_BATCH_SIZE = 500
+#: the default statement columns containing the order key and the amount
+DEFAULT_COLUMNS = {
+    "mer_id": "mer_id",
+    "out_trade_no": "out_trade_no",
+    "amount": "total_amt",
+}
+
+# the keys of the records seen so far, kept in the database instead of memory
+_seen_table = sa.Table(
+    "icbc_settlement_seen",
+    sa.MetaData(),
+    sa.Column("mer_id", sa.String, primary_key=True),
+    sa.Column("out_trade_no", sa.String, primary_key=True),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+
+class SettlementRecord(NamedTuple):
+    """A payment listed in a settlement statement."""
+
+    line: int
+    mer_id: str
+    out_trade_no: str
+    #: the amount in fen
+    amount: int
+    data: dict
+
+
+class SettlementResult(NamedTuple):
+    outcome: str
+    record: SettlementRecord | None
+    order: ICBCOrder | None
+    detail: str = ""
+
+
+class StatementFormatError(Exception):
+    """A settlement statement cannot be read."""
+
+
+def read_statement(fileobj, *, delimiter="|", columns=None, amount_in_yuan=False):
+    """Read the payment records of a settlement statement line by line.
+
+    The first row containing all the needed columns is used as the header.
+    Anything before it and rows with a different number of fields (e.g.
+    totals at the end) are skipped.
+
+    :param fileobj: the statement, opened in text mode
+    :param columns: a dict overriding the :data:`DEFAULT_COLUMNS`
+    :param amount_in_yuan: whether the amounts are in yuan instead of fen
+    :return: an iterator of :class:`SettlementRecord`
+    """
+    columns = DEFAULT_COLUMNS | (columns or {})
+    reader = csv.reader(fileobj, delimiter=delimiter)
+    header = None
+    for row in reader:
+        row = [value.strip() for value in row]
+        if header is None:
+            if set(columns.values()) <= set(row):
+                header = row
+            continue
+        if len(row) != len(header):
+            continue
+        data = dict(zip(header, row))
+        try:
+            amount = Decimal(data[columns["amount"]])
+        except InvalidOperation:
+            raise StatementFormatError(
+                f"Invalid amount on line {reader.line_num}: {data[columns['amount']]}"
+            )
+        if amount_in_yuan:
+            amount *= 100
+        yield SettlementRecord(
+            line=reader.line_num,
+            mer_id=data[columns["mer_id"]],
+            out_trade_no=data[columns["out_trade_no"]],
+            amount=int(amount),
+            data=data,
+        )
+    if header is None:
+        raise StatementFormatError(
+            f"No header with the columns {', '.join(columns.values())} found"
+        )
+
+
+def reconcile_statement(
+    records, *, start_dt=None, end_dt=None, register=False, batch_size=None
+):
+    """Match the records of a settlement statement against the ICBC orders.
+
+    The records are processed in batches: the orders of a batch are looked
+    up using the unique index on ``(mer_id, out_trade_no)`` and the keys
+    seen so far are kept in a temporary table, so the memory used does not
+    depend on the size of the statement.
+
+    If the period covered by the statement is given, orders paid in Indico
+    during that period but missing from it are reported at the end.
+
+    :param register: whether to register the payments which are in the
+                     statement but not in Indico
+    :return: an iterator of :class:`SettlementResult`
+    """
+    batch_size = batch_size or SETTLEMENT_BATCH_SIZE
+    # the temporary table lives in its own transaction and is dropped at its end
+    with db.engine.begin() as conn:
+        _seen_table.create(conn)
+        for batch in batched(records, batch_size):
+            yield from _reconcile_batch(conn, batch, register)
+            if register:
+                db.session.commit()
+        if start_dt is not None and end_dt is not None:
+            yield from _find_unsettled(conn, start_dt, end_dt)
+
+
+def _reconcile_batch(conn, batch, register):
+    keys = [(record.mer_id, record.out_trade_no) for record in batch]
+    result = conn.execute(
+        insert(_seen_table)
+        .values([{"mer_id": k[0], "out_trade_no": k[1]} for k in set(keys)])
+        .on_conflict_do_nothing()
+        .returning(_seen_table.c.mer_id, _seen_table.c.out_trade_no)
+    )
+    new_keys = {tuple(row) for row in result}
+    orders = {
+        (order.mer_id, order.out_trade_no): order
+        for order in ICBCOrder.query.filter(
+            sa.tuple_(ICBCOrder.mer_id, ICBCOrder.out_trade_no).in_(keys)
+        ).options(joinedload(ICBCOrder.registration))
+    }
+    for key, record in zip(keys, batch):
+        if key not in new_keys:
+            yield SettlementResult("duplicate", record, orders.get(key))
+            continue
+        new_keys.discard(key)
+        order = orders.get(key)
+        if order is None:
+            yield SettlementResult("missing", record, None)
+            continue
+        expected_amount = round(order.amount * 100)
+        if record.amount != expected_amount:
+            yield SettlementResult(
+                "amount_mismatch",
+                record,
+                order,
+                f"{record.amount} != {expected_amount}",
+            )
+            continue
+        if order.is_paid:
+            yield SettlementResult("matched", record, order)
+        elif order.registration.is_paid:
+            # paid through another order of the same registration
+            yield SettlementResult("paid_twice", record, order)
+        elif register:
+            yield SettlementResult(*_register_settled(record, order))
+        else:
+            yield SettlementResult("unpaid", record, order)
+
+
+def _register_settled(record, order):
+    biz_content = {
+        "mer_id": record.mer_id,
+        "out_trade_no": record.out_trade_no,
+        "total_amt": str(record.amount),
+        "pay_status": "0",
+    }
+    data = {"biz_content": json.dumps(biz_content), "settlement": record.data}
+    current_plugin.logger.info(
+        "Registering settled ICBC order %s of %s",
+        order.out_trade_no,
+        order.registration,
+    )
+    if register_payment(order.registration, biz_content, data) is None:
+        return "failed", record, order
+    return "registered", record, order
+
+
+def _find_unsettled(conn, start_dt, end_dt):
+    # the orders are loaded through the session like in _reconcile_batch, so
+    # they include the payments it registered before they are committed;
+    # the connection of the temporary table only looks up the keys seen
+    seen_key = sa.tuple_(_seen_table.c.mer_id, _seen_table.c.out_trade_no)
+    query = (
+        ICBCOrder.query.join(ICBCOrder.paid_transaction)
+        .filter(
+            PaymentTransaction.timestamp >= start_dt,
+            PaymentTransaction.timestamp < end_dt,
+        )
+        .order_by(ICBCOrder.id)
+    )
+    last_id = 0
+    while True:
+        orders = query.filter(ICBCOrder.id > last_id).limit(SETTLEMENT_BATCH_SIZE).all()
+        if not orders:
+            return
+        last_id = orders[-1].id
+        keys = [(order.mer_id, order.out_trade_no) for order in orders]
+        seen_keys = {
+            tuple(row)
+            for row in conn.execute(
+                sa.select(_seen_table.c.mer_id, _seen_table.c.out_trade_no).where(
+                    seen_key.in_(keys)
+                )
+            )
+        }
+        for key, order in zip(keys, orders):
+            if key not in seen_keys:
+                yield SettlementResult("unsettled", None, order)
@@ -0,0 +1,27 @@
+from celery.schedules import crontab
+from flask_pluginengine import current_plugin
+from indico.core.celery import celery
+from indico.core.db import db
+
+from indico_payment_icbc.operations import process_notification
+from indico_payment_icbc.reconciliation import (
+    find_unreconciled_orders,
+    reconcile_orders,
+)
+
+
+@celery.periodic_task(
+    run_every=crontab(minute="*/10"), plugin="payment_icbc", locked=True
+)
+def reconcile_pending_orders():
+    """Pull the status of ICBC orders the payer never came back from."""
+    stats = reconcile_orders(find_unreconciled_orders())
+    if stats:
+        current_plugin.logger.info("ICBC reconciliation finished: %s", dict(stats))
+
+
+@celery.task(plugin="payment_icbc")
+def process_notify_callback(notification):
+    """Register the payment of a notify callback stored by the handler."""
+    process_notification(notification)
+    db.session.commit()
@@ -0,0 +1,127 @@
+import cProfile
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+#: environment variable enabling OpenTelemetry spans
+TRACING_ENV_VAR = "INDICO_ICBC_TRACING"
+#: environment variable with the number of seconds after which the profile
+#: of a request is saved
+PROFILE_THRESHOLD_ENV_VAR = "INDICO_ICBC_PROFILE_THRESHOLD"
+#: environment variable with the directory the profiles are saved to
+PROFILE_DIR_ENV_VAR = "INDICO_ICBC_PROFILE_DIR"
+
+_tracer = None
+_profile_threshold = None
+_profile_dir = None
+_profiling = threading.local()
+_null_span = nullcontext()
+
+
+def configure_tracing(logger=None, profile_dir=None):
+    """Enable tracing and profiling as configured in the environment.
+
+    Spans are only created if ``INDICO_ICBC_TRACING`` is set and
+    `opentelemetry-api` is installed; they go to the tracer provider set up
+    by the OpenTelemetry SDK or instrumentation of the process.  Requests
+    are only profiled if ``INDICO_ICBC_PROFILE_THRESHOLD`` is set.
+
+    :param profile_dir: the directory the profiles are saved to unless
+                        ``INDICO_ICBC_PROFILE_DIR`` is set
+    """
+    global _tracer, _profile_threshold, _profile_dir
+    if os.environ.get(TRACING_ENV_VAR, "") not in ("", "0"):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            if logger is not None:
+                logger.warning(
+                    "%s is set but opentelemetry-api is not installed", TRACING_ENV_VAR
+                )
+        else:
+            _tracer = trace.get_tracer("indico_payment_icbc")
+    threshold = os.environ.get(PROFILE_THRESHOLD_ENV_VAR)
+    if threshold:
+        _profile_threshold = float(threshold)
+        _profile_dir = (
+            os.environ.get(PROFILE_DIR_ENV_VAR) or profile_dir or tempfile.gettempdir()
+        )
+
+
+def set_tracer(tracer):
+    """Set the OpenTelemetry tracer spans are created with, or ``None``."""
+    global _tracer
+    _tracer = tracer
+
+
+def set_profile_threshold(threshold, profile_dir=None):
+    """Profile requests slower than ``threshold`` seconds, or none if ``None``."""
+    global _profile_threshold, _profile_dir
+    _profile_threshold = threshold
+    _profile_dir = profile_dir or _profile_dir or tempfile.gettempdir()
+
+
+def span(name, **attributes):
+    """Trace a block of code in a span.
+
+    When tracing is off a shared no-op context manager is returned.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return tracer.start_as_current_span(name, attributes=attributes or None)
+
+
+def bind_context(func):
+    """Bind a function to the current tracing context.
+
+    Spans created by it in another thread, e.g. in an executor, become
+    children of the current span.
+    """
+    if _tracer is None:
+        return func
+    from opentelemetry import context
+
+    ctx = context.get_current()
+
+    def wrapper(*args, **kwargs):
+        token = context.attach(ctx)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            context.detach(token)
+
+    return wrapper
+
+
+def profiled(name):
+    """Profile a block of code, saving the profile if it was slow.
+
+    The profiles are saved as ``<name>-<timestamp>.prof`` and can be viewed
+    with tools like ``snakeviz``.  Nested blocks are not profiled again.
+    """
+    if _profile_threshold is None or getattr(_profiling, "active", False):
+        return _null_span
+    return _profile(name, _profile_threshold, _profile_dir)
+
+
+@contextmanager
+def _profile(name, threshold, profile_dir):
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another profiler is running in this thread
+        yield
+        return
+    _profiling.active = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _profiling.active = False
+        if time.perf_counter() - start >= threshold:
+            profile.dump_stats(os.path.join(profile_dir, f"{name}-{time.time()}.prof"))
@@ -0,0 +1,104 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import json
+from decimal import Decimal
+
+import pytest
+
+from indico_payment_icbc.audit import audit_payloads, check_payload
+
+from fake_gateway import FakeGateway
+
+
+@pytest.fixture(scope='module')
+def public_key(gateway_key):
+    return gateway_key.publickey().export_key().decode()
+
+
+@pytest.fixture(scope='module')
+def gateway(merchant_key, gateway_key, encrypt_key):
+    with FakeGateway(merchant_public_key=merchant_key.publickey().export_key(), encrypt_key=encrypt_key,
+                     gateway_key=gateway_key) as gateway:
+        yield gateway
+
+
+def _notification(gateway, total_amt=150000):
+    return gateway.build_notification(app_id='app', mer_id='020001', out_trade_no='1234', total_amt=total_amt)
+
+
+def test_check_payload_notification(gateway, public_key):
+    data = _notification(gateway)
+    assert check_payload(1, Decimal('1500.00'), data, public_key=public_key).outcome == 'valid'
+    # the built-in ICBC key did not sign it
+    assert check_payload(1, Decimal('1500.00'), data).outcome == 'invalid'
+
+
+def test_check_payload_tampered(gateway, public_key):
+    data = _notification(gateway)
+    biz_content = json.loads(data['biz_content'])
+    biz_content['total_amt'] = '1'
+    data['biz_content'] = json.dumps(biz_content, separators=(',', ':'))
+    result = check_payload(1, Decimal('0.01'), data, public_key=public_key)
+    assert result == (1, 'invalid', 'signature does not match')
+
+
+def test_check_payload_amount_mismatch(gateway, public_key):
+    result = check_payload(1, Decimal('15.00'), _notification(gateway), public_key=public_key)
+    assert result == (1, 'amount_mismatch', 'signed 150000 != stored 1500')
+
+
+def _response(gateway, total_amt='150000', **changes):
+    biz_content = json.dumps({'pay_status': '0', 'total_amt': total_amt}, separators=(',', ':'))
+    encrypted = gateway.codec.encrypt(biz_content)
+    data = {'response_biz_content': encrypted, 'sign_type': 'RSA', 'sign': gateway.sign(f'"{encrypted}"'),
+            'biz_content': biz_content}
+    return dict(data, **changes)
+
+
+def test_check_payload_response(gateway, public_key, encrypt_key):
+    data = _response(gateway)
+    assert check_payload(1, Decimal('1500.00'), data, encrypt_key, public_key).outcome == 'valid'
+    data['response_biz_content'] = gateway.codec.encrypt('{"pay_status":"1"}')
+    assert check_payload(1, Decimal('1500.00'), data, encrypt_key, public_key).outcome == 'invalid'
+
+
+def test_check_payload_response_tampered(gateway, public_key, encrypt_key):
+    # the decrypted copy is not signed, but has to match the signed data
+    data = _response(gateway, biz_content='{"pay_status":"0","total_amt":"1"}')
+    result = check_payload(1, Decimal('0.01'), data, encrypt_key, public_key)
+    assert result == (1, 'invalid', 'biz_content does not match the signed one')
+
+
+def test_check_payload_response_amount_mismatch(gateway, public_key, encrypt_key):
+    result = check_payload(1, Decimal('1500.00'), _response(gateway, total_amt='1'), encrypt_key, public_key)
+    assert result == (1, 'amount_mismatch', 'signed 1 != stored 150000')
+
+
+@pytest.mark.parametrize('key', (None, 'MTIzNDU2Nzg5MDEyMzQ1Ng=='))
+def test_check_payload_response_wrong_key(gateway, public_key, key):
+    assert check_payload(1, Decimal('1500.00'), _response(gateway), key, public_key).outcome == 'malformed'
+
+
+@pytest.mark.parametrize(('data', 'outcome'), (
+    (None, 'unsigned'),
+    ({'biz_content': '{}', 'channel': 'domestic'}, 'unsigned'),
+    ({'sign': 'abc'}, 'malformed'),
+    ({'sign': 'not base64!', 'biz_content': '{"total_amt":"1"}'}, 'malformed'),
+))
+def test_check_payload_other(public_key, data, outcome):
+    assert check_payload(1, Decimal('1500.00'), data, public_key=public_key).outcome == outcome
+
+
+@pytest.mark.parametrize('workers', (1, 2))
+def test_audit_payloads(gateway, public_key, encrypt_key, workers):
+    valid = (_notification(gateway), _response(gateway))
+    tampered = (dict(valid[0], app_id='other'), _response(gateway, biz_content='{"pay_status":"0"}'))
+    rows = [(i, Decimal('1500.00'), (tampered if i % 10 == 0 else valid)[i % 2], encrypt_key) for i in range(1, 101)]
+    results = list(audit_payloads(iter(rows), public_key=public_key, workers=workers, chunk_size=7))
+    assert sorted(result.transaction_id for result in results) == list(range(1, 101))
+    assert sorted(result.transaction_id for result in results if result.outcome == 'invalid') == list(range(10, 101, 10))
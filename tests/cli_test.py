@@ -0,0 +1,100 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import json
+from decimal import Decimal
+
+import pytest
+
+from indico.modules.events.payment.models.transactions import PaymentTransaction, TransactionStatus
+from indico.modules.events.registration.models.registrations import RegistrationState
+
+from indico_payment_icbc.cli import cli
+from indico_payment_icbc.models.notifications import ICBCNotification, ICBCNotificationState
+from indico_payment_icbc.plugin import ICBCPaymentPlugin
+
+
+@pytest.fixture
+def run_cli(app):
+    def _run_cli(*args):
+        with ICBCPaymentPlugin.instance.plugin_context():
+            result = app.test_cli_runner().invoke(cli, args, catch_exceptions=False)
+        assert result.exit_code == 0
+        return result.output
+
+    return _run_cli
+
+
+@pytest.fixture
+def registration(mocker, dummy_reg):
+    # registering the payment would email the registrant
+    mocker.patch('indico.modules.events.payment.util.notify_registration_state_update')
+    dummy_reg.base_price = Decimal('13.37')
+    dummy_reg.state = RegistrationState.unpaid
+    return dummy_reg
+
+
+@pytest.fixture
+def notifications(db, registration, create_icbc_order):
+    """Notifications of the same payment in each state."""
+    create_icbc_order(registration)
+    biz_content = {'mer_id': '020001', 'out_trade_no': '12345', 'total_amt': '1337', 'pay_status': '0'}
+    notifications = {state.name: ICBCNotification(registration=registration, state=state,
+                                                  data={'biz_content': json.dumps(biz_content)})
+                     for state in ICBCNotificationState}
+    db.session.add_all(notifications.values())
+    db.session.flush()
+    return notifications
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.parametrize(('args', 'count', 'replayed'), (
+    ((), 1, {'failed'}),
+    (('--pending',), 2, {'failed', 'pending'}),
+    # processed notifications are skipped even when given explicitly
+    (('--id', 'pending', '--id', 'processed'), 2, {'pending'}),
+))
+def test_replay_notifications(run_cli, registration, notifications, args, count, replayed):
+    args = [str(notifications[arg].id) if arg in notifications else arg for arg in args]
+    output = run_cli('replay-notifications', *args)
+    assert f'Replaying {count} notifications' in output
+    for name, notification in notifications.items():
+        assert notification.attempts == (name in replayed)
+        if name in replayed:
+            assert notification.state == ICBCNotificationState.processed
+    # the payment is only registered once, however many notifications reported it
+    assert registration.is_paid
+    assert PaymentTransaction.query.filter_by(registration=registration).count() == 1
+
+
+@pytest.mark.usefixtures('request_context')
+def test_backfill_orders(db, run_cli, registration):
+    def _create_transaction(status, out_trade_no, **data):
+        biz_content = {'mer_id': '020001', 'out_trade_no': out_trade_no, 'icbc_flag': '1'}
+        transaction = PaymentTransaction(registration=registration, status=status, amount=13.37, currency='USD',
+                                         provider='icbc', data={'biz_content': json.dumps(biz_content), **data})
+        db.session.add(transaction)
+        db.session.flush()
+        return transaction
+
+    # orders made by older versions, one of which has been paid
+    paid = _create_transaction(TransactionStatus.rejected, '1', channel='foreign')
+    unpaid = _create_transaction(TransactionStatus.rejected, '2')
+    payment = _create_transaction(TransactionStatus.successful, '1')
+    output = run_cli('backfill-orders', '--batch-size', '2')
+    assert 'created: 2' in output
+    assert 'linked: 1' in output
+    orders = {order.transaction: order for order in registration.icbc_orders}
+    assert orders.keys() == {paid, unpaid}
+    assert orders[paid].channel == 'foreign'
+    assert orders[paid].paid_transaction == payment
+    assert orders[unpaid].channel == 'domestic'
+    assert not orders[unpaid].is_paid
+    # running it again changes nothing
+    assert 'skipped: 3' in run_cli('backfill-orders')
+    assert registration.icbc_orders.count() == 2
+    assert orders[paid].paid_transaction == payment
@@ -0,0 +1,86 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from indico_payment_icbc.client import ICBCGatewayClient, ICBCGatewayError
+from indico_payment_icbc.util import RsaUtil, get_aes_codec, wrap_private_key
+
+
+@pytest.fixture
+def gateway(sign_key, encrypt_key):
+    """A local stand-in for the ICBC gateway answering order queries."""
+    signer = RsaUtil(private_key=wrap_private_key(sign_key))
+    codec = get_aes_codec(encrypt_key)
+    state = {'failures': 0, 'requests': []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+            form = {k: v[0] for k, v in parse_qs(body).items()}
+            state['requests'].append((self.path, form))
+            if state['failures']:
+                state['failures'] -= 1
+                self.send_response(503)
+                self.end_headers()
+                return
+            params = {k: v for k, v in form.items() if k != 'sign'}
+            assert form['sign'] == signer.create_sign(RsaUtil.encrypt_str(self.path, params))
+            biz_content = json.loads(codec.decrypt(form['biz_content']))
+            response_biz_content = {'return_code': '0', 'pay_status': '0', 'out_trade_no': biz_content['out_trade_no']}
+            payload = json.dumps({'response_biz_content': codec.encrypt(json.dumps(response_biz_content)),
+                                  'sign': 'dummy'}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}', state
+    server.shutdown()
+    server.server_close()
+
+
+def _make_client(sign_key, encrypt_key, base_url, **kwargs):
+    return ICBCGatewayClient(app_id='app', mer_id='mer', mer_prtcl_no='prtcl', sign_key=sign_key,
+                             encrypt_key=encrypt_key, base_url=base_url, backoff=0, **kwargs)
+
+
+def test_query_order(sign_key, encrypt_key, gateway):
+    base_url, state = gateway
+    response = _make_client(sign_key, encrypt_key, base_url).query_order('1234.5')
+    assert json.loads(response['biz_content'])['out_trade_no'] == '1234.5'
+    path, form = state['requests'][0]
+    assert path == ICBCGatewayClient.ORDER_QUERY_PATH
+    assert form['app_id'] == 'app'
+
+
+def test_query_order_retries(sign_key, encrypt_key, gateway):
+    base_url, state = gateway
+    state['failures'] = 2
+    response = _make_client(sign_key, encrypt_key, base_url, retries=2).query_order('1')
+    assert json.loads(response['biz_content'])['pay_status'] == '0'
+    assert len(state['requests']) == 3
+
+
+def test_query_order_gives_up(sign_key, encrypt_key, gateway):
+    base_url, state = gateway
+    state['failures'] = 3
+    with pytest.raises(ICBCGatewayError):
+        _make_client(sign_key, encrypt_key, base_url, retries=1).query_order('1')
+    assert len(state['requests']) == 2
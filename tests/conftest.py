@@ -0,0 +1,67 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from datetime import timedelta
+
+import pytest
+from Crypto.PublicKey import RSA
+
+# the registration fixtures are not loaded by Indico's pytest plugin
+from indico.modules.events.registration.testing.fixtures import dummy_reg, dummy_regform  # noqa: F401
+from indico.util.date_time import now_utc
+
+from indico_payment_icbc.models.orders import ICBCOrder
+
+
+@pytest.fixture(scope='session')
+def merchant_key():
+    """The RSA key of a merchant, i.e. the private key of its ``sign_key``."""
+    return RSA.generate(2048)
+
+
+@pytest.fixture(scope='session')
+def sign_key(merchant_key):
+    """The ``sign_key`` setting, which only contains the base64 body of the PEM on a single line."""
+    return ''.join(merchant_key.export_key(pkcs=1).decode().splitlines()[1:-1])
+
+
+@pytest.fixture(scope='session')
+def gateway_key():
+    """The RSA key of the gateway; the real ICBC gateway key is a 1024-bit one."""
+    return RSA.generate(1024)
+
+
+@pytest.fixture(scope='session')
+def encrypt_key():
+    """The ``encrypt_key`` setting of a merchant."""
+    return 'MDEyMzQ1Njc4OWFiY2RlZg=='
+
+
+@pytest.fixture
+def create_icbc_order(db):
+    """Return a callable creating an unpaid ICBC order of a registration."""
+    def _create_order(registration, out_trade_no='12345', created_dt=None, **kwargs):
+        created_dt = created_dt or now_utc()
+        kwargs = {'mer_id': '020001', 'channel': 'domestic', 'amount': registration.price,
+                  'currency': registration.currency, 'expires_dt': created_dt + timedelta(minutes=15), **kwargs}
+        order = ICBCOrder(registration=registration, out_trade_no=out_trade_no, created_dt=created_dt, **kwargs)
+        db.session.add(order)
+        db.session.flush()
+        return order
+
+    return _create_order
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    # keep the results of benchmark runs (in .benchmarks/ by default) so they
+    # can be compared between releases with `pytest-benchmark compare`
+    if not config.pluginmanager.hasplugin('benchmark') or not config.getoption('benchmark_only'):
+        return
+    if not config.getoption('benchmark_save') and not config.getoption('benchmark_autosave'):
+        from pytest_benchmark.utils import get_tag
+        config.option.benchmark_autosave = get_tag()
@@ -5,100 +5,408 @@
 # them and/or modify them under the terms of the MIT License;
 # see the LICENSE file for more details.
 
+import json
+import time
+from decimal import Decimal
 from unittest.mock import MagicMock
 
 import pytest
-from flask import request
+from flask import get_flashed_messages
+from werkzeug.exceptions import BadRequest, Forbidden
 
-from indico.modules.events.payment.models.transactions import PaymentTransaction
+from indico.modules.events.payment.models.transactions import PaymentTransaction, TransactionStatus
+from indico.modules.events.registration.models.registrations import RegistrationState
+from indico.web.flask.util import url_for
 
-from indico_payment_icbc.controllers import RHPaypalIPN
-from indico_payment_icbc.plugin import PaypalPaymentPlugin
+from indico_payment_icbc import controllers
+from indico_payment_icbc.controllers import RHICBCpayNotify, RHICBCpaySign, RHICBCpaySuccess
+from indico_payment_icbc.models.notifications import ICBCNotification, ICBCNotificationState
+from indico_payment_icbc.operations import (is_transaction_duplicated, process_notification, register_payment,
+                                            verify_amount)
+from indico_payment_icbc.plugin import ICBCPaymentPlugin
+from indico_payment_icbc.util import AesCodec, RsaUtil
 
+from fake_gateway import FakeGateway
+
+
+def _biz_content(out_trade_no='12345', total_amt='1337', pay_status='0'):
+    return {'mer_id': '020001', 'out_trade_no': out_trade_no, 'total_amt': total_amt, 'pay_status': pay_status}
 
-@pytest.mark.usefixtures('db', 'request_context')
-@pytest.mark.parametrize(('formdata', 'expected'), (
-    ({'business': 'test'},       True),
-    ({'receiver_id': 'test'},    True),
-    ({'receiver_email': 'test'}, True),
-    ({'business': 'foo'},        False),
-    ({},                         False)
-))
-def test_ipn_verify_business(formdata, expected, dummy_event):
-    rh = RHPaypalIPN()
-    rh.registration = MagicMock()
-    rh.registration.registration_form.event = dummy_event
-    PaypalPaymentPlugin.event_settings.set(dummy_event, 'business', 'TeST')
-    request.form = formdata
-    with PaypalPaymentPlugin.instance.plugin_context():
-        assert rh._verify_business() == expected
+
+@pytest.fixture
+def icbc_order(mocker, dummy_reg, create_icbc_order):
+    # registering the payment would email the registrant
+    mocker.patch('indico.modules.events.payment.util.notify_registration_state_update')
+    dummy_reg.base_price = Decimal('13.37')
+    dummy_reg.state = RegistrationState.unpaid
+    return create_icbc_order(dummy_reg)
+
+
+def _create_notification(db, registration, **kwargs):
+    notification = ICBCNotification(registration=registration, data={'biz_content': json.dumps(_biz_content(**kwargs))})
+    db.session.add(notification)
+    db.session.flush()
+    return notification
 
 
 @pytest.mark.usefixtures('request_context')
-@pytest.mark.parametrize(('amount', 'currency', 'expected'), (
-    ('13.37', 'EUR', True),
-    ('13.37', 'CHF', False),
-    ('10.00', 'CHF', False),
+@pytest.mark.parametrize(('total_amt', 'expected'), (
+    ('1337', True),
+    ('1000', False),
 ))
-def test_ipn_verify_amount(mocker, amount, currency, expected):
-    nai = mocker.patch('indico_payment_paypal.controllers.notify_amount_inconsistency')
-    rh = RHPaypalIPN()
-    rh.event = MagicMock(id=1)
-    rh.registration = MagicMock()
-    rh.registration.price = 13.37
-    rh.registration.currency = currency
-    request.form = {'mc_gross': amount, 'mc_currency': 'EUR'}
-    with PaypalPaymentPlugin.instance.plugin_context():
-        assert rh._verify_amount() == expected
+def test_verify_amount(mocker, total_amt, expected):
+    nai = mocker.patch('indico_payment_icbc.operations.notify_amount_inconsistency')
+    registration = MagicMock(price=13.37, currency='CNY')
+    with ICBCPaymentPlugin.instance.plugin_context():
+        assert verify_amount(registration, _biz_content(total_amt=total_amt)) == expected
         assert nai.called == (not expected)
 
 
-@pytest.mark.usefixtures('request_context')
-@pytest.mark.parametrize(('txn_id', 'payment_status', 'expected'), (
-    ('12345',  'Completed', True),
-    ('12345',  'Pending',   False),
-    ('123456', 'Completed', False),
-    ('123456', 'Pending',   False),
+@pytest.mark.parametrize(('out_trade_no', 'status', 'expected'), (
+    ('12345',  TransactionStatus.successful, True),
+    ('12345',  TransactionStatus.rejected,   False),
+    ('123456', TransactionStatus.successful, False),
+    ('123456', TransactionStatus.rejected,   False),
 ))
-def test_ipn_is_transaction_duplicated(txn_id, payment_status, expected):
-    request.form = {'payment_status': 'Completed', 'txn_id': '12345'}
-    rh = RHPaypalIPN()
-    rh.registration = MagicMock()
-    rh.registration.transaction = None
-    assert not rh._is_transaction_duplicated()
-    transaction = PaymentTransaction(provider='paypal', data={'payment_status': payment_status, 'txn_id': txn_id})
-    rh.registration.transaction = transaction
-    assert rh._is_transaction_duplicated() == expected
+def test_is_transaction_duplicated_legacy(mocker, out_trade_no, status, expected):
+    # orders made before the order table existed
+    mocker.patch('indico_payment_icbc.operations.ICBCOrder.find_order', return_value=None)
+    registration = MagicMock()
+    registration.transaction = None
+    assert not is_transaction_duplicated(registration, _biz_content())
+    registration.transaction = PaymentTransaction(provider='icbc', status=status,
+                                                  data={'biz_content': json.dumps(_biz_content(out_trade_no))})
+    assert is_transaction_duplicated(registration, _biz_content()) == expected
+
+
+@pytest.mark.parametrize('paid', (True, False))
+def test_is_transaction_duplicated(mocker, paid):
+    order = MagicMock(is_paid=paid)
+    find_order = mocker.patch('indico_payment_icbc.operations.ICBCOrder.find_order', return_value=order)
+    assert is_transaction_duplicated(MagicMock(), _biz_content()) == paid
+    find_order.assert_called_once_with('020001', '12345')
+    # an order which has been loaded already is not looked up again
+    assert is_transaction_duplicated(MagicMock(), _biz_content(), MagicMock(is_paid=paid)) == paid
+    find_order.assert_called_once()
 
 
-@pytest.mark.usefixtures('db', 'request_context')
+@pytest.mark.usefixtures('request_context')
 @pytest.mark.parametrize('fail', (
-    'verify',
     'dup_txn',
-    'fail',
-    'refund',
-    'negative',
     'status',
+    'amount',
     None,
 ))
-def test_ipn_process(mocker, fail):
-    rt = mocker.patch('indico_payment_paypal.controllers.register_transaction')
-    post = mocker.patch('indico_payment_paypal.controllers.requests.post')
-    mocker.patch('indico_payment_paypal.controllers.notify_amount_inconsistency')
-    post.return_value.text = 'INVALID' if fail == 'verify' else 'VERIFIED'
-    rh = RHPaypalIPN()
-    rh._verify_business = MagicMock()
-    rh._is_transaction_duplicated = lambda: fail == 'dup_txn'
-    rh.event = MagicMock(id=1)
+def test_register_payment(mocker, fail):
+    rt = mocker.patch('indico_payment_icbc.operations.register_transaction')
+    nai = mocker.patch('indico_payment_icbc.operations.notify_amount_inconsistency')
+    order = MagicMock(is_paid=fail == 'dup_txn')
+    find_order = mocker.patch('indico_payment_icbc.operations.ICBCOrder.find_order', return_value=order)
+    registration = MagicMock(price=13.37, currency='CNY')
+    biz_content = _biz_content(total_amt='1000' if fail == 'amount' else '1337',
+                               pay_status='1' if fail == 'status' else '0')
+    with ICBCPaymentPlugin.instance.plugin_context():
+        register_payment(registration, biz_content, {'biz_content': json.dumps(biz_content)})
+    # the order is locked before checking whether it has been paid already
+    find_order.assert_called_once_with('020001', '12345', lock=True)
+    # a wrong amount is reported to the organizers, but the payment still registered
+    assert rt.called == (fail in (None, 'amount'))
+    assert nai.called == (fail == 'amount')
+    if rt.called:
+        order.update_status.assert_called_once_with('0', paid_transaction=rt.return_value)
+    elif fail == 'status':
+        order.update_status.assert_called_once_with('1')
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.parametrize(('verified', 'async_notify'), (
+    (False, False),
+    (False, True),
+    (True,  False),
+    (True,  True),
+))
+def test_notify_process(mocker, verified, async_notify):
+    register = mocker.patch('indico_payment_icbc.controllers.register_payment')
+    task = mocker.patch('indico_payment_icbc.controllers.process_notify_callback')
+    mocker.patch('indico_payment_icbc.controllers.ICBCNotification')
+    mocker.patch('indico_payment_icbc.controllers.db')
+    mocker.patch.object(ICBCPaymentPlugin.settings, 'get',
+                        side_effect=lambda name: async_notify if name == 'async_notify' else None)
+    rh = RHICBCpayNotify()
+    rh._verify_signature = lambda: verified
     rh.registration = MagicMock()
-    rh.registration.getTotal.return_value = 10.00
-    payment_status = {'fail': 'Failed', 'refund': 'Refunded', 'status': 'Foobar'}.get(fail, 'Completed')
-    amount = '-10.00' if fail == 'negative' else '10.00'
-    request.view_args = {'event_id': rh.event.id}
-    request.args = {'registrantId': '1'}
-    request.form = {'payment_status': payment_status, 'txn_id': '12345', 'mc_gross': amount,
-                    'mc_currency': 'EUR', 'business': 'foo@bar.com'}
-    with PaypalPaymentPlugin.instance.plugin_context():
+    rh.response_form = {'biz_content': json.dumps(_biz_content())}
+    rh.biz_content = _biz_content()
+    with ICBCPaymentPlugin.instance.plugin_context():
         rh._process()
-        assert post.called
-        assert rt.called == (fail is None)
+    assert register.called == (verified and not async_notify)
+    assert task.delay.called == (verified and async_notify)
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.parametrize('pay_status', ('0', '1'))
+def test_process_notification(db, icbc_order, pay_status):
+    registration = icbc_order.registration
+    notification = _create_notification(db, registration, pay_status=pay_status)
+    with ICBCPaymentPlugin.instance.plugin_context():
+        assert process_notification(notification) == ICBCNotificationState.processed
+    assert notification.attempts == 1
+    assert notification.error is None
+    assert icbc_order.status == pay_status
+    assert icbc_order.is_paid == (pay_status == '0')
+    assert registration.is_paid == (pay_status == '0')
+    if icbc_order.is_paid:
+        assert icbc_order.paid_transaction == registration.transaction
+        assert registration.state == RegistrationState.complete
+
+
+@pytest.mark.usefixtures('request_context')
+def test_process_notification_duplicate(db, icbc_order):
+    registration = icbc_order.registration
+    first = _create_notification(db, registration)
+    second = _create_notification(db, registration)
+    with ICBCPaymentPlugin.instance.plugin_context():
+        assert process_notification(first) == ICBCNotificationState.processed
+        transaction = registration.transaction
+        # processed notifications are skipped, others find the order paid already
+        assert process_notification(first) == ICBCNotificationState.processed
+        assert process_notification(second) == ICBCNotificationState.processed
+    assert (first.attempts, second.attempts) == (1, 1)
+    assert registration.transaction == transaction
+    assert PaymentTransaction.query.filter_by(registration=registration).count() == 1
+
+
+@pytest.mark.usefixtures('request_context')
+def test_process_notification_failed(db, icbc_order):
+    notification = ICBCNotification(registration=icbc_order.registration, data={'sign': 'foo'})
+    db.session.add(notification)
+    db.session.flush()
+    with ICBCPaymentPlugin.instance.plugin_context():
+        assert process_notification(notification) == ICBCNotificationState.failed
+    assert notification.attempts == 1
+    assert notification.error == "'biz_content'"
+    assert not icbc_order.is_paid
+
+
+@pytest.mark.usefixtures('db')
+@pytest.mark.parametrize(('provider', 'data', 'expected'), (
+    ('icbc', {'biz_content': json.dumps(_biz_content('1234'))}, '1234'),
+    ('icbc', {}, None),
+    ('paypal', {'biz_content': json.dumps(_biz_content('1234'))}, None),
+    (None, None, None),
+))
+def test_query_all_results_legacy(mocker, dummy_reg, provider, data, expected):
+    # registrations whose orders have not been backfilled into the order table
+    if provider is not None:
+        dummy_reg.transaction = PaymentTransaction(registration=dummy_reg, status=TransactionStatus.rejected,
+                                                   amount=13.37, currency='USD', provider=provider, data=data)
+    client = MagicMock()
+    client.query_order.return_value = {'biz_content': json.dumps(_biz_content('1234', pay_status='1'))}
+    mocker.patch.object(RHICBCpaySuccess, '_get_gateway_client', return_value=client)
+    rh = RHICBCpaySuccess()
+    rh.registration = dummy_reg
+    with ICBCPaymentPlugin.instance.plugin_context():
+        if expected is None:
+            with pytest.raises(BadRequest):
+                rh._query_all_results()
+            assert not client.query_order.called
+        else:
+            assert rh._query_all_results() == client.query_order.return_value
+            client.query_order.assert_called_once_with(expected)
+
+
+@pytest.fixture
+def gateway(dummy_reg, merchant_key, gateway_key, sign_key, encrypt_key):
+    with FakeGateway(merchant_public_key=merchant_key.publickey().export_key(), encrypt_key=encrypt_key,
+                     gateway_key=gateway_key) as gateway:
+        ICBCPaymentPlugin.settings.set_multi({'gateway_url': gateway.url, 'gateway_public_key': gateway.public_key})
+        ICBCPaymentPlugin.event_settings.set_multi(dummy_reg.event, {
+            'app_id': 'app', 'mer_id': '020001', 'mer_prtcl_no': 'prtcl', 'sign_key': sign_key,
+            'encrypt_key': encrypt_key,
+        })
+        yield gateway
+
+
+# the state of orders in the fake gateway; a query taking longer than the read timeout fails
+PAID = {'pay_status': '0'}
+UNPAID = {'pay_status': '1'}
+FAILED = {'pay_status': '0', 'error': 503}
+SLOW = {'pay_status': '0', 'latency': 3}
+
+
+@pytest.mark.usefixtures('db')
+@pytest.mark.parametrize(('orders', 'expected'), (
+    # oldest order first
+    ((UNPAID, PAID, UNPAID), '2'),
+    ((UNPAID, UNPAID, {'pay_status': '2'}), '3'),
+    # failed queries of other orders do not matter
+    ((PAID, UNPAID, FAILED), '1'),
+    ((FAILED, UNPAID, UNPAID), '3'),
+    ((SLOW, UNPAID, UNPAID), '3'),
+    # the latest order cannot be queried
+    ((UNPAID, UNPAID, FAILED), None),
+    ((UNPAID, UNPAID, SLOW), None),
+))
+def test_query_all_results(app, monkeypatch, dummy_reg, create_icbc_order, gateway, orders, expected):
+    monkeypatch.setattr(controllers, 'ORDER_QUERY_TIMEOUT', (1, 1))
+    for out_trade_no, order in enumerate(orders, 1):
+        create_icbc_order(dummy_reg, str(out_trade_no))
+        gateway.set_order(str(out_trade_no), total_amt=1337, **order)
+    rh, response, messages = _process_success_args(app, dummy_reg)
+    if expected is None:
+        _assert_processing_redirect(app, response, messages, dummy_reg)
+    else:
+        assert response is None
+        assert rh.biz_content['out_trade_no'] == expected
+    # failed queries are not retried while the payer waits
+    assert gateway.stats['errors'] <= orders.count(FAILED)
+
+
+@pytest.mark.usefixtures('db')
+def test_query_all_results_deadline(app, monkeypatch, dummy_reg, create_icbc_order, gateway):
+    monkeypatch.setattr(controllers, 'ORDER_QUERY_DEADLINE', 0.5)
+    for i in range(1, 4):
+        create_icbc_order(dummy_reg, str(i))
+        gateway.set_order(str(i), total_amt=1337, latency=2)
+    start = time.perf_counter()
+    rh, response, messages = _process_success_args(app, dummy_reg)
+    # the payer does not wait for the running queries
+    assert time.perf_counter() - start < 2
+    _assert_processing_redirect(app, response, messages, dummy_reg)
+
+
+def _process_success(app, registration):
+    with (app.test_request_context(query_string={'token': registration.uuid}),
+          ICBCPaymentPlugin.instance.plugin_context()):
+        rh = RHICBCpaySuccess()
+        response = rh._process_args() or rh._process()
+        return response, get_flashed_messages(with_categories=True)
+
+
+@pytest.fixture
+def crypto_calls(mocker):
+    """Spy on the gateway clients created and on all signing and AES operations."""
+    return [mocker.spy(controllers.ICBCGatewayClient, 'from_settings'),
+            mocker.spy(RsaUtil, 'create_sign'), mocker.spy(RsaUtil, 'verify_sign'),
+            mocker.spy(AesCodec, 'encrypt'), mocker.spy(AesCodec, 'decrypt')]
+
+
+@pytest.mark.usefixtures('db')
+def test_success_already_paid(app, dummy_reg, create_icbc_order, gateway, crypto_calls):
+    order = create_icbc_order(dummy_reg)
+    gateway.set_order(order.out_trade_no, total_amt=1337)
+    dummy_reg.transaction = PaymentTransaction(registration=dummy_reg, status=TransactionStatus.successful,
+                                               amount=13.37, currency='USD', provider='icbc', data={})
+    response, messages = _process_success(app, dummy_reg)
+    assert response.status_code == 302
+    assert [category for category, message in messages] == ['success']
+    # the notification registered the payment already, so ICBC is not asked again
+    assert not gateway.stats['queries']
+    assert not any(spy.called for spy in crypto_calls)
+
+
+@pytest.mark.usefixtures('db')
+def test_success_unpaid(app, mocker, dummy_reg, create_icbc_order, gateway, crypto_calls):
+    mocker.patch('indico.modules.events.payment.util.notify_registration_state_update')
+    dummy_reg.base_price = Decimal('13.37')
+    dummy_reg.state = RegistrationState.unpaid
+    order = create_icbc_order(dummy_reg)
+    gateway.set_order(order.out_trade_no, total_amt=1337)
+    response, messages = _process_success(app, dummy_reg)
+    assert response.status_code == 302
+    assert [category for category, message in messages] == ['success']
+    assert gateway.stats['queries'] == 1
+    assert all(spy.called for spy in crypto_calls)
+    assert order.paid_transaction == dummy_reg.transaction
+    assert dummy_reg.is_paid
+
+
+def _process_success_args(app, registration):
+    with (app.test_request_context(query_string={'token': registration.uuid}),
+          ICBCPaymentPlugin.instance.plugin_context()):
+        rh = RHICBCpaySuccess()
+        response = rh._process_args()
+        return rh, response, get_flashed_messages(with_categories=True)
+
+
+def _assert_processing_redirect(app, response, messages, registration):
+    assert response.status_code == 302
+    with app.test_request_context():
+        assert response.location == url_for('event_registration.display_regform', registration.locator.registrant)
+    assert [category for category, message in messages] == ['warning']
+    assert 'being processed' in messages[0][1]
+
+
+@pytest.fixture
+def sign_registration(dummy_reg, sign_key, encrypt_key):
+    ICBCPaymentPlugin.event_settings.set_multi(dummy_reg.event, {
+        'app_id': '10000000000004095503', 'mer_id': '020001', 'mer_prtcl_no': '0200010200010201',
+        'sign_key': sign_key, 'encrypt_key': encrypt_key,
+    })
+    dummy_reg.base_price = Decimal('13.37')
+    dummy_reg.state = RegistrationState.unpaid
+    return dummy_reg
+
+
+def _sign(app, registration, channel='domestic', token=None):
+    with (app.test_request_context(method='POST', data={'channel': channel},
+                                   query_string={'token': token or registration.uuid}),
+          ICBCPaymentPlugin.instance.plugin_context()):
+        rh = RHICBCpaySign()
+        rh._process_args()
+        rh._check_access()
+        return rh._process().get_json()
+
+
+@pytest.mark.parametrize('channel', ('domestic', 'foreign'))
+def test_sign(app, encrypt_key, sign_registration, channel):
+    response = _sign(app, sign_registration, channel)
+    url = ICBCPaymentPlugin.settings.get('url' if channel == 'domestic' else 'url_foreign')
+    assert response['action'] == url
+    fields = response['fields']
+    assert fields['app_id'] == '10000000000004095503'
+    assert fields['sign_type'] == 'RSA2'
+    assert fields['sign']
+    biz_content = json.loads(AesCodec(encrypt_key).decrypt(fields['biz_content']))
+    assert biz_content['amount'] == '1337'
+    assert biz_content['out_trade_no'] == sign_registration.icbc_orders.one().out_trade_no
+    assert not sign_registration.is_paid
+
+
+@pytest.mark.parametrize(('state', 'price', 'paid', 'deleted'), (
+    (RegistrationState.complete, '13.37', False, False),
+    (RegistrationState.pending, '13.37', False, False),
+    (RegistrationState.withdrawn, '13.37', False, False),
+    (RegistrationState.rejected, '13.37', False, False),
+    (RegistrationState.unpaid, '0', False, False),
+    (RegistrationState.unpaid, '13.37', True, False),
+    (RegistrationState.unpaid, '13.37', False, True),
+))
+def test_sign_not_payable(app, sign_registration, state, price, paid, deleted):
+    sign_registration.state = state
+    sign_registration.base_price = Decimal(price)
+    sign_registration.is_deleted = deleted
+    if paid:
+        sign_registration.transaction = PaymentTransaction(registration=sign_registration, amount=13.37,
+                                                           currency='USD', provider='icbc', data={},
+                                                           status=TransactionStatus.successful)
+    with pytest.raises(BadRequest):
+        _sign(app, sign_registration)
+    assert not sign_registration.icbc_orders.count()
+
+
+def test_sign_restricted(app, sign_registration):
+    ICBCPaymentPlugin.event_settings.set(sign_registration.event, 'allowed_registration_form_ids',
+                                         str([sign_registration.registration_form_id + 1]))
+    with pytest.raises(Forbidden):
+        _sign(app, sign_registration)
+    assert not sign_registration.icbc_orders.count()
+
+
+@pytest.mark.parametrize(('channel', 'token'), (
+    ('paypal', None),
+    ('domestic', '00000000-0000-0000-0000-000000000000'),
+))
+def test_sign_invalid_args(app, sign_registration, channel, token):
+    with pytest.raises(BadRequest):
+        _sign(app, sign_registration, channel, token)
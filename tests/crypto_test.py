@@ -0,0 +1,137 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import base64
+import itertools
+import logging
+
+import pytest
+from Crypto.Hash import SHA1
+from Crypto.Signature import pkcs1_15
+
+from indico_payment_icbc import crypto
+from indico_payment_icbc.crypto import BACKENDS, CryptoBackend, CryptographyBackend, PyCryptodomeBackend
+from indico_payment_icbc.util import AesCodec, RsaUtil, wrap_private_key
+
+
+def _get_backend(name):
+    if name == 'cryptography':
+        pytest.importorskip('cryptography')
+    return BACKENDS[name]()
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request):
+    return _get_backend(request.param)
+
+
+@pytest.fixture(params=list(itertools.permutations(sorted(BACKENDS), 2)), ids='-'.join)
+def backends(request):
+    return tuple(_get_backend(name) for name in request.param)
+
+
+@pytest.fixture
+def crypto_backend():
+    yield
+    crypto.set_backend(None)
+    crypto.configure_crypto_backend()
+
+
+def _gateway_sign(gateway_key, content):
+    return base64.b64encode(pkcs1_15.new(gateway_key).sign(SHA1.new(content.encode()))).decode()
+
+
+def test_sign_conformance(backends, sign_key):
+    first, second = (RsaUtil(private_key=wrap_private_key(sign_key), backend=backend) for backend in backends)
+    content = '/ui/cardbusiness/epaypc/consumption/V1?app_id=1000&biz_content=中国工商银行'
+    # PKCS#1 v1.5 signatures are deterministic
+    assert first.create_sign(content) == second.create_sign(content)
+
+
+def test_verify_conformance(backend, gateway_key):
+    verifier = RsaUtil(public_key=gateway_key.publickey().export_key().decode(), backend=backend)
+    signature = _gateway_sign(gateway_key, '"abc"')
+    assert verifier.verify_sign('"abc"', signature)
+    assert not verifier.verify_sign('"abd"', signature)
+    assert not verifier.verify_sign('"abc"', base64.b64encode(b'\0' * 128).decode())
+    assert not verifier.verify_sign('"abc"', base64.b64encode(b'short').decode())
+
+
+def test_icbc_public_key(backend):
+    assert RsaUtil(public_key=RsaUtil.ICBC_PUBLIC_KEY, backend=backend).public_key is not None
+
+
+def test_encrypted_private_key(backend, merchant_key):
+    pem = merchant_key.export_key(passphrase='secret', pkcs=8, protection='scryptAndAES128-CBC')
+    rsa_util = RsaUtil(private_key=pem, private_key_password='secret', backend=backend)
+    signature = rsa_util.create_sign('abc')
+    assert signature == RsaUtil(private_key=merchant_key.export_key(), backend=backend).create_sign('abc')
+    with pytest.raises(ValueError):
+        RsaUtil(private_key=pem, backend=backend)
+
+
+@pytest.mark.parametrize('plaintext', ('', 'a' * 16, '{"out_trade_no":"1"}', '中国工商银行' * 20))
+def test_aes_conformance(backends, encrypt_key, plaintext):
+    first, second = (AesCodec(encrypt_key, backend=backend) for backend in backends)
+    encrypted = first.encrypt(plaintext)
+    assert second.encrypt(plaintext) == encrypted
+    assert second.decrypt(encrypted) == plaintext
+
+
+@pytest.mark.parametrize('ciphertext', (
+    base64.b64encode(b'\0' * 16).decode(),  # invalid padding
+    base64.b64encode(b'\0' * 15).decode(),  # not a multiple of the block size
+))
+def test_aes_invalid(backend, encrypt_key, ciphertext):
+    with pytest.raises(ValueError):
+        AesCodec(encrypt_key, backend=backend).decrypt(ciphertext)
+
+
+def test_aes_invalid_key(backend):
+    with pytest.raises(ValueError):
+        AesCodec(base64.b64encode(b'short').decode(), backend=backend)
+
+
+@pytest.mark.usefixtures('crypto_backend')
+@pytest.mark.parametrize(('value', 'expected'), (
+    (None, PyCryptodomeBackend),
+    ('pycryptodome', PyCryptodomeBackend),
+    ('cryptography', CryptographyBackend),
+))
+def test_configure_crypto_backend(monkeypatch, value, expected):
+    if expected is CryptographyBackend:
+        pytest.importorskip('cryptography')
+    if value is None:
+        monkeypatch.delenv(crypto.CRYPTO_BACKEND_ENV_VAR, raising=False)
+    else:
+        monkeypatch.setenv(crypto.CRYPTO_BACKEND_ENV_VAR, value)
+    crypto.set_backend(None)
+    assert type(crypto.get_backend()) is expected
+    assert type(RsaUtil(public_key=RsaUtil.ICBC_PUBLIC_KEY).backend) is expected
+
+
+@pytest.mark.usefixtures('crypto_backend')
+def test_configure_crypto_backend_unknown(monkeypatch, caplog):
+    monkeypatch.setenv(crypto.CRYPTO_BACKEND_ENV_VAR, 'openssl')
+    crypto.set_backend(None)
+    crypto.configure_crypto_backend(logging.getLogger('icbc'))
+    assert type(crypto.get_backend()) is PyCryptodomeBackend
+    assert 'Cannot use the openssl crypto backend' in caplog.text
+    with pytest.raises(ValueError):
+        crypto.set_backend('openssl')
+
+
+def test_incomplete_backend():
+    class SignOnlyBackend(CryptoBackend):
+        def load_key(self, pem, passphrase=None):
+            pass
+
+        def sign_sha256(self, private_key, data):
+            pass
+
+    with pytest.raises(TypeError):
+        SignOnlyBackend()
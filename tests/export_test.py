@@ -0,0 +1,203 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import base64
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+import pytest
+from flask import request
+from werkzeug.exceptions import BadRequest
+
+from indico.modules.events.payment.models.transactions import PaymentTransaction, TransactionStatus
+
+from indico_payment_icbc.controllers import RHICBCExportTransactions
+from indico_payment_icbc.export import (EXPORT_COLUMNS, EXPORT_FORMATS, iter_csv, iter_export_rows, iter_jsonl,
+                                        query_transactions)
+from indico_payment_icbc.plugin import ICBCPaymentPlugin
+from indico_payment_icbc.util import AesCodec
+
+
+Record = namedtuple('Record', ('id', 'timestamp', 'status', 'amount', 'currency', 'data', 'event_id',
+                               'registration_id', 'friendly_id', 'email', 'first_name', 'last_name'))
+
+
+def _make_records(count):
+    biz_content = {'icbc_flag': '1', 'mer_id': '123', 'out_trade_no': '0001', 'amount': '10000'}
+    for i in range(count):
+        yield Record(i, datetime(2026, 10, 18, tzinfo=timezone.utc), TransactionStatus.rejected, Decimal('100.00'),
+                     'CNY', {'biz_content': json.dumps(biz_content)}, 1, i, i, f'{i}@example.com', 'Guinea', 'Pig')
+
+
+def _make_query(records):
+    query = MagicMock()
+    query.yield_per.return_value = records
+    return query
+
+
+def test_export_rows_are_streamed():
+    records = _make_records(10_000)
+    rows = iter_export_rows(_make_query(records), batch_size=100)
+    first = next(rows)
+    assert first['channel'] == 'domestic'
+    assert first['out_trade_no'] == '0001'
+    assert first['status'] == 'rejected'
+    # only the first batch has been consumed
+    assert len(list(records)) == 10_000 - 100
+
+
+BIZ_CONTENT = {'return_code': '0', 'mer_id': '123', 'out_trade_no': '0001', 'order_id': 'ICBC0001',
+               'total_amt': '10000', 'pay_status': '0', 'pay_time': '20261018120000'}
+
+
+def _make_response_record(transaction_id, response_biz_content, event_id=1):
+    # order queries only store the encrypted biz_content of the response
+    return Record(transaction_id, datetime(2026, 10, 18, tzinfo=timezone.utc), TransactionStatus.successful,
+                  Decimal('100.00'), 'CNY', {'response_biz_content': response_biz_content}, event_id, transaction_id,
+                  transaction_id, f'{transaction_id}@example.com', 'Guinea', 'Pig')
+
+
+def test_export_rows_encrypted(mocker, encrypt_key):
+    codec = AesCodec(encrypt_key)
+    get_codec = mocker.patch('indico_payment_icbc.export._get_event_codec',
+                             side_effect=lambda event_id: codec if event_id == 1 else None)
+    payload = codec.encrypt(json.dumps(BIZ_CONTENT))
+    # the event of the second transaction has no encrypt key anymore
+    records = [_make_response_record(0, payload), _make_response_record(1, payload, event_id=2),
+               _make_response_record(2, payload)]
+    rows = list(iter_export_rows(_make_query(records), batch_size=2))
+    assert [row['out_trade_no'] for row in rows] == ['0001', None, '0001']
+    assert {column: rows[0][column] for column in ('mer_id', 'order_id', 'total_amt', 'pay_status', 'pay_time')} == {
+        'mer_id': '123', 'order_id': 'ICBC0001', 'total_amt': '10000', 'pay_status': '0', 'pay_time': '20261018120000'
+    }
+    # the codec of an event is only looked up once
+    assert get_codec.call_count == 2
+
+
+@pytest.mark.parametrize('bad_payload', ('base64', 'padding', 'json'))
+def test_export_rows_bad_payload(mocker, encrypt_key, bad_payload):
+    codec = AesCodec(encrypt_key)
+    mocker.patch('indico_payment_icbc.export._get_event_codec', return_value=codec)
+    payloads = {'base64': 'not-base64', 'padding': base64.b64encode(b'\0' * 16).decode(),
+                'json': codec.encrypt('{"out_trade_no": ')}
+    payload = codec.encrypt(json.dumps(BIZ_CONTENT))
+    records = [_make_response_record(0, payload), _make_response_record(1, payloads[bad_payload]),
+               _make_response_record(2, payload)]
+    with ICBCPaymentPlugin.instance.plugin_context():
+        rows = list(iter_export_rows(_make_query(records)))
+    assert [row['transaction_id'] for row in rows] == [0, 1, 2]
+    assert [row['out_trade_no'] for row in rows] == ['0001', None, '0001']
+    assert rows[1]['email'] == '1@example.com'
+
+
+def test_iter_csv():
+    rows = list(iter_export_rows(_make_query(_make_records(3))))
+    output = ''.join(iter_csv(rows))
+    parsed = list(csv.DictReader(io.StringIO(output)))
+    assert len(parsed) == 3
+    assert list(parsed[0]) == list(EXPORT_COLUMNS)
+    assert parsed[2]['email'] == '2@example.com'
+
+
+@pytest.mark.parametrize(('value', 'expected'), (
+    ('=HYPERLINK("http://example.com","Pig")', '\'=HYPERLINK("http://example.com","Pig")'),
+    ('+1-555-0100', "'+1-555-0100"),
+    ('-2+3', "'-2+3"),
+    ('@SUM(A1:A2)', "'@SUM(A1:A2)"),
+    ('\t=1', "'\t=1"),
+    ('Guinea-Pig', 'Guinea-Pig'),
+    ('', ''),
+))
+def test_iter_csv_formulas(value, expected):
+    rows = list(iter_export_rows(_make_query(_make_records(1))))
+    rows[0].update(first_name=value, last_name=value, email=value, order_id=value, amount='-10.00')
+    parsed = next(csv.DictReader(io.StringIO(''.join(iter_csv(rows)))))
+    assert [parsed[column] for column in ('first_name', 'last_name', 'email', 'order_id')] == [expected] * 4
+    # only free-text columns are escaped
+    assert parsed['amount'] == '-10.00'
+    # the JSON Lines export is not meant for spreadsheets
+    assert json.loads(next(iter_jsonl(rows)))['first_name'] == value
+
+
+def test_iter_jsonl():
+    rows = list(iter_export_rows(_make_query(_make_records(3))))
+    lines = list(iter_jsonl(rows))
+    assert [json.loads(line)['transaction_id'] for line in lines] == [0, 1, 2]
+
+
+def _create_transaction(db, registration, status, timestamp, provider='icbc', out_trade_no='0001'):
+    transaction = PaymentTransaction(registration=registration, status=status, amount=Decimal('13.37'),
+                                     currency='CNY', provider=provider, timestamp=timestamp,
+                                     data={'biz_content': json.dumps({**BIZ_CONTENT, 'out_trade_no': out_trade_no})})
+    db.session.add(transaction)
+    db.session.flush()
+    return transaction
+
+
+@pytest.fixture
+def transactions(db, dummy_reg):
+    dt = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    return {
+        'rejected': _create_transaction(db, dummy_reg, TransactionStatus.rejected, dt),
+        'successful': _create_transaction(db, dummy_reg, TransactionStatus.successful, dt + timedelta(days=1),
+                                          out_trade_no='0002'),
+        'paypal': _create_transaction(db, dummy_reg, TransactionStatus.successful, dt + timedelta(days=1),
+                                      provider='paypal'),
+    }
+
+
+@pytest.mark.parametrize(('kwargs', 'expected'), (
+    ({}, ['rejected', 'successful']),
+    ({'statuses': [TransactionStatus.successful]}, ['successful']),
+    ({'statuses': [TransactionStatus.successful, TransactionStatus.rejected]}, ['rejected', 'successful']),
+    ({'start_dt': datetime(2026, 10, 2, tzinfo=timezone.utc)}, ['successful']),
+    ({'end_dt': datetime(2026, 10, 2, tzinfo=timezone.utc)}, ['rejected']),
+    ({'start_dt': datetime(2026, 10, 3, tzinfo=timezone.utc)}, []),
+))
+def test_query_transactions(transactions, kwargs, expected):
+    assert [row[0] for row in query_transactions(**kwargs)] == [transactions[name].id for name in expected]
+
+
+def test_query_transactions_event(dummy_reg, transactions):
+    assert query_transactions(event_id=dummy_reg.event_id).count() == 2
+    assert not query_transactions(event_id=dummy_reg.event_id + 1).count()
+
+
+def _export(app, event, format_, statuses):
+    with (app.test_request_context(query_string={'status': statuses}),
+          ICBCPaymentPlugin.instance.plugin_context()):
+        request.view_args = {'event_id': event.id, 'format': format_}
+        rh = RHICBCExportTransactions()
+        rh._process_args()
+        response = rh._process()
+        # the rows are streamed while the request context is still active
+        return response, response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize('format_', ('csv', 'jsonl'))
+def test_export_transactions(app, dummy_reg, transactions, format_):
+    response, body = _export(app, dummy_reg.event, format_, ['successful'])
+    assert response.mimetype == EXPORT_FORMATS[format_][1]
+    assert response.headers['Content-Disposition'] == (f'attachment; filename="icbc-transactions-'
+                                                       f'{dummy_reg.event_id}.{format_}"')
+    if format_ == 'csv':
+        rows = list(csv.DictReader(io.StringIO(body)))
+    else:
+        rows = [json.loads(line) for line in body.splitlines()]
+    assert [str(row['transaction_id']) for row in rows] == [str(transactions['successful'].id)]
+    assert rows[0]['out_trade_no'] == '0002'
+    assert rows[0]['status'] == 'successful'
+
+
+def test_export_transactions_invalid_status(app, dummy_reg, transactions):
+    with pytest.raises(BadRequest):
+        _export(app, dummy_reg.event, 'csv', ['paid'])
@@ -0,0 +1,179 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""A local stand-in for the ICBC open API gateway.
+
+It answers signed order queries like ``gw.open.icbc.com.cn`` does, and can
+send signed notifications to the plugin, with configurable latency and
+error rates.  Point the ``gateway_url`` plugin setting to it and set the
+``gateway_public_key`` setting to :attr:`FakeGateway.public_key`.
+"""
+
+import base64
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from Crypto.Hash import SHA1, SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+
+from indico_payment_icbc.client import ICBCGatewayClient
+from indico_payment_icbc.util import RsaUtil, get_aes_codec
+
+
+class FakeGateway:
+    """Fake ICBC gateway for one merchant.
+
+    :param merchant_public_key: the public key of the merchant's ``sign_key``
+                                (PEM), used to check the request signatures
+    :param encrypt_key: the merchant's ``encrypt_key``
+    :param gateway_key: the RSA key the gateway signs with, generated if
+                        omitted
+    :param latency: seconds (or a ``(min, max)`` range) each query takes
+    :param error_rate: the share of queries answered with HTTP 503
+    :param pay_status: the status of orders not registered with
+                       :meth:`set_order`
+    """
+
+    def __init__(self, *, merchant_public_key, encrypt_key, gateway_key=None, latency=0, error_rate=0,
+                 pay_status='0', host='127.0.0.1', port=0, seed=None):
+        self.merchant_key = RSA.import_key(merchant_public_key)
+        self.codec = get_aes_codec(encrypt_key)
+        self.gateway_key = gateway_key or RSA.generate(1024)
+        self.latency = latency if isinstance(latency, tuple) else (latency, latency)
+        self.error_rate = error_rate
+        self.pay_status = pay_status
+        self.orders = {}
+        self.stats = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def public_key(self):
+        return self.gateway_key.publickey().export_key().decode()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def set_order(self, out_trade_no, *, total_amt, pay_status='0', mer_id=None, latency=0, error=None):
+        """Set the state of an order returned by queries.
+
+        :param latency: additional seconds each query of the order takes
+        :param error: the HTTP status queries of the order are answered with
+        """
+        self.orders[out_trade_no] = {'total_amt': str(total_amt), 'pay_status': pay_status, 'mer_id': mer_id,
+                                     'latency': latency, 'error': error}
+
+    def sign(self, content):
+        # the gateway signs with SHA1withRSA
+        signature = pkcs1_15.new(self.gateway_key).sign(SHA1.new(content.encode()))
+        return base64.b64encode(signature).decode()
+
+    def build_notification(self, *, app_id, mer_id, out_trade_no, total_amt, pay_status='0'):
+        """Build the signed form data of a payment notification."""
+        biz_content = {'return_code': '0', 'return_msg': 'success', 'mer_id': mer_id, 'out_trade_no': out_trade_no,
+                       'order_id': f'ICBC{out_trade_no}', 'total_amt': str(total_amt), 'pay_status': pay_status,
+                       'pay_time': time.strftime('%Y%m%d%H%M%S'), 'cur_type': '001'}
+        form = {'from': 'icbc-api', 'api': '/api/cardbusiness/aggregatepay/b2c/online/consumepurchase/V1',
+                'app_id': app_id, 'charset': 'UTF-8', 'format': 'json', 'sign_type': 'RSA',
+                'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'biz_content': json.dumps(biz_content, separators=(',', ':'))}
+        form['sign'] = self.sign(RsaUtil.encrypt_str('/notifyUrlServlet', form))
+        return form
+
+    def notify(self, notify_url, *, session=None, timeout=30, **kwargs):
+        """Send a signed payment notification to the plugin.
+
+        :return: the :class:`requests.Response` of the plugin
+        """
+        form = self.build_notification(**kwargs)
+        return (session or requests).post(notify_url, data=form, timeout=timeout)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _handle_query(self, path, form):
+        low, high = self.latency
+        if high:
+            time.sleep(self._random.uniform(low, high))
+        if self.error_rate and self._random.random() < self.error_rate:
+            self._count('errors')
+            return 503, None
+        if path != ICBCGatewayClient.ORDER_QUERY_PATH:
+            self._count('not_found')
+            return 404, None
+        params = {k: v for k, v in form.items() if k != 'sign'}
+        try:
+            pkcs1_15.new(self.merchant_key).verify(SHA256.new(RsaUtil.encrypt_str(path, params).encode()),
+                                                   base64.b64decode(form.get('sign', '')))
+        except (ValueError, TypeError):
+            self._count('invalid_signature')
+            return 400, None
+        biz_content = json.loads(self.codec.decrypt(form['biz_content']))
+        out_trade_no = biz_content['out_trade_no']
+        order = self.orders.get(out_trade_no, {'pay_status': self.pay_status, 'total_amt': '0', 'mer_id': None})
+        if order.get('latency'):
+            time.sleep(order['latency'])
+        if order.get('error'):
+            self._count('errors')
+            return order['error'], None
+        response_biz_content = {'return_code': '0', 'return_msg': 'success', 'msg_id': form['msg_id'],
+                                'mer_id': order['mer_id'] or biz_content['mer_id'], 'out_trade_no': out_trade_no,
+                                'order_id': f'ICBC{out_trade_no}', 'pay_status': order['pay_status'],
+                                'total_amt': order['total_amt'], 'cur_type': '001'}
+        encrypted = self.codec.encrypt(json.dumps(response_biz_content, separators=(',', ':')))
+        self._count('queries')
+        return 200, {'response_biz_content': encrypted, 'sign_type': 'RSA', 'sign': self.sign(f'"{encrypted}"')}
+
+    def _make_handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                form = {k: v[0] for k, v in parse_qs(body).items()}
+                status, payload = gateway._handle_query(urlsplit(self.path).path, form)
+                data = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
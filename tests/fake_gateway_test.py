@@ -0,0 +1,73 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import json
+
+import pytest
+
+from indico_payment_icbc.client import ICBCGatewayClient, ICBCGatewayError
+from indico_payment_icbc.util import RsaUtil, get_icbc_verifier, verify_response_signature
+
+from fake_gateway import FakeGateway
+
+
+@pytest.fixture
+def gateway_factory(merchant_key, encrypt_key):
+    gateways = []
+
+    def _make_gateway(**kwargs):
+        gateway = FakeGateway(merchant_public_key=merchant_key.publickey().export_key(), encrypt_key=encrypt_key,
+                              seed=42, **kwargs)
+        gateways.append(gateway.start())
+        return gateway
+
+    yield _make_gateway
+    for gateway in gateways:
+        gateway.stop()
+
+
+def _make_client(merchant_key, encrypt_key, gateway, **kwargs):
+    sign_key = ''.join(merchant_key.export_key(pkcs=1).decode().splitlines()[1:-1])
+    return ICBCGatewayClient(app_id='app', mer_id='020001', mer_prtcl_no='prtcl', sign_key=sign_key,
+                             encrypt_key=encrypt_key, base_url=gateway.url, backoff=0, **kwargs)
+
+
+def test_query_order(merchant_key, encrypt_key, gateway_factory):
+    gateway = gateway_factory()
+    gateway.set_order('1234', total_amt=150000)
+    response = _make_client(merchant_key, encrypt_key, gateway).query_order('1234')
+    assert verify_response_signature(response, gateway.public_key)
+    assert not verify_response_signature(response)
+    biz_content = json.loads(response['biz_content'])
+    assert biz_content['pay_status'] == '0'
+    assert biz_content['total_amt'] == '150000'
+    assert gateway.stats == {'queries': 1}
+
+
+def test_query_order_wrong_signature(gateway_key, encrypt_key, gateway_factory):
+    gateway = gateway_factory()
+    with pytest.raises(ICBCGatewayError):
+        # signed with a key the gateway does not know
+        _make_client(gateway_key, encrypt_key, gateway, retries=0).query_order('1234')
+    assert gateway.stats == {'invalid_signature': 1}
+
+
+def test_query_order_errors(merchant_key, encrypt_key, gateway_factory):
+    gateway = gateway_factory(error_rate=1)
+    with pytest.raises(ICBCGatewayError):
+        _make_client(merchant_key, encrypt_key, gateway, retries=2).query_order('1234')
+    assert gateway.stats == {'errors': 3}
+
+
+def test_build_notification(merchant_key, encrypt_key, gateway_factory):
+    gateway = gateway_factory()
+    form = gateway.build_notification(app_id='app', mer_id='020001', out_trade_no='1234', total_amt=150000)
+    # verified the same way as the notify handler does it
+    params = {k: v for k, v in form.items() if k != 'sign'}
+    verifier = get_icbc_verifier(gateway.public_key)
+    assert verifier.verify_sign(RsaUtil.encrypt_str('/notifyUrlServlet', params), form['sign'])
+    assert json.loads(form['biz_content'])['out_trade_no'] == '1234'
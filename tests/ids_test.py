@@ -0,0 +1,84 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from indico_payment_icbc.ids import ID_LENGTH, NODE_ID_ENV_VAR, IDGenerator, get_node_id
+
+
+def _generate(generator, count):
+    return [generator.next_id() for __ in range(count)]
+
+
+def _generate_to_file(generator, count, path):
+    path.write_text('\n'.join(_generate(generator, count)))
+
+
+def test_ids_fit_icbc_fields():
+    id_ = IDGenerator(node_id=0xFFFF).next_id()
+    assert len(id_) == ID_LENGTH <= 35
+    assert id_.isdigit()
+
+
+def test_ids_increase():
+    ids = _generate(IDGenerator(1), 100_000)
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_ids_survive_clock_going_backwards():
+    times = iter([1800000000.005, 1800000000.001, 1800000000.001, 1799999999.0])
+    generator = IDGenerator(1, clock=lambda: next(times))
+    ids = _generate(generator, 4)
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 4
+
+
+def test_sequence_overflow_advances_timestamp():
+    generator = IDGenerator(1, clock=lambda: 1800000000.0)
+    ids = _generate(generator, 3 * 4096)
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_node_id_from_environment(monkeypatch):
+    monkeypatch.setenv(NODE_ID_ENV_VAR, '42')
+    assert get_node_id() == 42
+    monkeypatch.setenv(NODE_ID_ENV_VAR, '70000')
+    with pytest.raises(ValueError):
+        get_node_id()
+
+
+def test_concurrent_threads_no_duplicates():
+    generator = IDGenerator(1)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(_generate, [generator] * 8, [125_000] * 8))
+    ids = [id_ for result in results for id_ in result]
+    assert len(ids) == 1_000_000
+    assert len(set(ids)) == len(ids)
+    # every thread sees strictly increasing IDs
+    assert all(result == sorted(result) for result in results)
+
+
+def test_concurrent_processes_no_duplicates(tmp_path):
+    # forked workers share the generator state and only differ by their pid
+    generator = IDGenerator(1)
+    generator.next_id()
+    ctx = multiprocessing.get_context('fork')
+    paths = [tmp_path / f'ids-{i}.txt' for i in range(4)]
+    processes = [ctx.Process(target=_generate_to_file, args=(generator, 250_000, path)) for path in paths]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    ids = [id_ for path in paths for id_ in path.read_text().split('\n')]
+    assert len(ids) == 1_000_000
+    assert len(set(ids)) == len(ids)
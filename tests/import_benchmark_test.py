@@ -0,0 +1,44 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import subprocess
+import sys
+
+import pytest
+
+
+pytest.importorskip('pytest_benchmark')
+
+# libraries which must only be loaded once a payment is signed or the gateway is called
+LAZY_MODULES = {'Crypto', 'cryptography', 'requests'}
+
+
+def _import(module):
+    """Import a module in a fresh interpreter and return the lazy libraries it loaded."""
+    code = (f'import sys, {module}\n'
+            f'print(*{{name.partition(".")[0] for name in sys.modules}} & {LAZY_MODULES!r})')
+    return set(subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout.split())
+
+
+@pytest.mark.benchmark(group='icbc-import')
+@pytest.mark.parametrize('module', (
+    # the interpreter startup and the Indico modules the package needs, as a baseline
+    'indico_payment_icbc',
+    'indico_payment_icbc.crypto',
+    'indico_payment_icbc.util',
+    'indico_payment_icbc.client',
+))
+def test_import_time(benchmark, module):
+    assert benchmark.pedantic(_import, (module,), rounds=5, iterations=1) <= _import('indico_payment_icbc')
+
+
+@pytest.mark.benchmark(group='icbc-import')
+@pytest.mark.parametrize('module', ('indico_payment_icbc.plugin', 'indico_payment_icbc.controllers'))
+def test_import_time_plugin(benchmark, module):
+    pytest.importorskip('indico.web.rh')
+    # Indico itself may use requests, but nothing it loads uses PyCryptodome
+    assert 'Crypto' not in benchmark.pedantic(_import, (module,), rounds=5, iterations=1)
@@ -0,0 +1,155 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+"""Load scenarios for the notify and success flows against the fake gateway.
+
+Configure a development Indico with the ``gateway_url`` and
+``gateway_public_key`` printed by ``serve`` and run the scenarios with a
+targets file containing one JSON object per line with the ``notify_url`` or
+``success_url`` of a registration and the ``mer_id``, ``out_trade_no`` and
+``total_amt`` (in fen) of one of its orders::
+
+    python tests/load_scenarios.py --merchant-key merchant.pem --encrypt-key KEY \\
+        --gateway-key gateway.pem serve
+    python tests/load_scenarios.py ... notify targets.jsonl --concurrency 32
+    python tests/load_scenarios.py ... --latency 0.05 0.5 success targets.jsonl
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle, islice
+
+import requests
+from Crypto.PublicKey import RSA
+from requests.adapters import HTTPAdapter
+
+from fake_gateway import FakeGateway
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, round(percent / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run_scenario(targets, send, *, requests_count, concurrency):
+    """Run ``send`` for the targets and report throughput and latency.
+
+    :param send: a function sending one request for a target using the
+                 given session and returning the HTTP status code
+    :return: a dict with the results
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    statuses = Counter()
+
+    def _run(target):
+        start = time.perf_counter()
+        try:
+            status = send(session, target)
+        except requests.RequestException as exc:
+            status = type(exc).__name__
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_run, islice(cycle(targets), requests_count)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, __ in results)
+    statuses.update(status for __, status in results)
+    return {
+        'requests': len(results),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 1),
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies) * 1000, 1),
+            **{f'p{p}': round(_percentile(latencies, p) * 1000, 1) for p in (50, 90, 99)},
+            'max': round(latencies[-1] * 1000, 1),
+        },
+        'statuses': dict(statuses),
+    }
+
+
+def notify_scenario(gateway, targets, *, app_id, **kwargs):
+    """Payment notifications sent by the gateway to ``/notify``."""
+    # signing is not part of what we measure
+    notifications = [(target['notify_url'],
+                      gateway.build_notification(app_id=app_id, mer_id=target['mer_id'],
+                                                 out_trade_no=target['out_trade_no'], total_amt=target['total_amt']))
+                     for target in targets]
+
+    def _send(session, notification):
+        url, form = notification
+        return session.post(url, data=form, timeout=60).status_code
+
+    return run_scenario(notifications, _send, **kwargs)
+
+
+def success_scenario(gateway, targets, **kwargs):
+    """Payers coming back to ``/success``, which queries the gateway."""
+    for target in targets:
+        gateway.set_order(target['out_trade_no'], total_amt=target['total_amt'], mer_id=target['mer_id'])
+
+    def _send(session, target):
+        return session.get(target['success_url'], allow_redirects=False, timeout=60).status_code
+
+    return run_scenario(targets, _send, **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--merchant-key', required=True, type=argparse.FileType('r'),
+                        help='PEM file of the merchant key (its public part is enough)')
+    parser.add_argument('--encrypt-key', required=True, help='the encrypt_key of the merchant')
+    parser.add_argument('--gateway-key', type=argparse.FileType('r'),
+                        help='PEM file of the key the gateway signs with; generated if omitted')
+    parser.add_argument('--app-id', default='10000000000000000000')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, nargs='+', default=[0], metavar='SECONDS',
+                        help='gateway latency, or a min and max for a random one')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of gateway queries failing with 503')
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+    subparsers.add_parser('serve', help='only run the fake gateway')
+    for name in ('notify', 'success'):
+        subparser = subparsers.add_parser(name, help=globals()[f'{name}_scenario'].__doc__)
+        subparser.add_argument('targets', type=argparse.FileType('r'))
+        subparser.add_argument('--requests', type=int, default=1000, dest='requests_count')
+        subparser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args(argv)
+
+    gateway = FakeGateway(merchant_public_key=RSA.import_key(args.merchant_key.read()).publickey().export_key(),
+                          encrypt_key=args.encrypt_key,
+                          gateway_key=RSA.import_key(args.gateway_key.read()) if args.gateway_key else None,
+                          latency=tuple(args.latency) if len(args.latency) > 1 else args.latency[0],
+                          error_rate=args.error_rate, port=args.port)
+    with gateway:
+        print(f'Fake ICBC gateway listening on {gateway.url}', file=sys.stderr)
+        if args.scenario == 'serve':
+            print(gateway.public_key)
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                return
+        targets = [json.loads(line) for line in args.targets if line.strip()]
+        kwargs = {'requests_count': args.requests_count, 'concurrency': args.concurrency}
+        if args.scenario == 'notify':
+            result = notify_scenario(gateway, targets, app_id=args.app_id, **kwargs)
+        else:
+            result = success_scenario(gateway, targets, **kwargs)
+        result['gateway'] = dict(gateway.stats)
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
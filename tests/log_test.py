@@ -0,0 +1,71 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import json
+import logging
+
+import pytest
+
+from indico_payment_icbc.log import MAX_VALUE_LENGTH, REDACTED, LogFields, Redacted, log_event, redact
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger('indico_payment_icbc_test')
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+class Exploding:
+    def __str__(self):
+        raise AssertionError('formatted although the level is disabled')
+
+    __repr__ = __str__
+
+
+def test_redact():
+    data = {'sign': 'abc', 'biz_content': {'encrypt_key': 'secret', 'mer_id': '020001'},
+            'items': [{'sign_key': 'x'}], 'response_biz_content': 'a' * 1000}
+    redacted = redact(data)
+    assert redacted['sign'] == REDACTED
+    assert redacted['biz_content'] == {'encrypt_key': REDACTED, 'mer_id': '020001'}
+    assert redacted['items'] == [{'sign_key': REDACTED}]
+    assert redacted['response_biz_content'] == f'{"a" * MAX_VALUE_LENGTH}...[1000 chars]'
+    # the original data is left alone
+    assert data['sign'] == 'abc'
+
+
+def test_log_event(caplog, logger):
+    with caplog.at_level(logging.INFO, logger.name):
+        log_event(logger, logging.INFO, 'icbc_test', form={'sign': 'abc', 'app_id': '1'})
+    record, = caplog.records
+    assert record.icbc_event == 'icbc_test'
+    assert record.icbc_fields.as_dict() == {'event': 'icbc_test', 'form': {'sign': REDACTED, 'app_id': '1'}}
+    event, fields = record.getMessage().split(' ', 1)
+    assert event == 'icbc_test'
+    assert json.loads(fields) == {'form': {'sign': REDACTED, 'app_id': '1'}}
+
+
+def test_log_event_disabled(caplog, logger):
+    with caplog.at_level(logging.INFO, logger.name):
+        log_event(logger, logging.DEBUG, 'icbc_test', data=Exploding())
+    assert not caplog.records
+
+
+def test_log_event_sampled(caplog, logger, monkeypatch):
+    monkeypatch.setattr('indico_payment_icbc.log.random.random', iter([0.05, 0.5, 0.09]).__next__)
+    with caplog.at_level(logging.INFO, logger.name):
+        for i in range(3):
+            log_event(logger, logging.INFO, 'icbc_test', sample=0.1, i=i)
+    assert [record.icbc_fields.fields['i'] for record in caplog.records] == [0, 2]
+
+
+def test_lazy_formatting():
+    # nothing is redacted or serialized before formatting
+    assert LogFields('icbc_test', {'data': Exploding()}).fields
+    assert Redacted(Exploding()).value
+    assert str(Redacted({'sign': 'abc'})) == str({'sign': REDACTED})
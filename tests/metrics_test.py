@@ -0,0 +1,104 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import pytest
+
+from indico_payment_icbc import metrics
+from indico_payment_icbc.util import AesCodec
+
+
+class RecordingExporter(metrics.MetricsExporter):
+    def __init__(self):
+        self.observed = []
+        self.counted = []
+
+    def observe(self, name, value, labels):
+        self.observed.append((name, labels))
+
+    def inc(self, name, labels, amount=1):
+        self.counted.append((name, labels, amount))
+
+
+@pytest.fixture
+def exporter():
+    exporter = RecordingExporter()
+    metrics.set_exporter(exporter)
+    yield exporter
+    metrics.set_exporter(None)
+
+
+def test_disabled():
+    assert metrics.get_exporter() is None
+    # nothing to do, and the no-op timer is shared
+    assert metrics.timer('icbc_handler_seconds', handler='notify') is metrics.timer('icbc_crypto_seconds')
+    metrics.inc('icbc_duplicate_payments_total')
+    assert metrics.timed('icbc_crypto_seconds', operation='test')(lambda x: x * 2)(21) == 42
+
+
+def test_timer(exporter):
+    with metrics.timer('icbc_handler_seconds', handler='notify'):
+        pass
+    with pytest.raises(ValueError), metrics.timer('icbc_handler_seconds', handler='success'):
+        raise ValueError
+    assert exporter.observed == [('icbc_handler_seconds', {'handler': 'notify'}),
+                                 ('icbc_handler_seconds', {'handler': 'success'})]
+
+
+def test_timed_crypto(exporter, encrypt_key):
+    codec = AesCodec(encrypt_key)
+    assert codec.decrypt(codec.encrypt('test')) == 'test'
+    assert exporter.observed == [('icbc_crypto_seconds', {'operation': 'aes_encrypt'}),
+                                 ('icbc_crypto_seconds', {'operation': 'aes_decrypt'})]
+
+
+def test_incomplete_exporter():
+    class HistogramExporter(metrics.MetricsExporter):
+        def observe(self, name, value, labels):
+            pass
+
+    with pytest.raises(TypeError):
+        HistogramExporter()
+    assert RecordingExporter().render() is None
+
+
+def test_inc(exporter):
+    metrics.inc('icbc_payment_status_total', status='0')
+    metrics.inc('icbc_duplicate_payments_total', 2)
+    assert exporter.counted == [('icbc_payment_status_total', {'status': '0'}, 1),
+                                ('icbc_duplicate_payments_total', {}, 2)]
+
+
+def test_configure_metrics(monkeypatch):
+    monkeypatch.delenv(metrics.METRICS_ENV_VAR, raising=False)
+    metrics.configure_metrics()
+    assert metrics.get_exporter() is None
+    # an explicitly set exporter is kept
+    exporter = RecordingExporter()
+    metrics.set_exporter(exporter)
+    monkeypatch.setenv(metrics.METRICS_ENV_VAR, '1')
+    try:
+        metrics.configure_metrics()
+        assert metrics.get_exporter() is exporter
+    finally:
+        metrics.set_exporter(None)
+
+
+def test_prometheus_exporter(monkeypatch):
+    prometheus_client = pytest.importorskip('prometheus_client')
+    monkeypatch.delenv('PROMETHEUS_MULTIPROC_DIR', raising=False)
+    registry = prometheus_client.CollectorRegistry()
+    exporter = metrics.PrometheusExporter(registry)
+    exporter.observe('icbc_crypto_seconds', 0.002, {'operation': 'sign'})
+    exporter.inc('icbc_payment_status_total', {'status': '0'})
+    exporter.inc('icbc_amount_mismatches_total', {})
+    assert registry.get_sample_value('icbc_crypto_seconds_count', {'operation': 'sign'}) == 1
+    assert registry.get_sample_value('icbc_crypto_seconds_bucket', {'operation': 'sign', 'le': '0.0025'}) == 1
+    assert registry.get_sample_value('icbc_payment_status_total', {'status': '0'}) == 1
+    assert registry.get_sample_value('icbc_amount_mismatches_total') == 1
+    body, content_type = exporter.render()
+    assert content_type.startswith('text/plain')
+    assert b'icbc_signature_failures_total' in body
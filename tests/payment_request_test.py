@@ -0,0 +1,73 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from unittest.mock import MagicMock
+from urllib.parse import urlparse
+
+import pytest
+
+from indico.core.config import config
+
+from indico_payment_icbc.payment_request import (PaymentRequestTemplate, clear_request_template_cache,
+                                                 get_request_template)
+from indico_payment_icbc.util import RsaUtil
+
+
+URL = 'https://gw.open.icbc.com.cn/ui/cardbusiness/epaypc/consumption/V1'
+URL_FOREIGN = 'https://gw.open.icbc.com.cn/ui/cardbusiness/aggregatepay/b2c/online/ui/foreignpay/V1'
+
+
+@pytest.fixture
+def template():
+    return PaymentRequestTemplate(url=URL, url_foreign=URL_FOREIGN, app_id='10000000000004095503',
+                                  mer_reference='indico.example.com', logo_url='/logo.png')
+
+
+@pytest.fixture
+def template_cache(mocker):
+    mocker.patch('indico_payment_icbc.payment_request.url_for_plugin', return_value='/logo.png')
+    clear_request_template_cache()
+    yield
+    clear_request_template_cache()
+
+
+@pytest.mark.parametrize(('channel', 'url'), (
+    ('domestic', URL),
+    ('foreign', URL_FOREIGN),
+))
+def test_sign_content(template, channel, url):
+    fields = template.build_fields('ZW5jcnlwdGVk', 1700000000)
+    assert fields['app_id'] == '10000000000004095503'
+    assert fields['sign_type'] == 'RSA2'
+    assert template.actions[channel] == url
+    # same as the generic (sorting) canonicalization
+    assert template.get_sign_content(channel, fields) == RsaUtil.encrypt_str(urlparse(url).path, fields)
+
+
+def test_build_fields(template):
+    first = template.build_fields('a', 1700000000)
+    second = template.build_fields('b', 1700000000)
+    assert first['msg_id'] != second['msg_id']
+    assert first['biz_content'] == 'a'
+    assert 'msg_id' not in template.common_fields
+
+
+def test_immutable(template):
+    with pytest.raises(AttributeError):
+        template.logo_url = '/other.png'
+
+
+@pytest.mark.usefixtures('template_cache')
+def test_get_request_template():
+    event = MagicMock(id=1)
+    template = get_request_template(event, url=URL, url_foreign=URL_FOREIGN, app_id='1')
+    assert get_request_template(event, url=URL, url_foreign=URL_FOREIGN, app_id='1') is template
+    assert template.mer_reference == urlparse(config.BASE_URL).hostname
+    # changed settings and other events get their own template
+    assert get_request_template(event, url=URL, url_foreign=URL_FOREIGN, app_id='2') is not template
+    assert get_request_template(event, url=URL_FOREIGN, url_foreign=URL_FOREIGN, app_id='1') is not template
+    assert get_request_template(MagicMock(id=2), url=URL, url_foreign=URL_FOREIGN, app_id='1') is not template
@@ -0,0 +1,66 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from indico_payment_icbc.plugin import ICBCPaymentPlugin
+
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.fixture(scope='module')
+def event_settings(sign_key, encrypt_key):
+    return {'app_id': '10000000000004095503', 'mer_id': '020001020001', 'mer_prtcl_no': '0200010200010201',
+            'sign_key': sign_key, 'encrypt_key': encrypt_key,
+            'allowed_registration_form_ids': '', 'disallowed_registration_form_ids': '',
+            'completed_registration_form_id': None, 'uncompleted_registration_form_id': None,
+            'custom_payment_name': ''}
+
+
+@pytest.fixture
+def registration():
+    registration = MagicMock(registration_form_id=2, email='guinea.pig@example.com', price=1500)
+    registration.locator.uuid = {'event_id': 1, 'reg_form_id': 2, 'token': 'f' * 36}
+    return registration
+
+
+@pytest.fixture
+def plugin(mocker, event_settings):
+    plugin = ICBCPaymentPlugin.instance
+    mocker.patch.object(plugin.settings, 'get_all', return_value=ICBCPaymentPlugin.default_settings)
+    mocker.patch.object(plugin.settings, 'get', side_effect=ICBCPaymentPlugin.default_settings.get)
+    mocker.patch.object(plugin.event_settings, 'get_all', return_value=event_settings)
+    with plugin.plugin_context():
+        yield plugin
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.benchmark(group='icbc-payment-form')
+def test_adjust_payment_form_data(benchmark, plugin, event_settings, registration):
+    def _run():
+        data = {'event_settings': event_settings, 'registration': registration}
+        plugin.adjust_payment_form_data(data)
+        return data
+
+    data = benchmark(_run)
+    assert data['payment_allowed']
+    assert data['sign_url'].endswith('/icbc/sign?token=' + 'f' * 36)
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.benchmark(group='icbc-payment-form')
+def test_build_payment_request(benchmark, mocker, plugin, event_settings, registration):
+    biz_content = {'icbc_flag': '1', 'icbc_appid': event_settings['app_id'], 'out_trade_no': '1' * 28,
+                   'amount': '150000', 'mer_id': event_settings['mer_id'],
+                   'mer_prtcl_no': event_settings['mer_prtcl_no'], 'mer_order_remark': 'x' * 150}
+    mocker.patch.object(plugin, '_get_open_order', return_value=biz_content)
+    request = benchmark(plugin.build_payment_request, registration, 'domestic')
+    assert request['action'] == ICBCPaymentPlugin.default_settings['url']
+    assert request['fields']['sign']
@@ -0,0 +1,104 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import json
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+
+from indico.modules.events.payment.models.transactions import TransactionStatus
+from indico.util.date_time import now_utc
+
+from indico_payment_icbc.payment_request import clear_request_template_cache
+from indico_payment_icbc.plugin import ORDER_REUSE_MARGIN, ICBCPaymentPlugin
+from indico_payment_icbc.util import AesCodec
+
+
+@pytest.fixture
+def registration(dummy_reg, sign_key, encrypt_key):
+    ICBCPaymentPlugin.event_settings.set_multi(dummy_reg.event, {
+        'app_id': '10000000000004095503', 'mer_id': '020001', 'mer_prtcl_no': '0200010200010201',
+        'sign_key': sign_key, 'encrypt_key': encrypt_key,
+    })
+    dummy_reg.base_price = Decimal('13.37')
+    clear_request_template_cache()
+    yield dummy_reg
+    clear_request_template_cache()
+
+
+@pytest.fixture
+def build_payment_request(encrypt_key):
+    def _build_payment_request(registration, channel='domestic'):
+        with ICBCPaymentPlugin.instance.plugin_context():
+            fields = ICBCPaymentPlugin.instance.build_payment_request(registration, channel)['fields']
+        return json.loads(AesCodec(encrypt_key).decrypt(fields['biz_content']))
+
+    return _build_payment_request
+
+
+@pytest.mark.usefixtures('request_context')
+def test_create_order(registration, build_payment_request):
+    biz_content = build_payment_request(registration)
+    order = registration.icbc_orders.one()
+    assert order.out_trade_no == biz_content['out_trade_no']
+    assert (order.mer_id, order.channel, order.amount) == ('020001', 'domestic', Decimal('13.37'))
+    assert biz_content['amount'] == '1337'
+    # the order is recorded as a rejected transaction so the registration stays unpaid
+    assert order.transaction == registration.transaction
+    assert registration.transaction.status == TransactionStatus.rejected
+    assert not registration.is_paid
+    assert order.biz_content == biz_content
+
+
+@pytest.mark.usefixtures('request_context')
+def test_reuse_open_order(registration, build_payment_request):
+    biz_content = build_payment_request(registration)
+    assert build_payment_request(registration) == biz_content
+    assert registration.icbc_orders.count() == 1
+
+
+@pytest.mark.usefixtures('request_context')
+def test_reuse_open_order_channel(registration, build_payment_request):
+    domestic = build_payment_request(registration, 'domestic')
+    foreign = build_payment_request(registration, 'foreign')
+    assert foreign['out_trade_no'] != domestic['out_trade_no']
+    # each channel keeps its own open order
+    assert build_payment_request(registration, 'domestic') == domestic
+    assert build_payment_request(registration, 'foreign') == foreign
+    assert registration.icbc_orders.count() == 2
+
+
+@pytest.mark.usefixtures('request_context')
+def test_reuse_open_order_price_changed(registration, build_payment_request):
+    biz_content = build_payment_request(registration)
+    registration.base_price = Decimal('20')
+    new_biz_content = build_payment_request(registration)
+    assert new_biz_content['out_trade_no'] != biz_content['out_trade_no']
+    assert new_biz_content['amount'] == '2000'
+    assert registration.icbc_orders.count() == 2
+
+
+@pytest.mark.usefixtures('request_context')
+@pytest.mark.parametrize(('expires_in', 'reused'), (
+    (timedelta(seconds=ORDER_REUSE_MARGIN + 60), True),
+    # the payer would not have enough time left to pay it
+    (timedelta(seconds=ORDER_REUSE_MARGIN - 60), False),
+    (-timedelta(minutes=1), False),
+))
+def test_reuse_open_order_expiry(registration, build_payment_request, expires_in, reused):
+    biz_content = build_payment_request(registration)
+    registration.icbc_orders.one().expires_dt = now_utc() + expires_in
+    assert (build_payment_request(registration)['out_trade_no'] == biz_content['out_trade_no']) == reused
+
+
+@pytest.mark.usefixtures('request_context')
+def test_reuse_open_order_paid(registration, build_payment_request):
+    biz_content = build_payment_request(registration)
+    order = registration.icbc_orders.one()
+    order.paid_transaction = order.transaction
+    assert build_payment_request(registration)['out_trade_no'] != biz_content['out_trade_no']
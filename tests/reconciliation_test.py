@@ -0,0 +1,180 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+
+from indico.modules.events.payment.models.transactions import PaymentTransaction, TransactionStatus
+from indico.modules.events.registration.models.registrations import RegistrationState
+from indico.util.date_time import now_utc
+
+from indico_payment_icbc import reconciliation
+from indico_payment_icbc.plugin import ICBCPaymentPlugin
+from indico_payment_icbc.reconciliation import find_unreconciled_orders, reconcile_orders
+from indico_payment_icbc.tasks import reconcile_pending_orders
+
+from fake_gateway import FakeGateway
+
+
+@pytest.fixture
+def create_order(create_icbc_order, dummy_reg):
+    def _create_order(age, status_delay=None, out_trade_no='1'):
+        order = create_icbc_order(dummy_reg, out_trade_no, created_dt=now_utc() - age)
+        if status_delay is not None:
+            # the unpaid status was last reported this long after the order expired
+            order.status = '2'
+            order.status_dt = order.expires_dt + status_delay
+        return order
+
+    return _create_order
+
+
+@pytest.mark.parametrize(('age', 'expected'), (
+    (timedelta(minutes=5), False),
+    (timedelta(minutes=20), True),
+    (timedelta(days=3), False),
+))
+def test_find_unreconciled_orders_window(create_order, age, expected):
+    order = create_order(age)
+    assert (order in find_unreconciled_orders(grace_period=None)) == expected
+
+
+@pytest.mark.parametrize(('age', 'status_delay', 'grace_period', 'expected'), (
+    # expired 15 minutes ago
+    (timedelta(minutes=30), None, timedelta(hours=1), True),
+    (timedelta(minutes=30), -timedelta(minutes=5), timedelta(hours=1), True),
+    # ICBC reported it as unpaid after it expired, so it cannot be paid anymore
+    (timedelta(minutes=30), timedelta(minutes=5), timedelta(hours=1), False),
+    (timedelta(minutes=30), timedelta(minutes=5), None, False),
+    # expired almost 3 hours ago
+    (timedelta(hours=3), None, timedelta(hours=1), False),
+    (timedelta(hours=3), -timedelta(minutes=5), timedelta(hours=1), False),
+    (timedelta(hours=3), None, None, True),
+))
+def test_find_unreconciled_orders_expired(create_order, age, status_delay, grace_period, expected):
+    order = create_order(age, status_delay)
+    assert (order in find_unreconciled_orders(grace_period=grace_period)) == expected
+
+
+@pytest.mark.parametrize(('status', 'expected'), (
+    (None, True),
+    (TransactionStatus.rejected, True),
+    (TransactionStatus.successful, False),
+    (TransactionStatus.pending, False),
+))
+def test_find_unreconciled_orders_paid_registration(create_order, dummy_reg, status, expected):
+    if status is not None:
+        dummy_reg.transaction = PaymentTransaction(registration=dummy_reg, status=status, amount=100,
+                                                   currency='USD', provider='icbc', data={})
+    order = create_order(timedelta(minutes=20))
+    assert (order in find_unreconciled_orders()) == expected
+
+
+def test_find_unreconciled_orders_batches(create_order, count_queries):
+    orders = [create_order(timedelta(minutes=20), out_trade_no=str(i)) for i in range(5)]
+    found = find_unreconciled_orders(batch_size=2)
+    with count_queries() as count:
+        assert next(found) == orders[0]
+    assert count() == 1
+    assert [orders[0], *found] == orders
+
+
+@pytest.fixture
+def gateway(mocker, dummy_reg, merchant_key, gateway_key, sign_key, encrypt_key):
+    # registering the payment would email the registrant
+    mocker.patch('indico.modules.events.payment.util.notify_registration_state_update')
+    dummy_reg.base_price = Decimal('13.37')
+    dummy_reg.state = RegistrationState.unpaid
+    with FakeGateway(merchant_public_key=merchant_key.publickey().export_key(), encrypt_key=encrypt_key,
+                     gateway_key=gateway_key) as gateway:
+        ICBCPaymentPlugin.settings.set_multi({'gateway_url': gateway.url, 'gateway_public_key': gateway.public_key})
+        ICBCPaymentPlugin.event_settings.set_multi(dummy_reg.event, {
+            'app_id': 'app', 'mer_id': '020001', 'mer_prtcl_no': 'prtcl', 'sign_key': sign_key,
+            'encrypt_key': encrypt_key,
+        })
+        yield gateway
+
+
+def _reconcile(orders, **kwargs):
+    with ICBCPaymentPlugin.instance.plugin_context():
+        return reconcile_orders(orders, **kwargs)
+
+
+def test_reconcile_orders_paid(mocker, dummy_reg, create_order, gateway):
+    register = mocker.spy(reconciliation, 'register_payment')
+    order = create_order(timedelta(minutes=20))
+    other = create_order(timedelta(minutes=20), out_trade_no='2')
+    gateway.set_order('1', total_amt=1337)
+    gateway.set_order('2', total_amt=1337)
+    # the second paid order of the registration is not registered again
+    assert _reconcile([order, other]) == {'paid': 1, 'duplicate': 1}
+    register.assert_called_once()
+    assert dummy_reg.is_paid
+    assert order.paid_transaction == dummy_reg.transaction
+    assert order.status == '0'
+    assert not other.is_paid
+
+
+@pytest.mark.parametrize(('order_state', 'outcome', 'status'), (
+    ({'pay_status': '2'}, 'unpaid', '2'),
+    ({'error': 503}, 'failed', None),
+))
+def test_reconcile_orders_not_paid(mocker, dummy_reg, create_order, gateway, order_state, outcome, status):
+    register = mocker.spy(reconciliation, 'register_payment')
+    order = create_order(timedelta(minutes=20))
+    gateway.set_order('1', total_amt=1337, **order_state)
+    assert _reconcile([order]) == {outcome: 1}
+    assert order.status == status
+    assert not register.called
+    assert not dummy_reg.is_paid
+
+
+def test_reconcile_orders_invalid_signature(mocker, dummy_reg, merchant_key, create_order, gateway):
+    register = mocker.spy(reconciliation, 'register_payment')
+    ICBCPaymentPlugin.settings.set('gateway_public_key', merchant_key.publickey().export_key().decode())
+    order = create_order(timedelta(minutes=20))
+    gateway.set_order('1', total_amt=1337)
+    assert _reconcile([order]) == {'invalid': 1}
+    assert order.status is None
+    assert not register.called
+    assert not dummy_reg.is_paid
+
+
+@pytest.mark.parametrize(('pay_status', 'outcome'), (('0', 'paid'), ('2', 'unpaid')))
+def test_reconcile_orders_dry_run(mocker, dummy_reg, create_order, gateway, pay_status, outcome):
+    register = mocker.spy(reconciliation, 'register_payment')
+    order = create_order(timedelta(minutes=20))
+    gateway.set_order('1', total_amt=1337, pay_status=pay_status)
+    assert _reconcile([order], dry_run=True) == {outcome: 1}
+    assert order.status is None
+    assert order.status_dt is None
+    assert not register.called
+    assert not dummy_reg.is_paid
+
+
+def test_reconcile_orders_no_keys(dummy_reg, create_order, gateway):
+    ICBCPaymentPlugin.event_settings.set(dummy_reg.event, 'sign_key', '')
+    order = create_order(timedelta(minutes=20))
+    assert _reconcile([order]) == {'skipped': 1}
+    assert not gateway.stats['queries']
+    assert order.status is None
+
+
+def test_reconcile_pending_orders(dummy_reg, create_order, gateway):
+    order = create_order(timedelta(minutes=20))
+    recent = create_order(timedelta(minutes=5), out_trade_no='2')
+    gateway.set_order('1', total_amt=1337)
+    gateway.set_order('2', total_amt=1337)
+    with ICBCPaymentPlugin.instance.plugin_context():
+        # the task itself, without the lock preventing concurrent runs of the periodic task
+        reconcile_pending_orders.run.__wrapped__()
+    assert order.paid_transaction == dummy_reg.transaction
+    # recent orders are left to the payer's browser and the notify callback
+    assert gateway.stats['queries'] == 1
+    assert recent.status is None
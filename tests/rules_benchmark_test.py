@@ -0,0 +1,50 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import random
+
+import pytest
+
+from indico.modules.events.registration.models.registrations import RegistrationState
+
+from indico_payment_icbc.rules import PaymentRules, get_payment_rules
+
+
+pytest.importorskip('pytest_benchmark')
+
+SETTINGS = {'allowed_registration_form_ids': '[' + ', '.join(map(str, range(1, 40))) + ']',
+            'disallowed_registration_form_ids': '[3, 5, 7]',
+            'completed_registration_form_id': 100,
+            'uncompleted_registration_form_id': 101}
+
+
+@pytest.fixture(scope='module')
+def registrations():
+    rnd = random.Random(42)
+    states = [RegistrationState.complete, RegistrationState.unpaid]
+    return [(rnd.randint(1, 45), {100: [rnd.choice(states)], 101: [rnd.choice(states)][:rnd.randint(0, 1)]})
+            for __ in range(5000)]
+
+
+@pytest.mark.benchmark(group='payment-rules')
+def test_rules_compiled_per_call(benchmark, registrations):
+    def _run():
+        for form_id, related_states in registrations:
+            rules = PaymentRules.from_settings(SETTINGS)
+            rules.check_form(form_id) or rules.check_related(form_id, related_states)
+
+    benchmark(_run)
+
+
+@pytest.mark.benchmark(group='payment-rules')
+def test_rules_cached(benchmark, registrations):
+    def _run():
+        for form_id, related_states in registrations:
+            rules = get_payment_rules(SETTINGS)
+            rules.check_form(form_id) or rules.check_related(form_id, related_states)
+
+    benchmark(_run)
@@ -0,0 +1,120 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import pytest
+
+from indico.modules.events.registration.models.forms import RegistrationForm
+from indico.modules.events.registration.models.registrations import Registration, RegistrationState
+
+from indico_payment_icbc.rules import (MESSAGE_FORM_NOT_ALLOWED, MESSAGE_MULTIPLE_RELATED, MESSAGE_NO_RELATED,
+                                       MESSAGE_RELATED_COMPLETED, MESSAGE_RELATED_NOT_COMPLETED, PaymentRules,
+                                       get_payment_rules, get_related_registration_states)
+
+
+def _settings(allowed='', disallowed='', completed=None, uncompleted=None):
+    return {'allowed_registration_form_ids': allowed, 'disallowed_registration_form_ids': disallowed,
+            'completed_registration_form_id': completed, 'uncompleted_registration_form_id': uncompleted}
+
+
+@pytest.mark.parametrize(('allowed', 'disallowed', 'form_id', 'expected'), (
+    ('',       '',       1, None),
+    ('[1, 2]', '',       1, None),
+    ('[1, 2]', '',       3, MESSAGE_FORM_NOT_ALLOWED),
+    ('',       '[1]',    1, MESSAGE_FORM_NOT_ALLOWED),
+    ('[1,2]',  '[2]',    2, MESSAGE_FORM_NOT_ALLOWED),
+    ('[1,2]',  '[2]',    1, None),
+))
+def test_check_form(allowed, disallowed, form_id, expected):
+    rules = PaymentRules.from_settings(_settings(allowed, disallowed))
+    assert rules.check_form(form_id) == expected
+
+
+@pytest.mark.parametrize(('completed', 'uncompleted', 'related_states', 'expected'), (
+    (None, None, {}, None),
+    (2, None, {}, MESSAGE_NO_RELATED),
+    (2, None, {2: [RegistrationState.complete]}, None),
+    (2, None, {2: [RegistrationState.unpaid]}, MESSAGE_RELATED_NOT_COMPLETED),
+    (2, None, {2: [RegistrationState.complete] * 2}, MESSAGE_MULTIPLE_RELATED),
+    (None, 3, {}, None),
+    (None, 3, {3: [RegistrationState.unpaid]}, None),
+    (None, 3, {3: [RegistrationState.complete]}, MESSAGE_RELATED_COMPLETED),
+    (None, 3, {3: [RegistrationState.unpaid] * 2}, MESSAGE_MULTIPLE_RELATED),
+    (2, 3, {2: [RegistrationState.complete], 3: [RegistrationState.complete]}, MESSAGE_RELATED_COMPLETED),
+    (1, 1, {}, None),
+))
+def test_check_related(completed, uncompleted, related_states, expected):
+    rules = PaymentRules.from_settings(_settings(completed=completed, uncompleted=uncompleted))
+    assert set(related_states) <= set(rules.get_related_form_ids(1))
+    assert rules.check_related(1, related_states) == expected
+
+
+def test_rules_cached_per_settings():
+    rules = get_payment_rules(_settings('[1]'))
+    assert get_payment_rules(_settings('[1]')) is rules
+    assert get_payment_rules(_settings('[1, 2]')) is not rules
+    with pytest.raises(AttributeError):
+        rules.allowed_form_ids = None
+
+
+@pytest.fixture
+def related_regform(db, dummy_event):
+    """Create the registration form the payment rules refer to."""
+    regform = RegistrationForm(event=dummy_event, title='Related Form', currency='USD')
+    db.session.add(regform)
+    db.session.flush()
+    return regform
+
+
+def _create_related_reg(regform, state, email='1337@example.com', is_deleted=False):
+    reg = Registration(registration_form=regform, first_name='Guinea', last_name='Pig', email=email, state=state,
+                       is_deleted=is_deleted, currency='USD')
+    regform.event.registrations.append(reg)
+    return reg
+
+
+@pytest.mark.parametrize(('setting', 'related', 'expected'), (
+    # no related registration
+    ('completed', (), MESSAGE_NO_RELATED),
+    ('completed', ((RegistrationState.complete, True),), MESSAGE_NO_RELATED),
+    ('completed', ((RegistrationState.withdrawn, False),), MESSAGE_NO_RELATED),
+    ('uncompleted', (), None),
+    ('uncompleted', ((RegistrationState.complete, True),), None),
+    ('uncompleted', ((RegistrationState.rejected, False),), None),
+    # allowed
+    ('completed', ((RegistrationState.complete, False),), None),
+    ('completed', ((RegistrationState.withdrawn, False), (RegistrationState.complete, False)), None),
+    ('uncompleted', ((RegistrationState.unpaid, False),), None),
+    # blocked
+    ('completed', ((RegistrationState.unpaid, False),), MESSAGE_RELATED_NOT_COMPLETED),
+    ('completed', ((RegistrationState.pending, False),), MESSAGE_RELATED_NOT_COMPLETED),
+    ('uncompleted', ((RegistrationState.complete, False),), MESSAGE_RELATED_COMPLETED),
+))
+def test_get_related_registration_states(db, dummy_reg, related_regform, setting, related, expected):
+    # Indico's unique index on the email of the active registrations of a form means
+    # that there is at most one related registration, so MESSAGE_MULTIPLE_RELATED
+    # cannot happen here; inactive registrations must be ignored though
+    _create_related_reg(related_regform, RegistrationState.complete, email='other@example.com')
+    for state, is_deleted in related:
+        _create_related_reg(related_regform, state, is_deleted=is_deleted)
+    db.session.flush()
+    rules = PaymentRules.from_settings(_settings(**{setting: related_regform.id}))
+    form_ids = rules.get_related_form_ids(dummy_reg.registration_form_id)
+    related_states = get_related_registration_states(dummy_reg.email, form_ids)
+    inactive = {RegistrationState.withdrawn, RegistrationState.rejected}
+    active_states = [state for state, is_deleted in related if not is_deleted and state not in inactive]
+    assert related_states == {related_regform.id: active_states}
+    assert rules.check_related(dummy_reg.registration_form_id, related_states) == expected
+
+
+def test_get_related_registration_states_no_forms(dummy_reg, count_queries):
+    rules = PaymentRules.from_settings(_settings(completed=dummy_reg.registration_form_id))
+    with count_queries() as count:
+        related_states = get_related_registration_states(dummy_reg.email,
+                                                         rules.get_related_form_ids(dummy_reg.registration_form_id))
+    assert related_states == {}
+    assert count() == 0
+    assert rules.check_related(dummy_reg.registration_form_id, related_states) is None
@@ -0,0 +1,160 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import io
+import json
+from datetime import timedelta
+from decimal import Decimal
+
+import pytest
+
+from indico.modules.events.payment.models.transactions import PaymentTransaction, TransactionStatus
+from indico.modules.events.registration.models.registrations import Registration, RegistrationState
+from indico.util.date_time import now_utc
+
+from indico_payment_icbc.plugin import ICBCPaymentPlugin
+from indico_payment_icbc.settlement import (SettlementRecord, StatementFormatError, read_statement,
+                                            reconcile_statement)
+
+
+STATEMENT = '''\
+ICBC settlement statement|2026-10-17
+mer_id|out_trade_no|order_id|total_amt|pay_time
+020001|0001|ICBC1|10000|2026-10-17 10:00:00
+020001|0002|ICBC2|2550|2026-10-17 11:00:00
+total|2
+'''
+
+
+def test_read_statement():
+    records = list(read_statement(io.StringIO(STATEMENT)))
+    assert [(r.mer_id, r.out_trade_no, r.amount) for r in records] == [('020001', '0001', 10000),
+                                                                        ('020001', '0002', 2550)]
+    assert records[0].line == 3
+    assert records[1].data['order_id'] == 'ICBC2'
+
+
+def test_read_statement_custom_columns():
+    statement = 'merchant,order,amount\n020001,0001,100.00\n020001,0002,25.5\n'
+    records = read_statement(io.StringIO(statement), delimiter=',', amount_in_yuan=True,
+                             columns={'mer_id': 'merchant', 'out_trade_no': 'order', 'amount': 'amount'})
+    assert [r.amount for r in records] == [10000, 2550]
+
+
+def test_read_statement_is_lazy():
+    lines = iter(STATEMENT.splitlines(keepends=True))
+    records = read_statement(lines)
+    assert next(records).out_trade_no == '0001'
+    # the rest of the file has not been read yet
+    assert next(lines).startswith('020001|0002')
+
+
+@pytest.mark.parametrize('statement', (
+    'foo|bar\n1|2\n',
+    'mer_id|out_trade_no|total_amt\n020001|0001|lots\n',
+))
+def test_read_statement_invalid(statement):
+    with pytest.raises(StatementFormatError):
+        list(read_statement(io.StringIO(statement)))
+
+
+@pytest.fixture
+def create_registration(db, dummy_regform):
+    """Return a callable creating an unpaid registration costing 13.37."""
+    def _create_registration(email):
+        registration = Registration(registration_form=dummy_regform, first_name='Guinea', last_name='Pig',
+                                    email=email, state=RegistrationState.unpaid, base_price=Decimal('13.37'),
+                                    currency='USD')
+        dummy_regform.event.registrations.append(registration)
+        db.session.flush()
+        return registration
+
+    return _create_registration
+
+
+def _pay(db, order, timestamp=None):
+    transaction = PaymentTransaction(registration=order.registration, status=TransactionStatus.successful,
+                                     amount=order.amount, currency=order.currency, provider='icbc', data={},
+                                     timestamp=timestamp or now_utc())
+    order.registration.transaction = transaction
+    order.update_status('0', paid_transaction=transaction)
+    db.session.flush()
+
+
+def _record(out_trade_no, amount=1337, mer_id='020001'):
+    return SettlementRecord(line=1, mer_id=mer_id, out_trade_no=out_trade_no, amount=amount,
+                            data={'order_id': f'ICBC{out_trade_no}'})
+
+
+def _reconcile(records, **kwargs):
+    with ICBCPaymentPlugin.instance.plugin_context():
+        return [(result.outcome, result.record.out_trade_no if result.record else None, result.order, result.detail)
+                for result in reconcile_statement(records, **kwargs)]
+
+
+@pytest.mark.parametrize('batch_size', (1, 3, None), ids=('single', 'batched', 'default'))
+def test_reconcile_statement(db, create_registration, create_icbc_order, batch_size):
+    paid = create_icbc_order(create_registration('paid@example.com'), '0001')
+    _pay(db, paid)
+    unpaid = create_icbc_order(create_registration('unpaid@example.com'), '0002')
+    registration = create_registration('twice@example.com')
+    _pay(db, create_icbc_order(registration, '0003'))
+    paid_twice = create_icbc_order(registration, '0004')
+    mismatch = create_icbc_order(create_registration('mismatch@example.com'), '0005')
+    records = [_record('0001'), _record('0002'), _record('0001'), _record('0004'), _record('0005', 1000),
+               _record('0006'), _record('0002', mer_id='020002'), _record('0002')]
+    # the duplicates are found within a batch, across batches or both (the second 0001 is in the
+    # first batch of 3 records, the second 0002 is not)
+    assert _reconcile(records, batch_size=batch_size) == [
+        ('matched', '0001', paid, ''),
+        ('unpaid', '0002', unpaid, ''),
+        ('duplicate', '0001', paid, ''),
+        ('paid_twice', '0004', paid_twice, ''),
+        ('amount_mismatch', '0005', mismatch, '1000 != 1337'),
+        ('missing', '0006', None, ''),
+        ('missing', '0002', None, ''),
+        ('duplicate', '0002', unpaid, ''),
+    ]
+    assert not unpaid.is_paid
+    assert not paid_twice.is_paid
+    assert not mismatch.is_paid
+
+
+def test_reconcile_statement_register(db, mocker, create_registration, create_icbc_order):
+    # registering the payment would email the registrant
+    mocker.patch('indico.modules.events.payment.util.notify_registration_state_update')
+    registration = create_registration('unpaid@example.com')
+    order = create_icbc_order(registration, '0001')
+    other = create_icbc_order(registration, '0002')
+    results = _reconcile([_record('0001'), _record('0002')], register=True)
+    assert results == [('registered', '0001', order, ''), ('paid_twice', '0002', other, '')]
+    assert registration.is_paid
+    assert order.paid_transaction == registration.transaction
+    assert not other.is_paid
+    data = registration.transaction.data
+    assert json.loads(data['biz_content'])['out_trade_no'] == '0001'
+    assert data['settlement'] == {'order_id': 'ICBC0001'}
+    # running it again finds the payment registered
+    assert _reconcile([_record('0001')], register=True) == [('matched', '0001', order, '')]
+
+
+def test_reconcile_statement_unsettled(db, create_registration, create_icbc_order):
+    start_dt = now_utc() - timedelta(days=1)
+    end_dt = now_utc() + timedelta(hours=1)
+    settled = create_icbc_order(create_registration('settled@example.com'), '0001')
+    _pay(db, settled)
+    # the same order number of another merchant
+    unsettled = create_icbc_order(create_registration('unsettled@example.com'), '0001', mer_id='020002')
+    _pay(db, unsettled)
+    _pay(db, create_icbc_order(create_registration('old@example.com'), '0002'), start_dt - timedelta(hours=1))
+    create_icbc_order(create_registration('unpaid@example.com'), '0003')
+    assert _reconcile([_record('0001')], start_dt=start_dt, end_dt=end_dt) == [
+        ('matched', '0001', settled, ''),
+        ('unsettled', None, unsettled, ''),
+    ]
+    # without the period of the statement there is nothing to compare
+    assert _reconcile([_record('0001')]) == [('matched', '0001', settled, '')]
@@ -0,0 +1,85 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from indico_payment_icbc import tracing
+
+
+@pytest.fixture
+def profile_dir(tmp_path):
+    yield tmp_path
+    tracing.set_profile_threshold(None)
+
+
+@pytest.fixture
+def span_exporter():
+    pytest.importorskip('opentelemetry.sdk')
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    tracing.set_tracer(provider.get_tracer('indico_payment_icbc'))
+    yield exporter
+    tracing.set_tracer(None)
+
+
+def _work():
+    return sum(i * i for i in range(1000))
+
+
+def _query():
+    with tracing.span('icbc.gateway_call'):
+        pass
+
+
+def test_disabled():
+    assert tracing.span('icbc.test') is tracing.span('icbc.other', foo='bar')
+    assert tracing.profiled('icbc-test') is tracing.span('icbc.test')
+    assert tracing.bind_context(_work) is _work
+
+
+@pytest.mark.parametrize(('threshold', 'saved'), (
+    (0, True),
+    (3600, False),
+))
+def test_profiled(profile_dir, threshold, saved):
+    tracing.set_profile_threshold(threshold, profile_dir)
+    with tracing.profiled('icbc-test'):
+        _work()
+    profiles = list(profile_dir.glob('icbc-test-*.prof'))
+    assert len(profiles) == saved
+    if saved:
+        assert any(func[2] == '_work' for func in pstats.Stats(str(profiles[0])).stats)
+
+
+def test_profiled_nested(profile_dir):
+    tracing.set_profile_threshold(0, profile_dir)
+    with tracing.profiled('icbc-outer'):
+        with tracing.profiled('icbc-inner'):
+            _work()
+    assert [p.name.split('-')[1] for p in profile_dir.iterdir()] == ['outer']
+
+
+def test_spans(span_exporter):
+    with tracing.span('icbc.notify'):
+        with tracing.span('icbc.verify_signature', handler='notify'):
+            pass
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(tracing.bind_context(_query)).result()
+    spans = {span.name: span for span in span_exporter.get_finished_spans()}
+    assert set(spans) == {'icbc.notify', 'icbc.verify_signature', 'icbc.gateway_call'}
+    assert spans['icbc.verify_signature'].attributes == {'handler': 'notify'}
+    assert spans['icbc.verify_signature'].parent.span_id == spans['icbc.notify'].context.span_id
+    # spans in the executor's threads are still children of the handler span
+    assert spans['icbc.gateway_call'].parent.span_id == spans['icbc.notify'].context.span_id
@@ -0,0 +1,135 @@
+# This file is part of the Indico plugins.
+# Copyright (C) 2002 - 2024 CERN
+#
+# The Indico plugins are free software; you can redistribute
+# them and/or modify them under the terms of the MIT License;
+# see the LICENSE file for more details.
+
+import base64
+import json
+
+import pytest
+from Crypto.Hash import SHA1
+from Crypto.Signature import pkcs1_15
+
+from indico_payment_icbc.crypto import BACKENDS
+from indico_payment_icbc.util import (AesCodec, RsaUtil, aes_decrypt, aes_encrypt, get_icbc_verifier,
+                                      reload_icbc_verifier, wrap_private_key)
+
+
+pytest.importorskip('pytest_benchmark')
+
+# what ICBC signs in the success flow: the quoted response_biz_content
+ENCRYPT_STR = '"{}"'.format('A' * 512)
+
+# a domestic order as built by the plugin (~800 bytes of JSON)
+BIZ_CONTENT = json.dumps({
+    'icbc_flag': '1', 'icbc_appid': '10000000000004095503', 'order_date': '20261018120000',
+    'out_trade_no': '0000000123456789012345678901', 'amount': '150000', 'installment_times': '1',
+    'cur_type': '001', 'mer_id': '020001020001', 'mer_prtcl_no': '0200010200010201',
+    'goods_id': '1234', 'goods_name': 'Registration of Inte', 'mer_reference': 'indico.example.com',
+    'mer_url': 'https://indico.example.com/event/1/registrations/2/icbc/success?token=' + 'f' * 36,
+    'return_url': 'https://indico.example.com/event/1/registrations/2/icbc/success?token=' + 'f' * 36,
+    'credit_type': '2', 'expire_time': '20261018121500', 'verify_join_flag': '0',
+    'mer_custom_id': 'guinea.pig@example.com', 'page_linkage_flag': '1',
+    'mer_order_remark': 'Guinea Pig (guinea.pig@example.com) payment for Registration of International '
+                        'Conference on Things',
+}, separators=(',', ':'))
+
+
+@pytest.fixture(scope='module')
+def request_fields(encrypt_key):
+    return {'app_id': '10000000000004095503', 'msg_id': '0000000123456789012345678901', 'format': 'json',
+            'charset': 'UTF-8', 'encrypt_type': 'AES', 'sign_type': 'RSA2', 'timestamp': '2026-10-18 12:00:00',
+            'biz_content': aes_encrypt(BIZ_CONTENT, encrypt_key)}
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request):
+    if request.param == 'cryptography':
+        pytest.importorskip('cryptography')
+    return BACKENDS[request.param]()
+
+
+@pytest.fixture
+def gateway_verifier(gateway_key):
+    public_key = gateway_key.publickey().export_key().decode()
+    yield public_key, reload_icbc_verifier(public_key)
+    reload_icbc_verifier()
+
+
+@pytest.fixture
+def gateway_signature(gateway_key):
+    # the gateway signs with SHA1withRSA
+    signature = pkcs1_15.new(gateway_key).sign(SHA1.new(ENCRYPT_STR.encode()))
+    return base64.b64encode(signature).decode()
+
+
+@pytest.mark.benchmark(group='icbc-verify')
+def test_verify_parse_per_call(benchmark, gateway_verifier, gateway_signature):
+    public_key = gateway_verifier[0]
+    assert benchmark(lambda: RsaUtil(public_key=public_key).verify_sign(ENCRYPT_STR, gateway_signature)) is True
+
+
+@pytest.mark.benchmark(group='icbc-verify')
+def test_verify_shared_verifier(benchmark, gateway_verifier, gateway_signature):
+    assert get_icbc_verifier() is gateway_verifier[1]
+    assert benchmark(lambda: get_icbc_verifier().verify_sign(ENCRYPT_STR, gateway_signature)) is True
+
+
+@pytest.mark.benchmark(group='icbc-aes')
+def test_aes_encrypt(benchmark, encrypt_key):
+    assert benchmark(aes_encrypt, BIZ_CONTENT, encrypt_key)
+
+
+@pytest.mark.benchmark(group='icbc-aes')
+def test_aes_decrypt(benchmark, encrypt_key):
+    encrypted = aes_encrypt(BIZ_CONTENT, encrypt_key)
+    assert benchmark(aes_decrypt, encrypted, encrypt_key) == BIZ_CONTENT
+
+
+@pytest.mark.benchmark(group='icbc-rsa')
+def test_import_key(benchmark, sign_key):
+    assert benchmark(RsaUtil.import_key, key=wrap_private_key(sign_key)).has_private()
+
+
+@pytest.mark.benchmark(group='icbc-rsa')
+def test_create_sign(benchmark, merchant_key, request_fields):
+    rsa_util = RsaUtil(private_key=merchant_key.export_key())
+    encrypt_str = RsaUtil.encrypt_str('/ui/cardbusiness/epaypc/consumption/V1', request_fields)
+    assert benchmark(rsa_util.create_sign, encrypt_str)
+
+
+@pytest.mark.benchmark(group='icbc-rsa')
+def test_verify_sign(benchmark, gateway_verifier, gateway_signature):
+    assert benchmark(gateway_verifier[1].verify_sign, ENCRYPT_STR, gateway_signature) is True
+
+
+@pytest.mark.benchmark(group='icbc-canonicalize')
+def test_encrypt_str(benchmark, request_fields):
+    encrypt_str = benchmark(RsaUtil.encrypt_str, '/ui/cardbusiness/epaypc/consumption/V1', request_fields)
+    assert encrypt_str.startswith('/ui/cardbusiness/epaypc/consumption/V1?app_id=')
+
+
+@pytest.mark.benchmark(group='icbc-backend-sign')
+def test_backend_create_sign(benchmark, backend, sign_key, request_fields):
+    rsa_util = RsaUtil(private_key=wrap_private_key(sign_key), backend=backend)
+    encrypt_str = RsaUtil.encrypt_str('/ui/cardbusiness/epaypc/consumption/V1', request_fields)
+    assert benchmark(rsa_util.create_sign, encrypt_str)
+
+
+@pytest.mark.benchmark(group='icbc-backend-verify')
+def test_backend_verify_sign(benchmark, backend, gateway_key, gateway_signature):
+    verifier = RsaUtil(public_key=gateway_key.publickey().export_key().decode(), backend=backend)
+    assert benchmark(verifier.verify_sign, ENCRYPT_STR, gateway_signature) is True
+
+
+@pytest.mark.benchmark(group='icbc-backend-aes-encrypt')
+def test_backend_aes_encrypt(benchmark, backend, encrypt_key):
+    assert benchmark(AesCodec(encrypt_key, backend=backend).encrypt, BIZ_CONTENT)
+
+
+@pytest.mark.benchmark(group='icbc-backend-aes-decrypt')
+def test_backend_aes_decrypt(benchmark, backend, encrypt_key):
+    codec = AesCodec(encrypt_key, backend=backend)
+    assert benchmark(codec.decrypt, codec.encrypt(BIZ_CONTENT)) == BIZ_CONTENT
@@ -5,27 +5,96 @@
 # them and/or modify them under the terms of the MIT License;
 # see the LICENSE file for more details.
 
-from unittest.mock import MagicMock
+import base64
 
 import pytest
-from wtforms import ValidationError
-
-from indico_payment_icbc.util import validate_business
-
-
-@pytest.mark.parametrize(('data', 'valid'), (
-    ('foobar',              False),
-    ('foo@bar,com',         False),
-    ('example@example.com', True),
-    ('X2345A789B12Cx',      False),
-    ('X2345A789B12',        False),
-    ('1234567890123',       True),
-    ('X2345A789B12C',       True),
-))
-def test_validate_business(data, valid):
-    field = MagicMock(data=data)
-    if valid:
-        validate_business(None, field)
-    else:
-        with pytest.raises(ValidationError):
-            validate_business(None, field)
+from Crypto.Hash import SHA1, SHA256
+from Crypto.Signature import pkcs1_15
+
+from indico_payment_icbc.util import (LRUCache, RsaUtil, aes_decrypt, aes_encrypt, get_aes_codec, get_icbc_verifier,
+                                      get_signer, invalidate_signer, reload_icbc_verifier, verify_response_signature)
+
+
+def test_encrypt_str():
+    params = {'sign_type': 'RSA2', 'app_id': '1000', 'biz_content': '{"a":"b"}', 'charset': 'UTF-8'}
+    assert RsaUtil.encrypt_str('/api/foo/V1', params) == ('/api/foo/V1?app_id=1000&biz_content={"a":"b"}'
+                                                          '&charset=UTF-8&sign_type=RSA2')
+
+
+def test_sign_roundtrip(sign_key):
+    signer = get_signer(sign_key)
+    signature = signer.create_sign('/api/foo/V1?app_id=1000')
+    # ICBC verifies merchant signatures with SHA256withRSA
+    hash_obj = SHA256.new(b'/api/foo/V1?app_id=1000')
+    pkcs1_15.new(signer.public_key).verify(hash_obj, base64.b64decode(signature))
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.get_or_create('a', lambda: 1)
+    cache.get_or_create('b', lambda: 2)
+    assert cache.get_or_create('a', lambda: None) == 1
+    cache.get_or_create('c', lambda: 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert len(cache) == 2
+
+
+def test_get_signer_cached(sign_key):
+    invalidate_signer()
+    signer = get_signer(sign_key)
+    assert get_signer(sign_key) is signer
+    invalidate_signer(sign_key)
+    assert get_signer(sign_key) is not signer
+
+
+@pytest.mark.parametrize('plaintext', ('', '{"out_trade_no":"1"}', '中国工商银行' * 20))
+def test_aes_roundtrip(encrypt_key, plaintext):
+    encrypted = aes_encrypt(plaintext, encrypt_key)
+    assert encrypted == get_aes_codec(encrypt_key).encrypt(plaintext)
+    assert aes_decrypt(encrypted, encrypt_key) == plaintext
+
+
+def test_aes_codec_batch(encrypt_key):
+    codec = get_aes_codec(encrypt_key)
+    assert get_aes_codec(encrypt_key) is codec
+    payloads = [f'payload {i}' for i in range(100)]
+    encrypted = list(codec.encrypt_many(payloads))
+    assert encrypted == [codec.encrypt(p) for p in payloads]
+    assert list(codec.decrypt_many(encrypted)) == payloads
+
+
+@pytest.fixture
+def icbc_verifier():
+    yield
+    # other tests expect the built-in gateway key
+    reload_icbc_verifier()
+
+
+def _gateway_sign(gateway_key, content):
+    return base64.b64encode(pkcs1_15.new(gateway_key).sign(SHA1.new(content.encode()))).decode()
+
+
+@pytest.mark.usefixtures('icbc_verifier')
+def test_reload_icbc_verifier(gateway_key):
+    verifier = get_icbc_verifier()
+    # without a gateway_public_key setting all callers share the built-in key
+    assert get_icbc_verifier() is verifier
+    assert get_icbc_verifier('') is verifier
+    signature = _gateway_sign(gateway_key, '"abc"')
+    assert not verifier.verify_sign('"abc"', signature)
+    reloaded = reload_icbc_verifier(gateway_key.publickey().export_key().decode())
+    assert get_icbc_verifier() is reloaded
+    assert reloaded.verify_sign('"abc"', signature)
+    # switching back to the built-in key
+    assert not reload_icbc_verifier().verify_sign('"abc"', signature)
+
+
+def test_icbc_verifier_configured_key(gateway_key):
+    public_key = gateway_key.publickey().export_key().decode()
+    verifier = get_icbc_verifier(public_key)
+    assert get_icbc_verifier(public_key) is verifier
+    assert verifier is not get_icbc_verifier()
+    signature = _gateway_sign(gateway_key, '"abc"')
+    assert verify_response_signature({'response_biz_content': 'abc', 'sign': signature}, public_key)
+    assert not verify_response_signature({'response_biz_content': 'abc', 'sign': signature})